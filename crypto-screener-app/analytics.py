@@ -0,0 +1,150 @@
+# Multi-asset analytics for the cryptocurrency screener
+#
+# Returns, correlations and betas of many products are computed on the aligned (time x product) price matrix, each
+# statistic being one matrix operation over all products rather than a loop over them. Products listed at different
+# times leave missing values in the matrix, statistics of a pair of products use the times where both have a return.
+
+import unittest
+import numpy as np
+import pandas as pd
+from screener import price_matrix
+
+
+# Returns the (time x product) matrix of close prices of some products. Without a start the latest window of candles
+# of every product is read from the candle cache (downloaded concurrently on a miss) and passed through
+# overlay(product_id, interval, candles) when given, i.e. to merge in the live candles. With a start (unix time) the
+# candles since then are read concurrently, older ones from the candle store.
+def close_matrix(market_data, product_ids, interval, start=None, overlay=None):
+    if start is not None:
+        product_candles = {p: c.tolist() for p, c in market_data.get_many_histories(product_ids, interval, start).items()}
+    else:
+        product_candles = market_data.get_many_historic_rates(product_ids, interval)
+        if overlay is not None:
+            product_candles = {p: overlay(p, interval, c) for p, c in product_candles.items()}
+    return price_matrix(product_candles)[0]
+
+
+# Returns the simple (or log) returns of a price matrix, times where a product did not trade keep the previous close
+def return_matrix(close, log=False):
+    prices = close.ffill()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.log(prices / prices.shift(1)) if log else prices / prices.shift(1) - 1
+    return returns.iloc[1:]
+
+
+# Returns the cumulative returns of every product since its first price
+def cumulative_returns(close):
+    prices = close.ffill()
+    first = prices.bfill().iloc[0]
+    return prices / first - 1
+
+
+# Returns the pairwise sums needed by the pairwise-complete statistics: the number of times where both products have
+# a return, the sums of the row product's and the column product's returns, of their squares and of their products
+def _pairwise_sums(returns):
+    values = returns.values
+    mask = np.isfinite(values).astype(np.float64)
+    x = np.where(mask > 0, values, 0.0)
+    n = mask.T @ mask
+    sx = x.T @ mask
+    sxx = (x * x).T @ mask
+    sxy = x.T @ x
+    return n, sx, sx.T, sxx, sxx.T, sxy
+
+
+# Returns the (product x product) covariance matrix and variances of the row and column products over common times
+def _pairwise_moments(returns):
+    n, sx, sy, sxx, syy, sxy = _pairwise_sums(returns)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = np.where(n > 1, n, np.nan)
+        cov = (sxy - sx * sy / n) / (n - 1)
+        var_x = (sxx - sx * sx / n) / (n - 1)
+        var_y = (syy - sy * sy / n) / (n - 1)
+    return cov, var_x, var_y
+
+
+# Returns the correlation matrix of the returns
+def correlation_matrix(returns):
+    cov, var_x, var_y = _pairwise_moments(returns)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / np.sqrt(var_x * var_y)
+    return pd.DataFrame(np.clip(corr, -1, 1), index=returns.columns, columns=returns.columns)
+
+
+# Returns the matrix of betas, the beta of the row product against the column product
+def beta_matrix(returns):
+    cov, var_x, var_y = _pairwise_moments(returns)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = cov / var_y
+    return pd.DataFrame(beta, index=returns.columns, columns=returns.columns)
+
+
+# Returns the rolling sums over `window` rows of a matrix with missing values counted as zeros
+def _rolling_sum(values, window):
+    sums = np.cumsum(np.vstack([np.zeros((1, values.shape[1])), values]), axis=0)
+    return sums[window:] - sums[:-window]
+
+
+# Returns the rolling correlations and betas of every product against a benchmark product, over `window` returns
+def rolling_statistics(returns, benchmark, window):
+    x = returns.values
+    y = returns[benchmark].values[:, None]
+    mask = (np.isfinite(x) & np.isfinite(y)).astype(np.float64)
+    x, y = np.where(mask > 0, x, 0.0), np.where(mask > 0, y, 0.0)
+    n = _rolling_sum(mask, window)
+    sx, sy = _rolling_sum(x, window), _rolling_sum(y, window)
+    sxx, syy, sxy = _rolling_sum(x * x, window), _rolling_sum(y * y, window), _rolling_sum(x * y, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = np.where(n >= window, n, np.nan)
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        corr = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+        beta = cov / var_y
+    index = returns.index[window - 1:]
+    return (pd.DataFrame(corr, index=index, columns=returns.columns),
+            pd.DataFrame(beta, index=index, columns=returns.columns))
+
+
+def _returns_with_gaps(seed=0):
+    # Random returns of products listed at different times and missing a few trades
+    rng = np.random.default_rng(seed)
+    returns = pd.DataFrame(rng.normal(0, 0.01, (200, 4)), columns=['A-USD', 'B-USD', 'C-USD', 'D-USD'])
+    returns['B-USD'] += returns['A-USD'] * 0.8
+    returns.iloc[:50, 2] = np.nan
+    returns.iloc[rng.choice(200, 20, replace=False), 3] = np.nan
+    return returns
+
+
+class TestAnalytics(unittest.TestCase):
+    def test_correlation_matrix(self):
+        returns = _returns_with_gaps()
+        np.testing.assert_allclose(correlation_matrix(returns).values, returns.corr().values, atol=1e-12)
+
+    def test_beta_matrix(self):
+        returns = _returns_with_gaps()
+        expected = pd.DataFrame(index=returns.columns, columns=returns.columns, dtype=float)
+        for x in returns.columns:
+            for y in returns.columns:
+                both = returns[x].notna() & returns[y].notna()
+                expected.loc[x, y] = returns[x][both].cov(returns[y][both]) / returns[y][both].var()
+        np.testing.assert_allclose(beta_matrix(returns).values, expected.values, atol=1e-12)
+
+    def test_rolling_statistics(self):
+        returns = _returns_with_gaps()
+        corr, beta = rolling_statistics(returns, 'A-USD', 30)
+        for p in returns.columns:
+            expected_corr = returns[p].rolling(30).corr(returns['A-USD']).iloc[29:]
+            expected_beta = (returns[p].rolling(30).cov(returns['A-USD']) / returns['A-USD'].rolling(30).var()).iloc[29:]
+            np.testing.assert_allclose(corr[p].values, expected_corr.values, atol=1e-10)
+            np.testing.assert_allclose(beta[p].values, expected_beta.values, atol=1e-10)
+
+    def test_return_matrix_fills_gaps(self):
+        close = pd.DataFrame({'A-USD': [1.0, np.nan, 2.0], 'B-USD': [np.nan, 4.0, 5.0]})
+        returns = return_matrix(close)
+        np.testing.assert_allclose(returns['A-USD'].values, [0.0, 1.0])
+        np.testing.assert_allclose(returns['B-USD'].values, [np.nan, 0.25])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,34 +2,59 @@
 #
 
 import cbpro
+import os
 import time
 import dash
 import dash_table
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
-from datetime import datetime
-from re import search
-import pandas as pd
-import numpy as np
 import plotly.graph_objs as go
-from plotly.subplots import make_subplots
-
-# Authenticate public client to coinbase pro
-public_client = cbpro.PublicClient()
+from marketdata import MarketData, parse_candles
+from candlestore import Backfiller, CandleStore
+from screener import CHANGE_COLUMNS, ScreenerRefresher, ScreenerStore
+from analytics import beta_matrix, close_matrix, correlation_matrix, cumulative_returns, return_matrix
+from livefeed import DEFAULT_WS_URL, LiveCandles, LiveFeed
+from indicators import IndicatorEngine
+from downsample import downsample_candles, downsample_line, visible_range
+from products import ProductRegistry
+from fakeclient import FakePublicClient
+from metrics import CONTENT_TYPE, REGISTRY, InstrumentedClient, timed_callback, timed_function
+
+# Authenticate public client to coinbase pro, CBPRO_API_URL can point the app at a local stub of the API and
+# CBPRO_FIXTURES replaces the API by recorded fixtures (see fakeclient.py)
+if os.environ.get('CBPRO_FIXTURES'):
+    public_client = FakePublicClient(os.environ['CBPRO_FIXTURES'], latency=float(os.environ.get('CBPRO_FIXTURES_LATENCY', 0)))
+else:
+    public_client = cbpro.PublicClient(api_url=os.environ.get('CBPRO_API_URL', 'https://api.pro.coinbase.com'))
+
+# Every upstream call is counted and timed, see the /metrics route
+public_client = InstrumentedClient(public_client)
+
+# Local candle store shared by all workers, CANDLE_STORE_DIR='' disables it
+candle_store_dir = os.environ.get('CANDLE_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'candle-store'))
+candle_store = CandleStore(candle_store_dir) if candle_store_dir else None
+
+# Rate limited, memoizing access to the public client
+market_data = MarketData(public_client, store=candle_store)
+
+# Product ids, names and dropdown options, saved next to the candle store and refreshed hourly in the background
+product_registry = ProductRegistry(market_data, os.path.join(candle_store_dir, 'products.json') if candle_store_dir else None)
+product_registry.ensure_loaded()
+product_registry.start()
 
 # Returns a list of the cryptocurrency/USD pairs
+@timed_function
 def getProductIds(output='dict'):
-    products = [p['id'] for p in public_client.get_products() if search(r'-USD$', p['id'])]
     if output == 'dict':
-        return [{'label': p, 'value': p} for p in sorted(products)]
+        return product_registry.options('USD')
     else:
-        return products
+        return product_registry.ids('USD')
 
 # Returns the name of the cryptocurrency as a string
+@timed_function
 def getProductName(product_id):
-    id_name = {c['id']: c['name'] for c in public_client.get_currencies()}
-    return id_name[product_id.replace('-USD', '')]
+    return product_registry.name(product_id)
 
 # Returns a list of the intervals
 def getIntervals():
@@ -37,34 +62,50 @@ def getIntervals():
     # intervals = {'1m': 60, '5m': 300, '15m': 900, '1h': 3600, '6h': 21600, 'D': 86400}
     return [{'label': key, 'value': value} for key, value in intervals]
 
-# Returns a dataframe with historical prices (OHLCV) for a given symbol and interval
-def getHistoricalData(product_id='BTC-USD', interval=60):
-    json_list = public_client.get_product_historic_rates(product_id, granularity=interval)
-    data = pd.DataFrame(json_list, columns=['time', 'low', 'high', 'open', 'close', 'volume'])
-    data['time'] = data['time'].apply(lambda x: datetime.utcfromtimestamp(x).isoformat())
-    data['time'] = pd.to_datetime(data['time'])
-    return data
-
-# Returns the screener dash_table.DataTable component
+# Returns a list of the history depths, in days (0 for the latest 300 candles only)
+def getHistories():
+    histories = [('latest', 0), ('1 week', 7), ('1 month', 30), ('1 year', 365), ('all', -1)]
+    return [{'label': key, 'value': value} for key, value in histories]
+
+# Returns the unix time from which to show `days` of history, None for the latest candles only and 0 for all
+def getStart(days):
+    if not days:
+        return None
+    return 0 if days < 0 else int(time.time()) - days * 86400
+
+# Live candles built from the websocket trade feed, LIVE_FEED=1 enables it
+live_feed_enabled = os.environ.get('LIVE_FEED', '0') == '1'
+live_candles = LiveCandles([interval['value'] for interval in getIntervals()]) if live_feed_enabled else None
+
+# Returns a dataframe with historical prices (OHLCV) for a given symbol and interval, going back to the
+# unix time `start` when given (deeper history than the latest 300 candles comes from the candle store)
+@timed_function
+def getHistoricalData(product_id='BTC-USD', interval=60, start=None):
+    if start is not None:
+        return parse_candles(market_data.get_history(product_id, interval, start))
+    candles = market_data.get_historic_rates(product_id, interval)
+    if live_candles is not None:
+        candles = live_candles.overlay(product_id, interval, candles)
+    return parse_candles(candles)
+
+# Returns the (time x product) matrix of close prices of several products, the latest candles of all products being
+# read in one concurrent pass
+@timed_function
+def getCloseMatrix(product_ids, interval=60, start=None):
+    return close_matrix(market_data, product_ids, interval, start, live_candles.overlay if live_candles is not None else None)
+
+# Indicator state is kept between callbacks so that only new candles are fed to the indicators
+indicator_engine = IndicatorEngine()
+
+# The screener is recomputed in the background and shared with the other workers through the candle store directory
+screener_store = ScreenerStore(os.path.join(candle_store_dir, 'screener.pkl') if candle_store_dir else None)
+ScreenerRefresher(market_data, product_registry, screener_store,
+                  interval=int(os.environ.get('SCREENER_REFRESH_SECONDS', 900)),
+                  lock_path=os.path.join(candle_store_dir, 'screener.lock') if candle_store_dir else None).start()
+
+# Returns the screener dash_table.DataTable component, built from the latest screener snapshot
 def get_screener():
-    screener = pd.DataFrame(columns=['productId','productName','last','7day%','30day%'])
-
-    for product_id in getProductIds(list):
-        try:
-            hist_data = getHistoricalData(product_id=product_id, interval=86400)
-            # Calculate columns and append to dataframe
-            hist_data_last = hist_data.iloc[0,:].close
-            hist_data_w = hist_data.iloc[7,:].close
-            hist_data_m = hist_data.iloc[30,:].close
-            screener = screener.append({'productId': product_id,
-                                 'productName': getProductName(product_id),
-                                 'last': hist_data_last,
-                                 '7day%': round((hist_data_last-hist_data_w)/hist_data_w*100,1),
-                                 '30day%': round((hist_data_last-hist_data_m)/hist_data_m*100,1)},
-                                ignore_index=True)
-            time.sleep(0.01)
-        except IndexError:
-            hist_data_m = 'NA'
+    screener = screener_store.latest()
 
     screener_table = dash_table.DataTable(
         id='table',
@@ -85,37 +126,28 @@ def get_screener():
         style_data_conditional=[
             {
                 'if': {
-                    'filter_query': '{7day%} > 0',
-                    'column_id': '7day%'
-                },
-                'color': 'green'
-            },
-            {
-                'if': {
-                    'filter_query': '{7day%} < 0',
-                    'column_id': '7day%'
-                },
-                'color': 'red'
-            },
-            {
-                'if': {
-                    'filter_query': '{30day%} > 0',
-                    'column_id': '30day%'
-                },
-                'color': 'green'
-            },
-            {
-                'if': {
-                    'filter_query': '{30day%} < 0',
-                    'column_id': '30day%'
+                    'filter_query': '{{{}}} {} 0'.format(column, comparison),
+                    'column_id': column
                 },
-                'color': 'red'
+                'color': color
             }
+            for column in CHANGE_COLUMNS
+            for comparison, color in [('>', 'green'), ('<', 'red')]
         ]
     )
 
     return screener_table
 
+# Backfill a year of daily candles in the background from a single worker, CANDLE_BACKFILL_DAYS=0 disables it
+backfill_days = int(os.environ.get('CANDLE_BACKFILL_DAYS', 365))
+if candle_store is not None and backfill_days:
+    Backfiller(market_data, candle_store, getProductIds(list), [86400], backfill_days * 86400,
+               lock_path=os.path.join(candle_store_dir, 'backfill.lock')).start()
+
+# Subscribe to the trades of every USD product, CBPRO_WS_URL can point the feed at a local replay server
+if live_feed_enabled:
+    LiveFeed(getProductIds(list), live_candles, url=os.environ.get('CBPRO_WS_URL', DEFAULT_WS_URL)).start()
+
 ## Layout
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -124,177 +156,356 @@ app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
 server = app.server
 
-app.layout = html.Div(children=[
-    html.H1(children='Cryptocurrency Screener'),
-    html.Div(className='row',  # Define the row element
-             children=[
-                 html.Div(className='two columns div-user-controls',
-                          children=[
-                              html.Label('Select symbol:'),
-                              dcc.Dropdown(
-                                  options=getProductIds(output='dict'),
-                                  value='BTC-USD',
-                                  id='dropdown-product'
-                              ),
-                              html.Label('Select an interval:'),
-                              dcc.Dropdown(
-                                  options=getIntervals(),
-                                  value=60,
-                                  id='dropdown-interval'
-                              ),
-                              html.Label('Select graph type:'),
-                              dcc.Dropdown(
-                                  options=[
-                                      {'label': 'line', 'value': 'line'},
-                                      {'label': 'candle', 'value': 'candle'}
-                                  ],
-                                  value='candle',
-                                  id='dropdown-graph'
-                              ),
-                              html.Label('Add indicator:'),
-                              dcc.Dropdown(
-                                  options=[
-                                      {'label': 'SMA', 'value': 'SMA'}
-                                  ],
-                                  multi=True,
-                                  value=[],
-                                  id='dropdown-indicator'
-                              ),
-                              html.Div(id='indicator-output-container',
-                                       children=[
-                                                "Enter SMA window:",
-                                                dcc.Input(
-                                                    id="input-sma", type="number", placeholder="",
-                                                    min=1, max=100, step=1,
-                                                )
-                              ]),
-                              html.Label('Select symbols to compare:'),
-                              dcc.Dropdown(
-                                  options=getProductIds(output='dict'),
-                                  multi=True,
-                                  value=['BTC-USD'],
-                                  id='dropdown-compare'
-                              ),
-                              html.Div(id='vol-slider-output-container'),
-                              dcc.Slider(
-                                min=3,
-                                max=50,
-                                step=1,
-                                value=7,
-                                id='volatility-slider'
-                              )
-                          ]
-                          ),  # End of left element
-
-                 html.Div(className='ten columns div-user-controls',
-                          children=[
-                              html.Div(className='seven columns div-left-display',
-                                    children=[
-                                        dcc.Graph(
-                                            id='stacked-charts'
-                                        )
-                                    ]
-                                    ),  # End of left chart element
-                              html.Div(className='five columns div-right-display',
-                                    children=[
-                                        get_screener()
-                                    ]
-                                    )  # End of right chart element
-
-                          ]
-                          )  # End of right element
-             ])
-
-])
+# The layout is a function so that every page load renders the latest screener snapshot
+@timed_function
+def serve_layout():
+    return html.Div(children=[
+        html.H1(children='Cryptocurrency Screener'),
+        html.Div(className='row',  # Define the row element
+                 children=[
+                     html.Div(className='two columns div-user-controls',
+                              children=[
+                                  html.Label('Select symbol:'),
+                                  dcc.Dropdown(
+                                      options=getProductIds(output='dict'),
+                                      value='BTC-USD',
+                                      id='dropdown-product'
+                                  ),
+                                  html.Label('Select an interval:'),
+                                  dcc.Dropdown(
+                                      options=getIntervals(),
+                                      value=60,
+                                      id='dropdown-interval'
+                                  ),
+                                  html.Label('Select history:'),
+                                  dcc.Dropdown(
+                                      options=getHistories(),
+                                      value=0,
+                                      id='dropdown-history'
+                                  ),
+                                  html.Label('Select graph type:'),
+                                  dcc.Dropdown(
+                                      options=[
+                                          {'label': 'line', 'value': 'line'},
+                                          {'label': 'candle', 'value': 'candle'}
+                                      ],
+                                      value='candle',
+                                      id='dropdown-graph'
+                                  ),
+                                  html.Label('Add indicator:'),
+                                  dcc.Dropdown(
+                                      options=[
+                                          {'label': 'SMA', 'value': 'SMA'},
+                                          {'label': 'EMA', 'value': 'EMA'},
+                                          {'label': 'Bollinger', 'value': 'BOLL'},
+                                          {'label': 'RSI', 'value': 'RSI'},
+                                          {'label': 'MACD', 'value': 'MACD'}
+                                      ],
+                                      multi=True,
+                                      value=[],
+                                      id='dropdown-indicator'
+                                  ),
+                                  html.Div(id='indicator-output-container',
+                                           children=[
+                                                    "Enter indicator window:",
+                                                    dcc.Input(
+                                                        id="input-sma", type="number", placeholder="",
+                                                        min=1, max=100, step=1,
+                                                    )
+                                  ]),
+                                  html.Label('Select symbols to compare:'),
+                                  dcc.Dropdown(
+                                      options=getProductIds(output='dict'),
+                                      multi=True,
+                                      value=['BTC-USD'],
+                                      id='dropdown-compare'
+                                  ),
+                                  html.Div(id='vol-slider-output-container'),
+                                  dcc.Slider(
+                                    min=3,
+                                    max=50,
+                                    step=1,
+                                    value=7,
+                                    id='volatility-slider'
+                                  )
+                              ]
+                              ),  # End of left element
+
+                     html.Div(className='ten columns div-user-controls',
+                              children=[
+                                  html.Div(className='seven columns div-left-display',
+                                        children=[
+                                            dcc.Graph(id='price-chart'),
+                                            dcc.Graph(id='oscillator-chart'),
+                                            dcc.Graph(id='volume-chart'),
+                                            dcc.Graph(id='returns-chart'),
+                                            dcc.Graph(id='correlation-chart'),
+                                            dcc.Graph(id='volatility-chart'),
+                                            # Redraws the charts with the latest live candles
+                                            dcc.Interval(id='live-interval',
+                                                         interval=int(os.environ.get('LIVE_FEED_REFRESH_MS', 2000)),
+                                                         disabled=not live_feed_enabled)
+                                        ]
+                                        ),  # End of left chart element
+                                  html.Div(className='five columns div-right-display',
+                                        children=[
+                                            get_screener(),
+                                            dcc.Interval(id='screener-interval', interval=60 * 1000)
+                                        ]
+                                        )  # End of right chart element
+
+                              ]
+                              )  # End of right element
+                 ])
+
+    ])
+
+app.layout = serve_layout
+
+# Prometheus metrics of this worker
+@server.route('/metrics')
+def metrics():
+    return REGISTRY.render(), 200, {'Content-Type': CONTENT_TYPE}
 
 ## Callbacks
 
 @app.callback(
-    Output('stacked-charts', 'figure'),
+    Output('table', 'data'),
+    [Input('screener-interval', 'n_intervals')])
+@timed_callback
+def update_screener(n_intervals):
+    return screener_store.latest().to_dict('records')
+
+# Panels are separate graphs with their own callbacks, so that an input only redraws the panels depending on it
+# and, for instance, moving the volatility slider neither rebuilds the candlestick nor reads any other product
+
+# Traces are downsampled to the visible range on the server (see downsample.py), and recomputed when a panel is
+# zoomed or panned, so figures stay small whatever the depth of the history
+
+# Returns the close prices of a product, oldest first
+def getClose(product_id, interval, days=0):
+    data = getHistoricalData(product_id, interval, getStart(days))
+    return data.set_index('time').close[::-1]
+
+# Applies the layout shared by the panels, the zoom of a panel is kept until its product or interval changes
+def panelLayout(fig, yaxis, height, uirevision=None):
+    fig.update_layout({'showlegend': False,
+                       'yaxis': yaxis,
+                       'xaxis_rangeslider_visible': False,
+                       'margin': {'t': 20, 'b': 20},
+                       'uirevision': uirevision,
+                       'plot_bgcolor': 'rgb(255,255,255)'}
+                      )
+    fig.update_layout(height=height, width=700)
+    return fig
+
+@app.callback(
+    Output('price-chart', 'figure'),
     [Input('dropdown-product','value'),
-     Input('dropdown-compare', 'value'),
      Input('dropdown-graph', 'value'),
+     Input('dropdown-indicator', 'value'),
      Input('input-sma', 'value'),
      Input('dropdown-interval', 'value'),
-     Input('volatility-slider','value')])
-def stackedPlots(product_id, product_list, graph, sma_window, interval=60, vol_window=5):
+     Input('dropdown-history', 'value'),
+     Input('price-chart', 'relayoutData'),
+     Input('live-interval', 'n_intervals')])
+@timed_callback
+def pricePlot(product_id, graph, indicators, sma_window, interval=60, days=0, relayout_data=None, n_intervals=None):
 
-    fig = make_subplots(rows=4, cols=1)
+    fig = go.Figure()
+    indicators = indicators or []
+    x_range = visible_range(relayout_data)
 
     # Price Data
-    data = getHistoricalData(product_id, interval)
+    data = getHistoricalData(product_id, interval, getStart(days))
     price = data[['time', 'close']]
     price = price.set_index('time')
 
     if graph == "line":
-        fig.append_trace(go.Scatter(
-            x=price.index,
-            y=price.close,
-        ), row=1, col=1)
+        line = downsample_line(price.close, x_range)
+        fig.add_trace(go.Scatter(
+            x=line.index,
+            y=line.values,
+        ))
     else:
-        fig.append_trace(go.Candlestick(x=data['time'],
-                                        open=data['open'], high=data['high'],
-                                        low=data['low'], close=data['close']),
-                         row=1, col=1)
-
-    fig.update_layout(xaxis_rangeslider_visible=False)
-
-    # Indicators
-    if sma_window:
-        mavg = price.copy()
-        mavg = mavg[::-1]
-        #mavg['ma'] = talib.MA(mavg['close'], timeperiod=sma_window)
-        mavg['ma'] = mavg['close'].rolling(sma_window).mean()
-        fig.append_trace(go.Scatter(
+        candles = downsample_candles(data, x_range)
+        fig.add_trace(go.Candlestick(x=candles['time'],
+                                     open=candles['open'], high=candles['high'],
+                                     low=candles['low'], close=candles['close']))
+
+    # Indicators, computed on the close prices oldest first
+    close = price.close[::-1]
+    window = sma_window or 20
+    if 'SMA' in indicators:
+        mavg = downsample_line(indicator_engine.compute(product_id, interval, 'SMA', close.index, close.values, window=window)['sma'], x_range)
+        fig.add_trace(go.Scatter(
             x=mavg.index,
-            y=mavg.ma,
+            y=mavg.values,
             line=dict(color='black')
-        ), row=1, col=1)
+        ))
+    if 'EMA' in indicators:
+        ema = downsample_line(indicator_engine.compute(product_id, interval, 'EMA', close.index, close.values, span=window)['ema'], x_range)
+        fig.add_trace(go.Scatter(
+            x=ema.index,
+            y=ema.values,
+            line=dict(color='blue')
+        ))
+    if 'BOLL' in indicators:
+        bands = indicator_engine.compute(product_id, interval, 'BOLL', close.index, close.values, window=window)
+        for band in ['upper', 'lower']:
+            line = downsample_line(bands[band], x_range)
+            fig.add_trace(go.Scatter(
+                x=line.index,
+                y=line.values,
+                line=dict(color='grey', dash='dot')
+            ))
+
+    return panelLayout(fig, {'title': 'Price', 'tickformat':'$'}, 300, uirevision='{} {}'.format(product_id, interval))
 
-    # Volume
-    fig.append_trace(go.Bar(
+@app.callback(
+    [Output('oscillator-chart', 'figure'),
+     Output('oscillator-chart', 'style')],
+    [Input('dropdown-product','value'),
+     Input('dropdown-indicator', 'value'),
+     Input('input-sma', 'value'),
+     Input('dropdown-interval', 'value'),
+     Input('dropdown-history', 'value'),
+     Input('oscillator-chart', 'relayoutData'),
+     Input('live-interval', 'n_intervals')])
+@timed_callback
+def oscillatorPlot(product_id, indicators, sma_window, interval=60, days=0, relayout_data=None, n_intervals=None):
+
+    fig = go.Figure()
+    x_range = visible_range(relayout_data)
+    oscillators = [i for i in (indicators or []) if i in ('RSI', 'MACD')]
+    if not oscillators:
+        return fig, {'display': 'none'}
+
+    close = getClose(product_id, interval, days)
+    if 'RSI' in oscillators:
+        rsi = downsample_line(indicator_engine.compute(product_id, interval, 'RSI', close.index, close.values, period=sma_window or 20)['rsi'], x_range)
+        fig.add_trace(go.Scatter(
+            x=rsi.index,
+            y=rsi.values,
+            line=dict(color='purple')
+        ))
+    if 'MACD' in oscillators:
+        macd = indicator_engine.compute(product_id, interval, 'MACD', close.index, close.values)
+        hist = downsample_line(macd['hist'], x_range)
+        fig.add_trace(go.Bar(
+            x=hist.index,
+            y=hist.values
+        ))
+        for column, color in [('macd', 'black'), ('signal', 'orange')]:
+            line = downsample_line(macd[column], x_range)
+            fig.add_trace(go.Scatter(
+                x=line.index,
+                y=line.values,
+                line=dict(color=color)
+            ))
+
+    return panelLayout(fig, {'title': ' / '.join(oscillators)}, 200, uirevision='{} {}'.format(product_id, interval)), {'display': 'block'}
+
+@app.callback(
+    Output('volume-chart', 'figure'),
+    [Input('dropdown-product','value'),
+     Input('dropdown-interval', 'value'),
+     Input('dropdown-history', 'value'),
+     Input('volume-chart', 'relayoutData'),
+     Input('live-interval', 'n_intervals')])
+@timed_callback
+def volumePlot(product_id, interval=60, days=0, relayout_data=None, n_intervals=None):
+
+    # Bars of merged candles hold the total volume of the candles
+    data = downsample_candles(getHistoricalData(product_id, interval, getStart(days)), visible_range(relayout_data))
+    fig = go.Figure(go.Bar(
         x=data.time,
         y=data.volume,
-    ), row=2, col=1)
-
-    # Cummulative Returns
-    for p in product_list:
-        data_ = getHistoricalData(p, interval=interval)
-        price_ = data_[['time', 'close']]
-        price_ = price_.set_index('time')
-        col = price_[::-1]
-        col.columns = [p]
-        returns = col.pct_change()
-        cumreturns = (1.0 + returns).cumprod()-1.0
-        # df = pd.concat([df, cumreturns], axis=1)
-        fig.add_trace(go.Scatter(x=cumreturns.index, y=cumreturns[p], mode='lines', name=p,
-                                 hovertemplate = "return: %{y:.2%}<br>"),row=3, col=1)
-
-    # Volatility (not annualized)
-    returns = price.pct_change()
-    logreturns = np.log(price/price.shift(1))
-    ann_vol = {60: 1440, 300: 288, 900: 96, 3600: 24, 21600: 4, 86400: 1}
-    vol = logreturns[::-1].rolling(vol_window).std() # * np.sqrt(252*ann_vol[interval])
-
-    fig.append_trace(go.Scatter(
-        x=vol.index,
-        y=vol.close
-    ), row=4, col=1)
+    ))
 
-    fig.update_layout({'showlegend': False,
-                       'yaxis': {'title': 'Price', 'tickformat':'$'},
-                       'yaxis2': {'title':'Volume'},
-                       'yaxis3': {'title': 'Cummulative Returns', 'tickformat':'.0%'},
-                       'yaxis4': {'title': 'Rolling Volatility'},
-                       'plot_bgcolor': 'rgb(255,255,255)'}
-                      )
-    fig.update_layout(height=800, width=700)
+    return panelLayout(fig, {'title':'Volume'}, 150, uirevision='{} {}'.format(product_id, interval))
 
-    return fig
+@app.callback(
+    Output('returns-chart', 'figure'),
+    [Input('dropdown-compare', 'value'),
+     Input('dropdown-interval', 'value'),
+     Input('dropdown-history', 'value'),
+     Input('returns-chart', 'relayoutData'),
+     Input('live-interval', 'n_intervals')])
+@timed_callback
+def returnsPlot(product_list, interval=60, days=0, relayout_data=None, n_intervals=None):
+
+    fig = go.Figure()
+    x_range = visible_range(relayout_data)
+
+    # Cummulative Returns of all the products at once
+    cumreturns = cumulative_returns(getCloseMatrix(product_list or [], interval, getStart(days)))
+    for p in cumreturns.columns:
+        line = downsample_line(cumreturns[p], x_range)
+        fig.add_trace(go.Scatter(x=line.index, y=line.values, mode='lines', name=p,
+                                 hovertemplate = "return: %{y:.2%}<br>"))
+
+    return panelLayout(fig, {'title': 'Cummulative Returns', 'tickformat':'.0%'}, 200, uirevision=interval)
+
+@app.callback(
+    [Output('correlation-chart', 'figure'),
+     Output('correlation-chart', 'style')],
+    [Input('dropdown-compare', 'value'),
+     Input('dropdown-interval', 'value'),
+     Input('dropdown-history', 'value')])
+@timed_callback
+def correlationPlot(product_list, interval=60, days=0):
+
+    if not product_list or len(product_list) < 2:
+        return go.Figure(), {'display': 'none'}
+
+    # Correlations and betas of the returns of every pair of products, the beta being that of the row product
+    returns = return_matrix(getCloseMatrix(product_list, interval, getStart(days)))
+    corr = correlation_matrix(returns)
+    beta = beta_matrix(returns)
+
+    fig = go.Figure(go.Heatmap(
+        z=corr.values,
+        x=list(corr.columns),
+        y=list(corr.index),
+        customdata=beta.values,
+        zmin=-1,
+        zmax=1,
+        colorscale='RdBu',
+        hovertemplate="%{y} / %{x}<br>correlation: %{z:.2f}<br>beta: %{customdata:.2f}<extra></extra>"
+    ))
+
+    return panelLayout(fig, {'title': 'Correlation'}, 300), {'display': 'block'}
+
+@app.callback(
+    Output('volatility-chart', 'figure'),
+    [Input('dropdown-product','value'),
+     Input('dropdown-interval', 'value'),
+     Input('volatility-slider','value'),
+     Input('dropdown-history', 'value'),
+     Input('volatility-chart', 'relayoutData'),
+     Input('live-interval', 'n_intervals')])
+@timed_callback
+def volatilityPlot(product_id, interval=60, vol_window=5, days=0, relayout_data=None, n_intervals=None):
+
+    # Volatility (not annualized), the candles come from the candle cache and the indicator state per window from
+    # the indicator engine, so a slider change does not request any price
+    close = getClose(product_id, interval, days)
+    vol = indicator_engine.compute(product_id, interval, 'VOL', close.index, close.values, window=vol_window)
+
+    vol = downsample_line(vol['vol'], visible_range(relayout_data))
+
+    fig = go.Figure(go.Scatter(
+        x=vol.index,
+        y=vol.values
+    ))
+
+    return panelLayout(fig, {'title': 'Rolling Volatility'}, 150, uirevision='{} {}'.format(product_id, interval))
 
 @app.callback(
     Output('vol-slider-output-container', 'children'),
     [Input('volatility-slider', 'value')])
+@timed_callback
 def update_volatility(value):
     return 'Volatility window size: {}'.format(value)
 
@@ -302,6 +513,7 @@ def update_volatility(value):
 @app.callback(
     Output('indicator-output-container', component_property='style'),
     [Input('dropdown-indicator', 'value')])
+@timed_callback
 def show_indicators(dropdown_value):
 
     if dropdown_value:
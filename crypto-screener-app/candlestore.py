@@ -0,0 +1,237 @@
+# On-disk OHLCV candle store for the cryptocurrency screener
+#
+# Candles are kept as one NumPy .npy file per product, granularity and UTC day, i.e. candle-store/BTC-USD/3600/2021-01-15.npy.
+# Files are replaced atomically when written and read through memory maps, so several worker processes can share
+# the store and the pages of the files they read.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+import numpy as np
+from fileutils import LeaderLock, atomic_write, fcntl
+
+CANDLE_DTYPE = np.dtype([('time', '<i8'), ('low', '<f8'), ('high', '<f8'), ('open', '<f8'), ('close', '<f8'), ('volume', '<f8')])
+
+DAY = 86400
+
+
+# Returns a structured array of candles sorted by time from rows in the API format
+def to_records(candles):
+    rows = np.asarray(candles, dtype=np.float64).reshape(-1, len(CANDLE_DTYPE.names))
+    records = np.empty(len(rows), dtype=CANDLE_DTYPE)
+    for i, name in enumerate(CANDLE_DTYPE.names):
+        records[name] = rows[:, i]
+    return records[np.argsort(records['time'], kind='stable')]
+
+
+# Returns rows in the API format, newest first, from a structured array of candles sorted by time
+def to_rows(records):
+    return np.column_stack([records[name].astype(np.float64) for name in CANDLE_DTYPE.names])[::-1]
+
+
+# Returns the number of days since the epoch of a YYYY-MM-DD date
+def _day_number(date):
+    return (datetime.strptime(date, '%Y-%m-%d') - datetime(1970, 1, 1)).days
+
+
+class CandleStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, product_id, granularity):
+        return os.path.join(self.root, product_id, str(granularity))
+
+    def _path(self, product_id, granularity, day):
+        return os.path.join(self._dir(product_id, granularity), datetime.utcfromtimestamp(day * DAY).strftime('%Y-%m-%d') + '.npy')
+
+    def _load(self, path):
+        try:
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            return np.empty(0, dtype=CANDLE_DTYPE)
+        except ValueError:
+            # Empty arrays cannot be memory mapped
+            return np.load(path)
+
+    # Returns the days (as days since the epoch) stored for a product and granularity, oldest first
+    def days(self, product_id, granularity):
+        try:
+            names = os.listdir(self._dir(product_id, granularity))
+        except FileNotFoundError:
+            return []
+        return sorted(_day_number(name[:-4]) for name in names if name.endswith('.npy'))
+
+    # Merges candles in the API format into the store, newer values replacing stored candles with the same time
+    def write(self, product_id, granularity, candles):
+        records = to_records(candles)
+        if not len(records):
+            return
+        os.makedirs(self._dir(product_id, granularity), exist_ok=True)
+        days = records['time'] // DAY
+        for day in np.unique(days):
+            part = records[days == day]
+            path = self._path(product_id, granularity, day)
+            existing = self._load(path)
+            merged = np.concatenate([existing[~np.isin(existing['time'], part['time'])], part])
+            merged = merged[np.argsort(merged['time'], kind='stable')]
+            with atomic_write(path, 'wb') as f:
+                np.save(f, merged)
+
+    # Returns the stored candles between two unix times (inclusive) as rows in the API format, newest first
+    def read(self, product_id, granularity, start=None, end=None):
+        parts = []
+        for day in self.days(product_id, granularity):
+            if (start is not None and (day + 1) * DAY <= start) or (end is not None and day * DAY > end):
+                continue
+            records = self._load(self._path(product_id, granularity, day))
+            mask = np.ones(len(records), dtype=bool)
+            if start is not None:
+                mask &= records['time'] >= start
+            if end is not None:
+                mask &= records['time'] <= end
+            parts.append(records[mask])
+        if not parts:
+            return np.empty((0, len(CANDLE_DTYPE.names)))
+        return to_rows(np.concatenate(parts))
+
+    # Returns the latest n stored candles as rows in the API format, newest first
+    def latest(self, product_id, granularity, n):
+        parts, count = [], 0
+        for day in reversed(self.days(product_id, granularity)):
+            records = self._load(self._path(product_id, granularity, day))
+            parts.insert(0, records)
+            count += len(records)
+            if count >= n:
+                break
+        if not parts:
+            return np.empty((0, len(CANDLE_DTYPE.names)))
+        return to_rows(np.concatenate(parts)[-n:])
+
+    # Returns the time of the oldest stored candle, or None
+    def oldest_time(self, product_id, granularity):
+        for day in self.days(product_id, granularity):
+            records = self._load(self._path(product_id, granularity, day))
+            if len(records):
+                return int(records['time'][0])
+        return None
+
+
+# Background job filling the store with history, walking back one request window at a time from the oldest stored
+# candle until `depth` seconds of history are stored for every product and granularity. The candles are persisted by
+# market_data.fetch_range, so market_data must write to the same store. With a lock path only the process holding the
+# lock file backfills, as for the screener refresh.
+class Backfiller(threading.Thread):
+    def __init__(self, market_data, store, product_ids, granularities, depth, window=300, lock_path=None):
+        super().__init__(daemon=True)
+        self.market_data = market_data
+        self.store = store
+        self.product_ids = list(product_ids)
+        self.granularities = list(granularities)
+        self.depth = depth
+        self.window = window
+        self._leader = LeaderLock(lock_path)
+
+    # Returns whether this process is the one backfilling the shared store
+    def _is_leader(self):
+        return self._leader.acquire()
+
+    def backfill(self, product_id, granularity):
+        target = time.time() - self.depth
+        oldest = self.store.oldest_time(product_id, granularity) or int(time.time())
+        while oldest > target:
+            candles = self.market_data.fetch_range(product_id, granularity, oldest - self.window * granularity, oldest - granularity)
+            if not isinstance(candles, list) or not candles:
+                # Error, or no older history upstream
+                break
+            oldest = min(c[0] for c in candles)
+
+    def run(self):
+        if not self._is_leader():
+            return
+        for granularity in self.granularities:
+            for product_id in self.product_ids:
+                try:
+                    self.backfill(product_id, granularity)
+                except Exception as e:
+                    print('Backfill of {} {} failed: {}'.format(product_id, granularity, e))
+
+
+def _candles(times):
+    return [[t, 1.0, 2.0, 1.5, float(t), 10.0] for t in times]
+
+
+class TestCandleStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = CandleStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_write_and_read(self):
+        # Two days of hourly candles, written newest first as the API returns them
+        self.store.write('BTC-USD', 3600, _candles(range(0, 2 * DAY, 3600))[::-1])
+        self.assertEqual(self.store.days('BTC-USD', 3600), [0, 1])
+        rows = self.store.read('BTC-USD', 3600)
+        self.assertEqual(rows[:, 0].tolist(), list(range(2 * DAY - 3600, -1, -3600)))
+        self.assertEqual(self.store.read('BTC-USD', 3600, DAY - 3600, DAY)[:, 0].tolist(), [DAY, DAY - 3600])
+        self.assertEqual(self.store.read('ETH-USD', 3600).shape, (0, 6))
+
+    def test_write_replaces_candles(self):
+        self.store.write('BTC-USD', 60, _candles([0, 60, 120]))
+        self.store.write('BTC-USD', 60, [[120, 1.0, 3.0, 1.5, 2.5, 20.0], [180, 1.0, 2.0, 1.5, 2.0, 5.0]])
+        self.assertEqual(self.store.read('BTC-USD', 60).tolist(),
+                         [[180, 1.0, 2.0, 1.5, 2.0, 5.0], [120, 1.0, 3.0, 1.5, 2.5, 20.0]] + _candles([60, 0]))
+
+    def test_latest(self):
+        self.store.write('BTC-USD', 3600, _candles(range(0, 3 * DAY, 3600)))
+        self.assertEqual(self.store.latest('BTC-USD', 3600, 30)[:, 0].tolist(), list(range(3 * DAY - 3600, 3 * DAY - 31 * 3600, -3600)))
+        self.assertEqual(len(self.store.latest('BTC-USD', 3600, 1000)), 72)
+        self.assertEqual(self.store.oldest_time('BTC-USD', 3600), 0)
+        self.assertEqual(self.store.latest('ETH-USD', 3600, 10).shape, (0, 6))
+
+
+class StubMarketData:
+    # Returns daily candles for any range and persists them like MarketData.fetch_range, counting the requests
+    def __init__(self, store):
+        self.store = store
+        self.requests = []
+
+    def fetch_range(self, product_id, granularity, start, end):
+        self.requests.append((product_id, start, end))
+        candles = _candles(range(end // granularity * granularity, start - 1, -granularity))
+        self.store.write(product_id, granularity, candles)
+        return candles
+
+
+class TestBackfiller(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = CandleStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_backfill(self):
+        market_data = StubMarketData(self.store)
+        Backfiller(market_data, self.store, ['BTC-USD'], [DAY], 10 * DAY, window=4).backfill('BTC-USD', DAY)
+        self.assertEqual(len(market_data.requests), 3)
+        self.assertLessEqual(self.store.oldest_time('BTC-USD', DAY), time.time() - 10 * DAY)
+
+    @unittest.skipIf(fcntl is None, 'no file locks')
+    def test_single_leader(self):
+        lock_path = os.path.join(self.root, 'backfill.lock')
+        leader = Backfiller(StubMarketData(self.store), self.store, ['BTC-USD'], [DAY], DAY, lock_path=lock_path)
+        follower = Backfiller(StubMarketData(self.store), self.store, ['BTC-USD'], [DAY], DAY, lock_path=lock_path)
+        self.assertTrue(leader._is_leader())
+        follower.run()
+        self.assertEqual(follower.market_data.requests, [])
+        leader._leader.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
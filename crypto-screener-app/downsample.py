@@ -0,0 +1,187 @@
+# Server-side downsampling of the chart traces of the cryptocurrency screener
+#
+# Long candle series are reduced before being sent to the browser: candles are merged into coarser candles (keeping
+# the highs and lows, so spikes stay visible) and lines are decimated with Largest-Triangle-Three-Buckets. Only the
+# visible part of a series is reduced, so zooming in brings back the detail of the zoomed range.
+
+import unittest
+import numpy as np
+import pandas as pd
+
+# Most points sent for one line trace, and most candles or bars for one candlestick or bar trace
+MAX_POINTS = 1000
+MAX_CANDLES = 500
+
+
+# Returns the (start, end) timestamps of the x axis range of a graph from its relayoutData, or None when the whole
+# series is shown
+def visible_range(relayout_data, axis='xaxis'):
+    if not relayout_data or relayout_data.get(axis + '.autorange'):
+        return None
+    if axis + '.range[0]' in relayout_data:
+        bounds = relayout_data[axis + '.range[0]'], relayout_data.get(axis + '.range[1]')
+    elif axis + '.range' in relayout_data:
+        bounds = relayout_data[axis + '.range']
+    else:
+        return None
+    try:
+        return pd.Timestamp(bounds[0]), pd.Timestamp(bounds[1])
+    except (TypeError, ValueError):
+        return None
+
+
+# Returns the rows of a dataframe (or the items of a series) whose time lies in the visible range, along with one row
+# on each side so that lines run to the edges of the graph
+def clip(data, x_range, column=None):
+    if x_range is None or not len(data):
+        return data
+    times = pd.DatetimeIndex(data.index if column is None else data[column])
+    inside = np.flatnonzero((times >= x_range[0]) & (times <= x_range[1]))
+    if not len(inside):
+        return data.iloc[:0]
+    return data.iloc[max(inside[0] - 1, 0):inside[-1] + 2]
+
+
+# Returns the indices of the n points of (x, y) kept by Largest-Triangle-Three-Buckets: the first and last points, and
+# in each of n - 2 buckets the point forming the largest triangle with the previously kept point and the average of
+# the next bucket
+def lttb(x, y, n):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    length = len(x)
+    if n >= length or n < 3:
+        return np.arange(length)
+    edges = (np.arange(n - 1) * ((length - 2) / (n - 2))).astype(np.int64) + 1
+    edges[-1] = length - 1
+    indices = np.empty(n, dtype=np.int64)
+    indices[0], indices[-1] = 0, length - 1
+    a = 0
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else length
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+# Returns a series indexed by time reduced to at most n points of its visible range, missing values being dropped
+def downsample_line(series, x_range=None, n=MAX_POINTS):
+    series = clip(series.dropna(), x_range)
+    return series.iloc[lttb(pd.DatetimeIndex(series.index).asi8, series.values, n)]
+
+
+# Returns a dataframe of candles (time, low, high, open, close, volume) reduced to at most n candles of its visible
+# range, oldest first. Consecutive candles are merged into one spanning them, with the total volume.
+def downsample_candles(data, x_range=None, n=MAX_CANDLES):
+    data = clip(data.sort_values('time'), x_range, 'time')
+    if len(data) <= n:
+        return data
+    starts = np.arange(0, len(data), -(-len(data) // n))
+    ends = np.append(starts[1:], len(data)) - 1
+    return pd.DataFrame({
+        'time': data['time'].values[starts],
+        'low': np.minimum.reduceat(data['low'].values, starts),
+        'high': np.maximum.reduceat(data['high'].values, starts),
+        'open': data['open'].values[starts],
+        'close': data['close'].values[ends],
+        'volume': np.add.reduceat(data['volume'].values, starts)
+    }, columns=data.columns)
+
+
+def _candles(n=1000, seed=0):
+    # Random candles, one a minute, in the column order of the candles returned by Coinbase Pro
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+    open_ = np.append(100.0, close[:-1])
+    return pd.DataFrame({
+        'time': pd.date_range('2021-01-01', periods=n, freq='min'),
+        'low': np.minimum(open_, close) * (1 - rng.uniform(0, 0.01, n)),
+        'high': np.maximum(open_, close) * (1 + rng.uniform(0, 0.01, n)),
+        'open': open_,
+        'close': close,
+        'volume': rng.uniform(0, 10, n)
+    })
+
+
+class TestDownsample(unittest.TestCase):
+    def test_visible_range(self):
+        start, end = pd.Timestamp('2021-01-01 10:00'), pd.Timestamp('2021-01-02 12:30')
+        # A zoom reports the bounds as separate keys, a relayout of the whole range as one list
+        self.assertEqual(visible_range({'xaxis.range[0]': '2021-01-01 10:00', 'xaxis.range[1]': '2021-01-02 12:30'}), (start, end))
+        self.assertEqual(visible_range({'xaxis.range': ['2021-01-01 10:00', '2021-01-02 12:30']}), (start, end))
+        self.assertEqual(visible_range({'xaxis2.range[0]': '2021-01-01 10:00', 'xaxis2.range[1]': '2021-01-02 12:30'}, 'xaxis2'), (start, end))
+        for relayout_data in (None, {}, {'xaxis.autorange': True}, {'autosize': True}, {'xaxis.range[0]': 'soon'},
+                              {'xaxis2.range': ['2021-01-01', '2021-01-02']}):
+            with self.subTest(relayout_data=relayout_data):
+                self.assertIsNone(visible_range(relayout_data))
+
+    def test_lttb(self):
+        rng = np.random.default_rng(0)
+        x = np.arange(1000, dtype=np.float64)
+        y = rng.normal(0, 1, 1000)
+        y[567] = 50.0
+        indices = lttb(x, y, 100)
+        self.assertEqual(len(indices), 100)
+        self.assertEqual((indices[0], indices[-1]), (0, 999))
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        self.assertIn(567, indices)
+        # Each bucket keeps its point of largest triangle with the previous kept point and the next bucket's average
+        every = 998 / 98
+        edges = [int(i * every) + 1 for i in range(98)] + [999, 1000]
+        for i in range(98):
+            a, bucket, following = indices[i], range(edges[i], edges[i + 1]), slice(edges[i + 1], edges[i + 2])
+            avg_x, avg_y = x[following].mean(), y[following].mean()
+            areas = [abs((x[a] - avg_x) * (y[j] - y[a]) - (x[a] - x[j]) * (avg_y - y[a])) for j in bucket]
+            self.assertEqual(indices[i + 1], bucket[int(np.argmax(areas))])
+
+    def test_lttb_short_series(self):
+        for length, n in ((10, 10), (10, 20), (10, 2), (0, 5)):
+            with self.subTest(length=length, n=n):
+                np.testing.assert_array_equal(lttb(np.arange(length), np.arange(length), n), np.arange(length))
+
+    def test_downsample_candles(self):
+        data = _candles(1000)
+        # Buckets of ceil(1000 / n) consecutive candles, the last one holding the remaining candles
+        for n, size in ((300, 4), (333, 4), (500, 2), (999, 2), (7, 143)):
+            with self.subTest(n=n):
+                result = downsample_candles(data.sample(frac=1, random_state=0), n=n)
+                groups = data.groupby(np.arange(len(data)) // size)
+                expected = pd.DataFrame({
+                    'time': groups['time'].first(),
+                    'low': groups['low'].min(),
+                    'high': groups['high'].max(),
+                    'open': groups['open'].first(),
+                    'close': groups['close'].last(),
+                    'volume': groups['volume'].sum()
+                }).reset_index(drop=True)
+                self.assertLessEqual(len(result), n)
+                self.assertEqual(list(result.columns), list(data.columns))
+                pd.testing.assert_frame_equal(result.reset_index(drop=True), expected)
+                self.assertAlmostEqual(result['volume'].sum(), data['volume'].sum())
+
+    def test_downsample_candles_short_series(self):
+        data = _candles(100)
+        for n in (100, 500):
+            with self.subTest(n=n):
+                pd.testing.assert_frame_equal(downsample_candles(data.iloc[::-1], n=n), data)
+
+    def test_downsample_candles_visible_range(self):
+        data = _candles(1000)
+        x_range = (pd.Timestamp('2021-01-01 02:00:30'), pd.Timestamp('2021-01-01 05:00'))
+        # The candles of the range and one on each side, few enough to be kept
+        pd.testing.assert_frame_equal(downsample_candles(data, x_range), data.iloc[120:302])
+        self.assertTrue(downsample_candles(data, (pd.Timestamp('2022-01-01'), pd.Timestamp('2022-01-02'))).empty)
+
+    def test_downsample_line(self):
+        series = _candles(5000).set_index('time')['close']
+        series.iloc[::7] = np.nan
+        result = downsample_line(series, n=500)
+        self.assertEqual(len(result), 500)
+        self.assertFalse(result.isna().any())
+        self.assertEqual((result.index[0], result.index[-1]), (series.index[1], series.index[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+'''
+Fake Coinbase Pro public client
+
+Replays recorded products, currencies and candles so that the app can run without access to Coinbase Pro, i.e.
+
+    python fakeclient.py record --products BTC-USD,ETH-USD fixtures    # record from the live API
+    python fakeclient.py generate --products 50 fixtures               # or generate random walks
+    CBPRO_FIXTURES=fixtures python app.py
+
+Recorded candles are replayed as if they were the latest ones: the candle of a requested time is taken from the
+recording cyclically, so any range of times can be requested.
+'''
+
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime
+import numpy as np
+
+GRANULARITIES = [60, 300, 900, 3600, 21600, 86400]
+
+# Most candles returned by one historic rates request, as for the API
+MAX_CANDLES = 300
+
+
+def _candles_path(root, product_id, granularity):
+    return os.path.join(root, 'candles', product_id, '{}.json'.format(granularity))
+
+
+def _to_unix(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return int((datetime.fromisoformat(value.rstrip('Z')) - datetime(1970, 1, 1)).total_seconds())
+
+
+class FakePublicClient:
+    def __init__(self, root, latency=0.0, clock=time.time):
+        self.root = root
+        # Seconds slept by every call, to mimic the round trip to the API
+        self.latency = latency
+        self.clock = clock
+        with open(os.path.join(root, 'products.json')) as f:
+            self._products = json.load(f)
+        with open(os.path.join(root, 'currencies.json')) as f:
+            self._currencies = json.load(f)
+        self._candles = {}
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_products(self):
+        self._wait()
+        return self._products
+
+    def get_currencies(self):
+        self._wait()
+        return self._currencies
+
+    # Returns the recorded candles of a product as an array oldest first, None when there is no recording
+    def _recording(self, product_id, granularity):
+        key = (product_id, granularity)
+        if key not in self._candles:
+            try:
+                with open(_candles_path(self.root, product_id, granularity)) as f:
+                    candles = np.array(json.load(f), dtype=np.float64).reshape(-1, 6)
+                self._candles[key] = candles[np.argsort(candles[:, 0])]
+            except FileNotFoundError:
+                self._candles[key] = None
+        return self._candles[key]
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        self._wait()
+        granularity = granularity or 60
+        recording = self._recording(product_id, granularity)
+        if recording is None or not len(recording):
+            return {'message': 'NotFound'}
+        end = _to_unix(end)
+        end = int(self.clock() if end is None else end) // granularity * granularity
+        start = _to_unix(start)
+        start = end - (MAX_CANDLES - 1) * granularity if start is None else -(-int(start) // granularity) * granularity
+        if (end - start) // granularity + 1 > MAX_CANDLES:
+            return {'message': 'granularity too small for the requested time range'}
+        times = np.arange(end, start - 1, -granularity, dtype=np.int64)
+        rows = recording[(times // granularity) % len(recording)]
+        return [[int(t)] + row[1:].tolist() for t, row in zip(times, rows)]
+
+
+# Records the products, currencies and latest candles of some products from a client into a fixtures directory
+def record(client, root, product_ids, granularities=GRANULARITIES):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'products.json'), 'w') as f:
+        json.dump(client.get_products(), f)
+    with open(os.path.join(root, 'currencies.json'), 'w') as f:
+        json.dump(client.get_currencies(), f)
+    for product_id in product_ids:
+        for granularity in granularities:
+            candles = client.get_product_historic_rates(product_id, granularity=granularity)
+            if isinstance(candles, list):
+                os.makedirs(os.path.dirname(_candles_path(root, product_id, granularity)), exist_ok=True)
+                with open(_candles_path(root, product_id, granularity), 'w') as f:
+                    json.dump(candles, f)
+            time.sleep(0.15)
+
+
+# Writes fixtures of n products whose candles are random walks
+def generate(root, n_products, granularities=GRANULARITIES, seed=0):
+    rng = random.Random(seed)
+    currencies = [{'id': 'USD', 'name': 'United States Dollar'}]
+    products = []
+    for i in range(n_products):
+        base = 'C{}'.format(i)
+        currencies.append({'id': base, 'name': 'Coin {}'.format(i)})
+        products.append({'id': base + '-USD', 'base_currency': base, 'quote_currency': 'USD', 'status': 'online'})
+        price = 10 ** rng.uniform(-1, 4)
+        for granularity in granularities:
+            candles, close = [], price
+            volatility = 0.002 * (granularity / 60) ** 0.5
+            for t in range(MAX_CANDLES):
+                open_ = close
+                close = open_ * (1 + rng.gauss(0, volatility))
+                high = max(open_, close) * (1 + abs(rng.gauss(0, volatility / 2)))
+                low = min(open_, close) * (1 - abs(rng.gauss(0, volatility / 2)))
+                candles.append([t * granularity, low, high, open_, close, rng.uniform(1, 100) * granularity])
+            os.makedirs(os.path.dirname(_candles_path(root, base + '-USD', granularity)), exist_ok=True)
+            with open(_candles_path(root, base + '-USD', granularity), 'w') as f:
+                json.dump(candles[::-1], f)
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, 'products.json'), 'w') as f:
+        json.dump(products, f)
+    with open(os.path.join(root, 'currencies.json'), 'w') as f:
+        json.dump(currencies, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record or generate fixtures for the fake Coinbase Pro client')
+    parser.add_argument('command', choices=['record', 'generate'])
+    parser.add_argument('root', help='fixtures directory')
+    parser.add_argument('--products', default='BTC-USD,ETH-USD',
+                        help='comma separated product ids to record, or number of products to generate')
+    parser.add_argument('--api-url', default='https://api.pro.coinbase.com')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        import cbpro
+        record(cbpro.PublicClient(api_url=args.api_url), args.root, args.products.split(','))
+    else:
+        generate(args.root, int(args.products) if args.products.isdigit() else 50)
+
+
+if __name__ == '__main__':
+    main()
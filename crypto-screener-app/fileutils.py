@@ -0,0 +1,98 @@
+# File helpers shared by the stores of the cryptocurrency screener
+#
+# Files read by several worker processes are written to a temporary file next to them and renamed over them, so a
+# reader sees either the previous or the new content, never a partial write. Background jobs that only one worker
+# should run (screener refresh, backfill) elect that worker with a lock file.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Opens a temporary file next to path for writing, and replaces path with it once the block completes. The temporary
+# file is removed when the block raises, leaving path untouched.
+@contextmanager
+def atomic_write(path, mode='w'):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# Exclusive lock on a file held for the life of the process, taken by the first process asking for it. Without a path
+# or file locks (i.e. on Windows) every process holds it.
+class LeaderLock:
+    def __init__(self, path=None):
+        self.path = path
+        self._file = None
+
+    # Returns whether this process holds the lock, taking it when it is free
+    def acquire(self):
+        if self._file is not None or self.path is None or fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TestFileUtils(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_atomic_write(self):
+        path = os.path.join(self.root, 'data', 'products.json')
+        with atomic_write(path) as f:
+            f.write('first')
+        with self.assertRaises(ValueError):
+            with atomic_write(path) as f:
+                f.write('partial')
+                raise ValueError('failed while writing')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'first')
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['products.json'])
+
+    @unittest.skipIf(fcntl is None, 'no file locks')
+    def test_single_leader(self):
+        path = os.path.join(self.root, 'refresh.lock')
+        leader, follower = LeaderLock(path), LeaderLock(path)
+        self.assertTrue(leader.acquire())
+        self.assertTrue(leader.acquire())
+        self.assertFalse(follower.acquire())
+        leader.release()
+        self.assertTrue(follower.acquire())
+        follower.release()
+        self.assertTrue(LeaderLock().acquire())
+
+
+if __name__ == '__main__':
+    unittest.main()
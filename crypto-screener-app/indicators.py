@@ -0,0 +1,353 @@
+# Streaming technical indicators for the cryptocurrency screener
+#
+# Every indicator consumes one value per candle in O(1): push() adds the value of a new candle and amend() replaces
+# the value of the latest candle, which keeps changing until the candle closes. The IndicatorEngine keeps the state
+# and outputs of each indicator per (product, interval, indicator, parameters), so that a redraw only feeds the
+# candles added since the previous one instead of recomputing the whole history.
+
+import math
+import threading
+import unittest
+from collections import OrderedDict, deque
+import numpy as np
+import pandas as pd
+
+NAN = float('nan')
+
+
+# Simple moving average
+class SMA:
+    outputs = ('sma',)
+
+    def __init__(self, window):
+        self.window = window
+        self._values = deque()
+        self._sum = 0.0
+
+    def push(self, x):
+        self._values.append(x)
+        self._sum += x
+        if len(self._values) > self.window:
+            self._sum -= self._values.popleft()
+        return self.value()
+
+    def amend(self, x):
+        self._sum += x - self._values[-1]
+        self._values[-1] = x
+        return self.value()
+
+    def value(self):
+        return (self._sum / self.window,) if len(self._values) == self.window else (NAN,)
+
+
+# Exponential moving average, the recursive form of pandas' ewm(span, adjust=False)
+class EMA:
+    outputs = ('ema',)
+
+    def __init__(self, span):
+        self.alpha = 2 / (span + 1)
+        self._ema = None
+        self._before = None
+
+    def push(self, x):
+        self._before = self._ema
+        return self.amend(x)
+
+    def amend(self, x):
+        self._ema = x if self._before is None else self._before + self.alpha * (x - self._before)
+        return (self._ema,)
+
+
+# Sample standard deviation over a sliding window, kept with Welford's updates for adding and removing values
+class RollingStd:
+    outputs = ('mean', 'std')
+
+    def __init__(self, window):
+        self.window = window
+        self._values = deque()
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    # Replaces the value `old` of the window by `x`
+    def _replace(self, old, x):
+        mean = self._mean + (x - old) / len(self._values)
+        self._m2 = max(self._m2 + (x - old) * (x - mean + old - self._mean), 0.0)
+        self._mean = mean
+
+    def push(self, x):
+        if len(self._values) < self.window:
+            self._values.append(x)
+            delta = x - self._mean
+            self._mean += delta / len(self._values)
+            self._m2 += delta * (x - self._mean)
+        else:
+            old = self._values.popleft()
+            self._values.append(x)
+            self._replace(old, x)
+        return self.value()
+
+    def amend(self, x):
+        old = self._values[-1]
+        self._values[-1] = x
+        self._replace(old, x)
+        return self.value()
+
+    def value(self):
+        if len(self._values) < self.window or self.window < 2:
+            return (NAN, NAN)
+        return (self._mean, math.sqrt(self._m2 / (self.window - 1)))
+
+
+# Bollinger bands, `k` standard deviations around the moving average
+class Bollinger:
+    outputs = ('mid', 'upper', 'lower')
+
+    def __init__(self, window, k=2):
+        self.k = k
+        self._std = RollingStd(window)
+
+    def _bands(self, value):
+        mean, std = value
+        return (mean, mean + self.k * std, mean - self.k * std)
+
+    def push(self, x):
+        return self._bands(self._std.push(x))
+
+    def amend(self, x):
+        return self._bands(self._std.amend(x))
+
+
+# Moving average convergence divergence
+class MACD:
+    outputs = ('macd', 'signal', 'hist')
+
+    def __init__(self, fast=12, slow=26, signal=9):
+        self._fast = EMA(fast)
+        self._slow = EMA(slow)
+        self._signal = EMA(signal)
+
+    def _lines(self, fast, slow, update):
+        macd = fast[0] - slow[0]
+        signal = update(macd)[0]
+        return (macd, signal, macd - signal)
+
+    def push(self, x):
+        return self._lines(self._fast.push(x), self._slow.push(x), self._signal.push)
+
+    def amend(self, x):
+        return self._lines(self._fast.amend(x), self._slow.amend(x), self._signal.amend)
+
+
+# Relative strength index with Wilder's smoothing of the average gains and losses
+class RSI:
+    outputs = ('rsi',)
+
+    def __init__(self, period=14):
+        self.period = period
+        # previous close, average gain, average loss, number of changes
+        self._state = (None, 0.0, 0.0, 0)
+        self._before = self._state
+
+    def push(self, x):
+        self._before = self._state
+        return self.amend(x)
+
+    def amend(self, x):
+        last, gain, loss, n = self._before
+        if last is None:
+            self._state = (x, gain, loss, n)
+            return (NAN,)
+        change = x - last
+        n += 1
+        weight = 1 / min(n, self.period)
+        gain += (max(change, 0.0) - gain) * weight
+        loss += (max(-change, 0.0) - loss) * weight
+        self._state = (x, gain, loss, n)
+        if n < self.period:
+            return (NAN,)
+        return (100.0 if loss == 0 else 100 - 100 / (1 + gain / loss),)
+
+
+# Rolling standard deviation of the log returns (not annualized)
+class Volatility:
+    outputs = ('vol',)
+
+    def __init__(self, window):
+        self._std = RollingStd(window)
+        self._previous = None
+        self._last = None
+
+    def push(self, x):
+        self._previous, self._last = self._last, x
+        if self._previous is None:
+            return (NAN,)
+        return (self._std.push(math.log(x / self._previous))[1],)
+
+    def amend(self, x):
+        self._last = x
+        if self._previous is None:
+            return (NAN,)
+        return (self._std.amend(math.log(x / self._previous))[1],)
+
+
+INDICATORS = {
+    'SMA': SMA,
+    'EMA': EMA,
+    'BOLL': Bollinger,
+    'RSI': RSI,
+    'MACD': MACD,
+    'VOL': Volatility
+}
+
+
+class IndicatorEngine:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        # key -> [indicator, times (int64, ascending), outputs (2d array)]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns a dataframe of the outputs of an indicator over values (ascending times), feeding the indicator only
+    # the candles it has not seen yet when the same series was computed before
+    def compute(self, product_id, interval, name, times, values, **params):
+        cls = INDICATORS[name]
+        index = pd.DatetimeIndex(times)
+        times = index.asi8
+        values = np.asarray(values, dtype=np.float64)
+        key = (product_id, interval, name, tuple(sorted(params.items())))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            outputs = self._update(entry, times, values) if entry is not None else None
+            if outputs is None:
+                indicator = cls(**params)
+                outputs = np.array([indicator.push(v) for v in values.tolist()], dtype=np.float64).reshape(-1, len(cls.outputs))
+                entry = self._entries[key] = [indicator, times, outputs]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return pd.DataFrame(outputs, index=index, columns=cls.outputs)
+
+    # Brings a cached entry up to date with the series, returns None when the series does not continue the entry
+    def _update(self, entry, times, values):
+        indicator, cached_times, outputs = entry
+        if not len(times) or not len(cached_times) or times[0] < cached_times[0]:
+            return None
+        i = np.searchsorted(times, cached_times[-1])
+        if i == len(times) or times[i] != cached_times[-1]:
+            return None
+        # The last seen candle may have changed since, the following ones are new
+        first = np.searchsorted(cached_times, times[0])
+        if len(cached_times) - first != i + 1:
+            return None
+        new = [indicator.amend(float(values[i]))] + [indicator.push(v) for v in values[i + 1:].tolist()]
+        outputs = np.concatenate([outputs[first:-1], np.array(new, dtype=np.float64).reshape(len(new), -1)])
+        entry[1], entry[2] = times, outputs
+        return outputs
+
+
+def _prices(n=300, seed=0):
+    # Random walk of closes, one a minute
+    rng = np.random.default_rng(seed)
+    return pd.Series(100 * np.exp(np.cumsum(rng.normal(0, 0.01, n))),
+                     index=pd.date_range('2021-01-01', periods=n, freq='min'))
+
+
+# The outputs of each indicator computed with pandas over the whole series
+def _expected(name, close, **params):
+    if name == 'SMA':
+        return pd.DataFrame({'sma': close.rolling(params['window']).mean()})
+    if name == 'EMA':
+        return pd.DataFrame({'ema': close.ewm(span=params['span'], adjust=False).mean()})
+    if name == 'BOLL':
+        mean, std = close.rolling(params['window']).mean(), close.rolling(params['window']).std()
+        k = params.get('k', 2)
+        return pd.DataFrame({'mid': mean, 'upper': mean + k * std, 'lower': mean - k * std})
+    if name == 'MACD':
+        macd = close.ewm(span=params['fast'], adjust=False).mean() - close.ewm(span=params['slow'], adjust=False).mean()
+        signal = macd.ewm(span=params['signal'], adjust=False).mean()
+        return pd.DataFrame({'macd': macd, 'signal': signal, 'hist': macd - signal})
+    if name == 'RSI':
+        # Wilder's smoothing, seeded with the simple average of the first `period` changes
+        period = params['period']
+        change = close.diff()
+        averages = []
+        for moves in (change.clip(lower=0), (-change).clip(lower=0)):
+            seeded = moves.iloc[period:].copy()
+            seeded.iloc[0] = moves.iloc[1:period + 1].mean()
+            averages.append(seeded.ewm(alpha=1 / period, adjust=False).mean().reindex(close.index))
+        gain, loss = averages
+        return pd.DataFrame({'rsi': 100 - 100 / (1 + gain / loss)})
+    if name == 'VOL':
+        return pd.DataFrame({'vol': np.log(close).diff().rolling(params['window']).std()})
+    raise KeyError(name)
+
+
+CASES = [
+    ('SMA', {'window': 20}),
+    ('EMA', {'span': 12}),
+    ('BOLL', {'window': 20, 'k': 2}),
+    ('MACD', {'fast': 12, 'slow': 26, 'signal': 9}),
+    ('RSI', {'period': 14}),
+    ('VOL', {'window': 30})
+]
+
+
+class TestIndicators(unittest.TestCase):
+    def assertMatches(self, result, expected):
+        self.assertEqual(list(result.columns), list(expected.columns))
+        self.assertTrue(result.index.equals(expected.index))
+        np.testing.assert_allclose(result.values, expected.values, rtol=1e-9, atol=1e-9)
+
+    def test_from_scratch(self):
+        close = _prices()
+        for name, params in CASES:
+            with self.subTest(name=name):
+                result = IndicatorEngine().compute('BTC-USD', 60, name, close.index, close.values, **params)
+                self.assertMatches(result, _expected(name, close, **params))
+
+    def test_amend_and_push(self):
+        close = _prices()
+        for name, params in CASES:
+            with self.subTest(name=name):
+                engine = IndicatorEngine()
+                engine.compute('BTC-USD', 60, name, close.index[:200], close.values[:200], **params)
+                # The forming candle changed several times before closing and new candles came in
+                updated = close.copy()
+                for price in (90.0, 110.0, close.iloc[199] * 1.02):
+                    updated.iloc[199] = price
+                    result = engine.compute('BTC-USD', 60, name, updated.index[:200], updated.values[:200], **params)
+                    self.assertMatches(result, _expected(name, updated[:200], **params))
+                for end in (201, 250, 300):
+                    result = engine.compute('BTC-USD', 60, name, updated.index[:end], updated.values[:end], **params)
+                    self.assertMatches(result, _expected(name, updated[:end], **params))
+
+    def test_window_splicing(self):
+        close = _prices()
+        for name, params in CASES:
+            with self.subTest(name=name):
+                engine = IndicatorEngine()
+                engine.compute('BTC-USD', 60, name, close.index[:200], close.values[:200], **params)
+                # A sliding window of the latest candles continues the cached outputs from the whole history
+                result = engine.compute('BTC-USD', 60, name, close.index[50:260], close.values[50:260], **params)
+                self.assertMatches(result, _expected(name, close[:260], **params)[50:])
+                entry = engine._entries[('BTC-USD', 60, name, tuple(sorted(params.items())))]
+                self.assertEqual(len(entry[1]), 210)
+                self.assertEqual(len(entry[2]), 210)
+
+    def test_discontinued_series_is_recomputed(self):
+        close = _prices()
+        engine = IndicatorEngine()
+        engine.compute('BTC-USD', 60, 'SMA', close.index[:200], close.values[:200], window=20)
+        # Starting before the cached candles or skipping the last one cannot continue the cached state
+        for part in (close[:100], close[210:]):
+            result = engine.compute('BTC-USD', 60, 'SMA', part.index, part.values, window=20)
+            self.assertMatches(result, _expected('SMA', part, window=20))
+
+    def test_rolling_std_single_value_window(self):
+        std = RollingStd(1)
+        self.assertTrue(all(math.isnan(v) for v in std.push(1.0) + std.push(2.0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# Live trade feed for the cryptocurrency screener
+#
+# A LiveFeed subscribes to the matches channel of the Coinbase Pro websocket feed and folds every trade into the
+# LiveCandles kept in memory for each product and granularity. The REST candles served by MarketData are then
+# overlaid with the live ones, so the charts follow the market to the second without any extra REST request.
+
+import calendar
+import threading
+import time
+import cbpro
+
+DEFAULT_WS_URL = 'wss://ws-feed.pro.coinbase.com'
+
+# Seconds to wait before reconnecting after the socket is closed or fails
+RECONNECT_DELAY = 5
+
+
+# Returns the unix time, to the second, of a feed timestamp like 2021-01-15T12:34:56.789012Z
+def parse_time(timestamp):
+    return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+# Rolling candles built from trades, for every product and a fixed set of granularities. Only the latest `window`
+# candles of each product and granularity are kept.
+class LiveCandles:
+    def __init__(self, granularities=(60, 300, 900, 3600, 21600, 86400), window=300):
+        self.granularities = list(granularities)
+        self.window = window
+        # (product id, granularity) -> {candle time: [low, high, open, close, volume]}
+        self._candles = {}
+        # product id -> time of the first trade received, candles opened before it only hold part of their trades
+        self._since = {}
+        self._lock = threading.Lock()
+
+    def add_trade(self, product_id, price, size, timestamp):
+        with self._lock:
+            self._since.setdefault(product_id, timestamp)
+            for granularity in self.granularities:
+                candles = self._candles.setdefault((product_id, granularity), {})
+                start = timestamp // granularity * granularity
+                candle = candles.get(start)
+                if candle is None:
+                    candles[start] = [price, price, price, price, size]
+                    if len(candles) > self.window:
+                        del candles[min(candles)]
+                else:
+                    candle[0] = min(candle[0], price)
+                    candle[1] = max(candle[1], price)
+                    candle[3] = price
+                    candle[4] += size
+
+    # Returns the live candles of a product in the API format, newest first
+    def candles(self, product_id, granularity):
+        with self._lock:
+            candles = self._candles.get((product_id, granularity), {})
+            return [[t] + candles[t] for t in sorted(candles, reverse=True)]
+
+    # Returns the last traded price of a product, or None
+    def last_price(self, product_id):
+        candles = self.candles(product_id, self.granularities[0])
+        return candles[0][4] if candles else None
+
+    # Returns REST candles (API format, newest first) with the live candles merged in. Candles opened before the
+    # feed started are combined with the REST candle of the same time, which holds the trades the feed missed.
+    def overlay(self, product_id, granularity, candles):
+        live = self.candles(product_id, granularity)
+        if not live or not isinstance(candles, list):
+            return candles
+        with self._lock:
+            since = self._since.get(product_id, 0)
+        merged = {int(c[0]): list(c) for c in candles}
+        for t, low, high, open_, close, volume in live:
+            rest = merged.get(t)
+            if rest is not None and t < since:
+                merged[t] = [t, min(rest[1], low), max(rest[2], high), rest[3], close, max(rest[5], volume)]
+            else:
+                merged[t] = [t, low, high, open_, close, volume]
+        return [merged[t] for t in sorted(merged, reverse=True)]
+
+
+# Websocket client feeding the trades of some products into LiveCandles, reconnecting when the socket drops
+class LiveFeed(cbpro.WebsocketClient):
+    def __init__(self, product_ids, live_candles, url=DEFAULT_WS_URL):
+        super().__init__(url=url, products=list(product_ids), channels=['matches'], should_print=False)
+        self.live_candles = live_candles
+        self._closing = False
+
+    def on_message(self, msg):
+        if msg.get('type') in ('match', 'last_match'):
+            self.live_candles.add_trade(msg['product_id'], float(msg['price']), float(msg['size']), parse_time(msg['time']))
+
+    def on_error(self, e, data=None):
+        self.error = e
+        self.stop = True
+        print('Live feed error: {}'.format(e))
+
+    def on_close(self):
+        if not self._closing:
+            timer = threading.Timer(RECONNECT_DELAY, self.start)
+            timer.daemon = True
+            timer.start()
+
+    # Same as WebsocketClient.start, but in a daemon thread and going through on_close when the connection fails
+    def start(self):
+        def _go():
+            try:
+                self._connect()
+                self._listen()
+            except Exception as e:
+                self.on_error(e)
+            self._disconnect()
+
+        self.stop = False
+        self.on_open()
+        self.thread = threading.Thread(target=_go, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self._closing = True
+        super().close()
@@ -0,0 +1,178 @@
+'''
+Load test of the cryptocurrency screener
+
+Fires concurrent callback requests at a running app and reports throughput and latency per callback. The callbacks
+are read from the app's dependencies and their inputs filled with random values (products are taken from the
+options of the product dropdown), i.e.
+
+    python loadtest.py --url http://127.0.0.1:8050 --threads 8 --requests 2000
+
+With --fixtures the app is started in a subprocess on recorded fixtures (see fakeclient.py), so that it can be
+benchmarked without access to Coinbase Pro:
+
+    python fakeclient.py generate --products 50 fixtures
+    python loadtest.py --fixtures fixtures --threads 8 --requests 2000
+'''
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import pandas as pd
+import requests
+
+# Returns random values of the app inputs, by input id and property
+INPUT_VALUES = {
+    'dropdown-product.value': lambda rng, products: rng.choice(products),
+    'dropdown-compare.value': lambda rng, products: rng.sample(products, min(len(products), rng.randint(1, 5))),
+    'dropdown-graph.value': lambda rng, products: rng.choice(['line', 'candle']),
+    'dropdown-indicator.value': lambda rng, products: rng.sample(['SMA', 'EMA', 'BOLL', 'RSI', 'MACD'], rng.randint(0, 3)),
+    'input-sma.value': lambda rng, products: rng.randint(5, 50),
+    'dropdown-interval.value': lambda rng, products: rng.choice([60, 300, 900, 3600, 21600, 86400]),
+    'dropdown-history.value': lambda rng, products: rng.choice([0, 7, 30, 365, -1]),
+    'volatility-slider.value': lambda rng, products: rng.randint(3, 50)
+}
+
+
+# Returns the component of a layout with the given id
+def find_component(layout, component_id):
+    if isinstance(layout, dict):
+        props = layout.get('props', {})
+        if props.get('id') == component_id:
+            return layout
+        children = props.get('children')
+        return find_component(children, component_id) if children is not None else None
+    if isinstance(layout, list):
+        for child in layout:
+            found = find_component(child, component_id)
+            if found is not None:
+                return found
+    return None
+
+
+# Returns the list of {'id', 'property'} of a callback output, which lists several outputs as ..a.b...c.d..
+def parse_output(output):
+    if output.startswith('..'):
+        return [dict(zip(['id', 'property'], o.rsplit('.', 1))) for o in output[2:-2].split('...')]
+    return dict(zip(['id', 'property'], output.rsplit('.', 1)))
+
+
+def build_request(callback, rng, products, n):
+    inputs = []
+    for i in callback['inputs']:
+        key = '{}.{}'.format(i['id'], i['property'])
+        if key in INPUT_VALUES:
+            value = INPUT_VALUES[key](rng, products)
+        elif i['property'] == 'n_intervals':
+            value = n
+        else:
+            value = None
+        inputs.append({'id': i['id'], 'property': i['property'], 'value': value})
+    return {
+        'output': callback['output'],
+        'outputs': parse_output(callback['output']),
+        'inputs': inputs,
+        'changedPropIds': ['{}.{}'.format(inputs[0]['id'], inputs[0]['property'])] if inputs else [],
+        'state': []
+    }
+
+
+def run(url, n_threads, n_requests, callbacks=None, seed=0):
+    session = requests.Session()
+    dependencies = session.get(url + '/_dash-dependencies').json()
+    layout = session.get(url + '/_dash-layout').json()
+    dropdown = find_component(layout, 'dropdown-product')
+    products = [o['value'] for o in dropdown['props']['options']] if dropdown else ['BTC-USD']
+    if callbacks:
+        dependencies = [d for d in dependencies if any(c in d['output'] for c in callbacks)]
+
+    # Threads take request numbers from a shared counter until n_requests have been sent, so a thread stuck on slow
+    # callbacks does not hold back a share of the requests
+    numbers = iter(range(n_requests))
+    samples = []
+    lock = threading.Lock()
+
+    def worker(thread_id):
+        rng = random.Random(seed * 1000 + thread_id)
+        local = requests.Session()
+        while True:
+            with lock:
+                k = next(numbers, None)
+            if k is None:
+                return
+            callback = rng.choice(dependencies)
+            body = build_request(callback, rng, products, k)
+            start = time.perf_counter()
+            try:
+                ok = local.post(url + '/_dash-update-component', json=body).status_code in (200, 204)
+            except requests.RequestException:
+                ok = False
+            with lock:
+                samples.append((callback['output'], time.perf_counter() - start, not ok))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    frame = pd.DataFrame(samples, columns=['callback', 'latency', 'error'])
+    frame = pd.concat([frame, frame.assign(callback='all')])
+    latency_ms = frame.groupby('callback', sort=False)['latency'].quantile([0.5, 0.95, 0.99]).unstack() * 1000
+    results = frame.groupby('callback', sort=False).agg(requests=('latency', 'size'), errors=('error', 'sum'))
+    results['req/s'] = results['requests'] / elapsed
+    results[['p50_ms', 'p95_ms', 'p99_ms']] = latency_ms.values
+    return results.reset_index()
+
+
+# Starts the app on fixtures in a subprocess, returns it once it answers. The app gets its own candle store directory,
+# so that the fixture candles are not persisted into the store of the live app and the products and screener saved by
+# a live run are not loaded instead of the fixture ones.
+def serve(fixtures, port, candle_store_dir, latency=0.0):
+    env = dict(os.environ, CBPRO_FIXTURES=os.path.abspath(fixtures), CBPRO_FIXTURES_LATENCY=str(latency),
+               CANDLE_BACKFILL_DAYS='0', CANDLE_STORE_DIR=candle_store_dir)
+    process = subprocess.Popen([sys.executable, '-c', 'import app; app.app.run_server(port={}, threaded=True)'.format(port)],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(300):
+        try:
+            requests.get(url + '/_dash-dependencies')
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('The app did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the cryptocurrency screener callbacks')
+    parser.add_argument('--url', default='http://127.0.0.1:8050')
+    parser.add_argument('--fixtures', help='start the app on the fixtures of this directory instead of using --url')
+    parser.add_argument('--port', type=int, default=8051, help='port of the app started with --fixtures')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake API call')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--callbacks', help='comma separated parts of the outputs of the callbacks to test')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='loadtest-candle-store-') as candle_store_dir:
+        process, url = serve(args.fixtures, args.port, candle_store_dir, args.latency) if args.fixtures else (None, args.url)
+        try:
+            results = run(url, args.threads, args.requests, args.callbacks.split(',') if args.callbacks else None, args.seed)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:,.1f}'.format):
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+# Market data access layer for the cryptocurrency screener
+#
+# Wraps a cbpro.PublicClient so that every upstream call goes through a shared rate limiter, slow-changing
+# reference data (products and currencies) is fetched once, candles for many products are downloaded
+# concurrently by a thread pool, and candle series are kept up to date by only requesting new candles. With a
+# CandleStore, candle series start from the stored candles and every downloaded candle is persisted.
+
+import threading
+import time
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from re import search
+import numpy as np
+import pandas as pd
+
+# Coinbase Pro allows 10 public requests per second per IP, with bursts of up to 15
+DEFAULT_RATE = 10
+DEFAULT_BURST = 15
+
+# Reference data is refreshed after this many seconds
+REFERENCE_TTL = 3600
+
+# Longest time the latest, still forming, candle of a cached series may be out of date
+CANDLE_MAX_AGE = 60
+
+# Number of candles returned by one historic rates request, and kept by a CandleSeries
+CANDLE_WINDOW = 300
+
+CANDLE_COLUMNS = ['time', 'low', 'high', 'open', 'close', 'volume']
+
+
+class RateLimitError(Exception):
+    pass
+
+
+# Returns a dataframe of OHLCV candles from the [time, low, high, open, close, volume] rows returned by the API.
+# The rows are converted to a NumPy array in one go and the epoch seconds to datetimes as a column, prices may be
+# stored as float32 when the precision loss is acceptable (it is not for large prices like BTC-USD to the cent).
+def parse_candles(candles, price_dtype=np.float64):
+    array = np.asarray(candles, dtype=np.float64).reshape(-1, len(CANDLE_COLUMNS))
+    columns = {'time': pd.to_datetime(array[:, 0].astype(np.int64), unit='s')}
+    for i, column in enumerate(CANDLE_COLUMNS[1:-1], start=1):
+        columns[column] = array[:, i].astype(price_dtype)
+    columns['volume'] = array[:, -1]
+    return pd.DataFrame(columns, columns=CANDLE_COLUMNS)
+
+
+# Token bucket shared by all threads making upstream calls
+class RateLimiter:
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Blocks until a request may be sent
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Cache of candle series keyed by (product id, granularity). An entry expires when the next candle opens, or after
+# max_age seconds if that comes first, and concurrent misses on the same key share a single upstream request.
+class CandleCache:
+    def __init__(self, max_age=CANDLE_MAX_AGE, clock=time.time):
+        self.max_age = max_age
+        self.clock = clock
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    # Returns the time at which candles of the given granularity fetched at `now` become stale
+    def expiry(self, granularity, now):
+        return min((now // granularity + 1) * granularity, now + self.max_age)
+
+    # Returns the cached candles for the key, calling fetch() on a miss
+    def get(self, product_id, granularity, fetch):
+        key = (product_id, granularity)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                return entry[1]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            now = self.clock()
+            candles = fetch()
+            # Error payloads are passed on but not cached
+            if isinstance(candles, list):
+                with self._lock:
+                    self._entries[key] = (self.expiry(granularity, now), candles)
+            future.set_result(candles)
+            return candles
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def invalidate(self, product_id=None, granularity=None):
+        with self._lock:
+            for key in list(self._entries):
+                if product_id in (None, key[0]) and granularity in (None, key[1]):
+                    del self._entries[key]
+
+
+# Rolling window of the latest candles of one product and granularity. The first refresh downloads the whole window,
+# later ones only request candles from the last stored one (which may still have been forming) onwards and merge them in.
+class CandleSeries:
+    def __init__(self, product_id, granularity, window=CANDLE_WINDOW):
+        self.product_id = product_id
+        self.granularity = granularity
+        self.window = window
+        # Oldest first, values are low, high, open, close, volume
+        self.times = np.empty(0, dtype=np.int64)
+        self.values = np.empty((0, 5))
+        self._lock = threading.Lock()
+
+    # Merges candles in the API format into the series, replacing candles with the same time
+    def merge(self, candles):
+        if not len(candles):
+            return
+        new = np.array(candles, dtype=float)
+        new = new[np.argsort(new[:, 0], kind='stable')]
+        new_times = new[:, 0].astype(np.int64)
+        keep = self.times < new_times[0]
+        self.times = np.concatenate([self.times[keep], new_times])[-self.window:]
+        self.values = np.concatenate([self.values[keep], new[:, 1:]])[-self.window:]
+
+    # Brings the series up to date through fetch(start, end), which takes unix times (None for the latest window)
+    def refresh(self, fetch, now=None):
+        with self._lock:
+            now = time.time() if now is None else now
+            if not len(self.times) or (now - self.times[-1]) / self.granularity >= self.window:
+                candles = fetch(None, None)
+            else:
+                candles = fetch(int(self.times[-1]), int(now))
+            if not isinstance(candles, list):
+                return candles
+            self.merge(candles)
+            return self.to_list()
+
+    # Returns the candles in the API format, newest first
+    def to_list(self):
+        return [[int(t)] + v for t, v in zip(self.times[::-1].tolist(), self.values[::-1].tolist())]
+
+
+class MarketData:
+    def __init__(self, client, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_workers=8, retries=3, candle_cache=None, store=None):
+        self.client = client
+        self.candle_cache = candle_cache or CandleCache()
+        self.store = store
+        self.limiter = RateLimiter(rate, burst)
+        self.max_workers = max_workers
+        self.retries = retries
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+        self._series = {}
+        self._series_lock = threading.Lock()
+
+    # Calls a client method under the rate limit, backing off and retrying when the API still reports a rate limit error
+    def call(self, method, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            result = getattr(self.client, method)(*args, **kwargs)
+            # Errors come back as a json object with a message instead of the expected payload
+            if not (isinstance(result, dict) and 'rate limit' in str(result.get('message', '')).lower()):
+                return result
+            time.sleep(0.5 * 2 ** attempt)
+        raise RateLimitError('{} still rate limited after {} retries'.format(method, self.retries))
+
+    # Returns the result of a client call without arguments, fetched at most once every REFERENCE_TTL seconds
+    def _memoized(self, method):
+        with self._memo_lock:
+            cached = self._memo.get(method)
+            if cached and time.monotonic() - cached[0] < REFERENCE_TTL:
+                return cached[1]
+        result = self.call(method)
+        with self._memo_lock:
+            self._memo[method] = (time.monotonic(), result)
+        return result
+
+    def get_products(self):
+        return self._memoized('get_products')
+
+    def get_currencies(self):
+        return self._memoized('get_currencies')
+
+    # Returns the ids of the cryptocurrency/USD pairs
+    def get_usd_product_ids(self):
+        return [p['id'] for p in self.get_products() if search(r'-USD$', p['id'])]
+
+    # Returns a dict of currency id to currency name
+    def get_currency_names(self):
+        return {c['id']: c['name'] for c in self.get_currencies()}
+
+    # Returns the raw candles ([time, low, high, open, close, volume], newest first) of a product, the latest
+    # window is served from the candle cache and refreshed incrementally once the cache entry expires
+    def get_historic_rates(self, product_id, granularity, start=None, end=None):
+        if start is None and end is None:
+            series = self.get_series(product_id, granularity)
+            return self.candle_cache.get(product_id, granularity,
+                                         lambda: series.refresh(lambda s, e: self.fetch_range(product_id, granularity, s, e)))
+        return self.call('get_product_historic_rates', product_id, start=start, end=end, granularity=granularity)
+
+    # Returns the candles from a unix time up to now, newest first, reading what is older than the latest window from the store
+    def get_history(self, product_id, granularity, start):
+        latest = np.asarray(self.get_historic_rates(product_id, granularity), dtype=np.float64).reshape(-1, len(CANDLE_COLUMNS))
+        latest = latest[latest[:, 0] >= start]
+        if self.store is None:
+            return latest
+        end = latest[-1, 0] - 1 if len(latest) else None
+        return np.concatenate([latest, self.store.read(product_id, granularity, start, end)])
+
+    # Returns the CandleSeries kept for a product and granularity, starting from the latest stored candles
+    def get_series(self, product_id, granularity):
+        with self._series_lock:
+            key = (product_id, granularity)
+            if key not in self._series:
+                self._series[key] = CandleSeries(product_id, granularity)
+                if self.store is not None:
+                    self._series[key].merge(self.store.latest(product_id, granularity, CANDLE_WINDOW))
+            return self._series[key]
+
+    # Requests the candles between two unix times, or the latest window when they are None, and persists them
+    def fetch_range(self, product_id, granularity, start, end):
+        if start is None:
+            candles = self.call('get_product_historic_rates', product_id, granularity=granularity)
+        else:
+            candles = self.call('get_product_historic_rates', product_id,
+                                start=datetime.utcfromtimestamp(start).isoformat(),
+                                end=datetime.utcfromtimestamp(end).isoformat(),
+                                granularity=granularity)
+        if self.store is not None and isinstance(candles, list):
+            self.store.write(product_id, granularity, candles)
+        return candles
+
+    # Returns a dict of product id to raw candles, downloading all products concurrently
+    def get_many_historic_rates(self, product_ids, granularity):
+        product_ids = list(product_ids)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            candles = pool.map(lambda p: self.get_historic_rates(p, granularity), product_ids)
+            return dict(zip(product_ids, candles))
+
+    # Returns a dict of product id to the candles since a unix time (see get_history), reading all products concurrently
+    def get_many_histories(self, product_ids, granularity, start):
+        product_ids = list(product_ids)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            candles = pool.map(lambda p: self.get_history(p, granularity, start), product_ids)
+            return dict(zip(product_ids, candles))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst(self):
+        # At one request per second only the burst can go through at once
+        limiter = RateLimiter(rate=1, burst=3)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_rate(self):
+        limiter = RateLimiter(rate=50, burst=1)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+        # The two requests beyond the burst wait for a token each
+        self.assertGreaterEqual(time.monotonic() - start, 0.035)
+
+    def test_shared_by_threads(self):
+        limiter = RateLimiter(rate=100, burst=1)
+        start = time.monotonic()
+        threads = [threading.Thread(target=limiter.acquire) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+
+
+class CountingClient:
+    # Stub of the public client returning a fixed window of candles and counting the requests
+    def __init__(self, candles, delay=0.0):
+        self.candles = candles
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        with self._lock:
+            self.calls.append((product_id, start, end, granularity))
+        time.sleep(self.delay)
+        return self.candles
+
+
+class TestCandleCache(unittest.TestCase):
+    def test_concurrent_misses_share_one_request(self):
+        client = CountingClient([[120, 1, 2, 1, 2, 10], [60, 1, 2, 1, 1, 10]], delay=0.1)
+        market_data = MarketData(client, rate=1000, burst=1000)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(market_data.get_historic_rates('BTC-USD', 60)))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(client.calls), 1)
+        self.assertEqual(results, [results[0]] * 8)
+        self.assertEqual([c[0] for c in results[0]], [120, 60])
+
+    def test_error_payload_not_cached(self):
+        cache = CandleCache()
+        payloads = iter([{'message': 'NotFound'}, [[60, 1, 2, 1, 2, 10]]])
+        fetch = lambda: next(payloads)
+        self.assertEqual(cache.get('BTC-USD', 60, fetch), {'message': 'NotFound'})
+        self.assertEqual(cache.get('BTC-USD', 60, fetch), [[60, 1, 2, 1, 2, 10]])
+        self.assertEqual(cache.get('BTC-USD', 60, fetch), [[60, 1, 2, 1, 2, 10]])
+
+    def test_expires_at_next_candle(self):
+        now = [130.0]
+        cache = CandleCache(max_age=3600, clock=lambda: now[0])
+        calls = []
+        fetch = lambda: calls.append(now[0]) or [[120, 1, 2, 1, 2, 10]]
+        cache.get('BTC-USD', 60, fetch)
+        now[0] = 179.9
+        cache.get('BTC-USD', 60, fetch)
+        self.assertEqual(calls, [130.0])
+        now[0] = 180.0
+        cache.get('BTC-USD', 60, fetch)
+        self.assertEqual(calls, [130.0, 180.0])
+        # max_age bounds the entries of long candles
+        cache = CandleCache(max_age=60, clock=lambda: now[0])
+        self.assertEqual(cache.expiry(86400, now[0]), 240.0)
+
+    def test_many_histories_download_concurrently(self):
+        client = CountingClient([[180, 1, 2, 1, 2, 10], [120, 1, 2, 1, 2, 10], [60, 1, 2, 1, 1, 10]], delay=0.1)
+        market_data = MarketData(client, rate=1000, burst=1000, max_workers=4)
+        start = time.monotonic()
+        histories = market_data.get_many_histories(['BTC-USD', 'ETH-USD', 'LTC-USD', 'XRP-USD'], 60, 120)
+        self.assertLess(time.monotonic() - start, 0.3)
+        self.assertEqual(list(histories), ['BTC-USD', 'ETH-USD', 'LTC-USD', 'XRP-USD'])
+        for candles in histories.values():
+            self.assertEqual(candles[:, 0].tolist(), [180, 120])
+
+
+class TestCandleSeries(unittest.TestCase):
+    def test_merge_replaces_forming_candle(self):
+        series = CandleSeries('BTC-USD', 60)
+        series.merge([[120, 1, 2, 1, 1.5, 10], [60, 1, 2, 1, 1, 10]])
+        series.merge([[180, 2, 3, 2, 3, 5], [120, 1, 3, 1, 2, 20]])
+        self.assertEqual(series.to_list(), [[180, 2, 3, 2, 3, 5], [120, 1, 3, 1, 2, 20], [60, 1, 2, 1, 1, 10]])
+
+    def test_merge_trims_to_window(self):
+        series = CandleSeries('BTC-USD', 60, window=3)
+        series.merge([[t, 1, 2, 1, 1, 10] for t in range(0, 300, 60)])
+        self.assertEqual(series.times.tolist(), [120, 180, 240])
+        series.merge([[300, 1, 2, 1, 1, 10]])
+        self.assertEqual(series.times.tolist(), [180, 240, 300])
+
+    def test_refresh(self):
+        requests = []
+
+        def fetch(start, end):
+            requests.append((start, end))
+            first = 0 if start is None else start
+            return [[t, 1, 2, 1, 1, 10] for t in range(first, (end or 120) + 1, 60)][::-1]
+
+        series = CandleSeries('BTC-USD', 60, window=3)
+        series.refresh(fetch, now=130)
+        self.assertEqual(series.times.tolist(), [0, 60, 120])
+        # Only the candles from the last stored one on are requested
+        self.assertEqual([c[0] for c in series.refresh(fetch, now=200)], [180, 120, 60])
+        # The whole window is downloaded again once the gap is as long as the window
+        series.refresh(fetch, now=180 + 3 * 60)
+        self.assertEqual(requests, [(None, None), (120, 200), (None, None)])
+        self.assertEqual(series.refresh(lambda start, end: {'message': 'NotFound'}, now=400), {'message': 'NotFound'})
+
+
+if __name__ == '__main__':
+    unittest.main()
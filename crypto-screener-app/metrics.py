@@ -0,0 +1,179 @@
+# Instrumentation of the cryptocurrency screener
+#
+# Counters and latency histograms of the upstream Coinbase Pro calls, the Dash callbacks and the main data access
+# functions, rendered in the Prometheus text format on the /metrics route of the app. Metrics are kept per process,
+# with several workers each of them reports its own.
+
+import functools
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # label values -> [count per bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return entry[2] if entry else 0
+
+    def samples(self):
+        with self._lock:
+            values = {key: ([list(entry[0])] + entry[1:]) for key, entry in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name + '_bucket', labels + [('le', _format_value(bound))], cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    # Returns every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+upstream_requests = REGISTRY.counter('cbpro_requests_total', 'Coinbase Pro API requests', ['method', 'outcome'])
+upstream_latency = REGISTRY.histogram('cbpro_request_duration_seconds', 'Coinbase Pro API request latency', ['method'])
+callback_latency = REGISTRY.histogram('dash_callback_duration_seconds', 'Dash callback latency', ['callback'])
+callback_errors = REGISTRY.counter('dash_callback_errors_total', 'Dash callbacks raising an exception', ['callback'])
+function_latency = REGISTRY.histogram('app_function_duration_seconds', 'Latency of the data access functions', ['function'])
+
+
+# Decorator recording the latency of every call of a function in a histogram, and the exceptions in a counter
+def timed(histogram, errors=None, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+# Returns a decorator timing a Dash callback under its function name
+def timed_callback(func):
+    return timed(callback_latency, callback_errors, callback=func.__name__)(func)
+
+
+# Returns a decorator timing a data access function under its function name
+def timed_function(func):
+    return timed(function_latency, function=func.__name__)(func)
+
+
+# Wraps an API client so that every method call is counted and timed, calls returning an error message (the API
+# returns errors as a json object with a message) being counted as errors
+class InstrumentedClient:
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = attribute(*args, **kwargs)
+                if not (isinstance(result, dict) and 'message' in result):
+                    outcome = 'ok'
+                return result
+            finally:
+                upstream_latency.observe(time.perf_counter() - start, method=name)
+                upstream_requests.inc(method=name, outcome=outcome)
+        return call
@@ -0,0 +1,104 @@
+# Product metadata registry for the cryptocurrency screener
+#
+# Ids, names, trading status and dropdown options of the products are built once from the products and currencies
+# of the API, kept in memory and saved to a json file, so that a restarted worker starts from the saved metadata
+# without waiting on the API. A background thread refreshes them on a schedule.
+
+import json
+import threading
+import time
+from fileutils import atomic_write
+
+# Metadata older than this many seconds is refreshed
+REGISTRY_TTL = 3600
+
+
+class ProductRegistry:
+    def __init__(self, market_data, path=None, ttl=REGISTRY_TTL):
+        self.market_data = market_data
+        self.path = path
+        self.ttl = ttl
+        self._products = {}
+        self._ids = {}
+        self._options = {}
+        self._updated = 0
+        self._lock = threading.Lock()
+
+    # Builds the lookups from a list of product metadata dicts
+    def _index(self, products, updated):
+        by_quote = {}
+        for product in products:
+            by_quote.setdefault(product['quote'], []).append(product['id'])
+        ids = {quote: sorted(quote_ids) for quote, quote_ids in by_quote.items()}
+        with self._lock:
+            self._products = {p['id']: p for p in products}
+            self._ids = ids
+            self._options = {quote: [{'label': p, 'value': p} for p in quote_ids] for quote, quote_ids in ids.items()}
+            self._updated = updated
+
+    # Loads the saved metadata, returns whether there was any
+    def load(self):
+        if not self.path:
+            return False
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self._index(saved['products'], saved['updated'])
+        return True
+
+    # Fetches the metadata from the API, bypassing the memoized reference data, and saves it
+    def refresh(self):
+        names = {c['id']: c['name'] for c in self.market_data.call('get_currencies')}
+        products = [{
+            'id': p['id'],
+            'base': p['base_currency'],
+            'quote': p['quote_currency'],
+            'name': names.get(p['base_currency'], p['base_currency']),
+            'status': p.get('status', 'online'),
+            'trading_disabled': bool(p.get('trading_disabled', False))
+        } for p in self.market_data.call('get_products')]
+        updated = time.time()
+        self._index(products, updated)
+        if self.path:
+            with atomic_write(self.path) as f:
+                json.dump({'updated': updated, 'products': products}, f)
+
+    # Makes sure metadata is available, from the saved file when there is one and from the API otherwise
+    def ensure_loaded(self):
+        if not self._products and not self.load():
+            self.refresh()
+
+    # Refreshes the metadata every ttl seconds in a daemon thread, starting with the saved metadata if it is stale
+    def start(self):
+        def run():
+            while True:
+                time.sleep(max(self._updated + self.ttl - time.time(), 0))
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print('Product registry refresh failed: {}'.format(e))
+                    time.sleep(min(self.ttl, 60))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    # Returns the ids of the products quoted in a currency, sorted
+    def ids(self, quote='USD'):
+        self.ensure_loaded()
+        return self._ids.get(quote, [])
+
+    # Returns the dropdown options of the products quoted in a currency
+    def options(self, quote='USD'):
+        self.ensure_loaded()
+        return self._options.get(quote, [])
+
+    # Returns the name of the base currency of a product
+    def name(self, product_id):
+        self.ensure_loaded()
+        return self._products[product_id]['name']
+
+    # Returns the trading status of a product, i.e. online, offline or delisted
+    def status(self, product_id):
+        self.ensure_loaded()
+        return self._products[product_id]['status']
@@ -0,0 +1,227 @@
+# Screener computation for the cryptocurrency screener
+#
+# The screener table is recomputed by a background ScreenerRefresher and published to a ScreenerStore, from which
+# the layout and callbacks read the latest snapshot without waiting on any upstream request. With a file path the
+# snapshot is shared by every worker process, and only one of them (the holder of a lock file) recomputes it.
+
+import os
+import threading
+import time
+import unittest
+import numpy as np
+import pandas as pd
+from fileutils import LeaderLock, atomic_write
+
+SCREENER_COLUMNS = ['rank', 'productId', 'productName', 'last', '1day%', '7day%', '30day%', '30dayVol%', '7dayVolume%']
+
+# Columns colored green or red by sign in the screener table
+CHANGE_COLUMNS = ['1day%', '7day%', '30day%', '7dayVolume%']
+
+
+# Returns wide (date x product) dataframes of the close prices and volumes of every product, built in one pass from
+# the daily candles of each product in the API format
+def price_matrix(product_candles):
+    product_ids = [p for p, candles in product_candles.items() if isinstance(candles, list) and candles]
+    if not product_ids:
+        return pd.DataFrame(), pd.DataFrame()
+    rows = [np.asarray(product_candles[p], dtype=np.float64).reshape(-1, 6) for p in product_ids]
+    stacked = np.concatenate(rows)
+    columns = np.repeat(np.arange(len(product_ids)), [len(r) for r in rows])
+    times, index = np.unique(stacked[:, 0].astype(np.int64), return_inverse=True)
+
+    close = np.full((len(times), len(product_ids)), np.nan)
+    volume = np.full((len(times), len(product_ids)), np.nan)
+    close[index, columns] = stacked[:, 4]
+    volume[index, columns] = stacked[:, 5]
+
+    dates = pd.to_datetime(times, unit='s')
+    return pd.DataFrame(close, index=dates, columns=product_ids), pd.DataFrame(volume, index=dates, columns=product_ids)
+
+
+# Returns the screener dataframe from the close price and volume matrices and a dict of product id to name, every
+# metric being computed for all products at once. Days without a trade keep the previous close.
+def screener_metrics(close, volume, names):
+    if close.empty:
+        return pd.DataFrame(columns=SCREENER_COLUMNS)
+    prices = close.ffill().values
+    volumes = np.nan_to_num(volume.values)
+    last = prices[-1]
+
+    def change(days):
+        if len(prices) <= days:
+            return np.full(len(last), np.nan)
+        return (last - prices[-1 - days]) / prices[-1 - days] * 100
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_returns = np.diff(np.log(prices[-31:]), axis=0)
+        volatility = pd.DataFrame(log_returns).std().values * 100
+        volume_change = (volumes[-7:].sum(axis=0) / volumes[-14:-7].sum(axis=0) - 1) * 100
+
+    screener = pd.DataFrame({
+        'productId': close.columns,
+        'productName': [names.get(p, p) for p in close.columns],
+        'last': last,
+        '1day%': np.round(change(1), 1),
+        '7day%': np.round(change(7), 1),
+        '30day%': np.round(change(30), 1),
+        '30dayVol%': np.round(volatility, 1),
+        '7dayVolume%': np.round(np.where(np.isfinite(volume_change), volume_change, np.nan), 1)
+    })
+    screener['rank'] = screener['7day%'].rank(ascending=False, method='min')
+    screener = screener.dropna(subset=['last']).sort_values('rank', na_position='last')
+    return screener[SCREENER_COLUMNS].reset_index(drop=True)
+
+
+# Returns the screener dataframe computed from the daily candles of some products, named by a dict of product id to name
+def compute_screener(market_data, product_ids, names):
+    # Daily candles of every product, downloaded concurrently
+    product_candles = market_data.get_many_historic_rates(product_ids, 86400)
+    close, volume = price_matrix(product_candles)
+    return screener_metrics(close, volume, names)
+
+
+# Holds the latest screener snapshot, in memory and optionally in a file shared between processes
+class ScreenerStore:
+    def __init__(self, path=None):
+        self.path = path
+        self._frame = pd.DataFrame(columns=SCREENER_COLUMNS)
+        self._updated = 0
+        self._lock = threading.Lock()
+
+    def publish(self, frame):
+        with self._lock:
+            self._frame = frame
+            self._updated = time.time()
+        if self.path:
+            with atomic_write(self.path, 'wb') as f:
+                frame.to_pickle(f)
+
+    # Returns the latest snapshot, reloading it when another process has published a newer one
+    def latest(self):
+        if self.path:
+            try:
+                mtime = os.path.getmtime(self.path)
+                if mtime > self._updated:
+                    frame = pd.read_pickle(self.path)
+                    with self._lock:
+                        self._frame, self._updated = frame, mtime
+            except (OSError, EOFError):
+                pass
+        with self._lock:
+            return self._frame
+
+    # Returns the time of the latest snapshot (0 when there is none yet)
+    def updated(self):
+        self.latest()
+        return self._updated
+
+
+# Background thread recomputing the screener of the USD products of a ProductRegistry every `interval` seconds
+class ScreenerRefresher(threading.Thread):
+    def __init__(self, market_data, registry, store, interval=900, lock_path=None):
+        super().__init__(daemon=True)
+        self.market_data = market_data
+        self.registry = registry
+        self.store = store
+        self.interval = interval
+        self._leader = LeaderLock(lock_path)
+
+    # Returns whether this process is the one refreshing the shared snapshot
+    def _is_leader(self):
+        return self._leader.acquire()
+
+    def run(self):
+        while True:
+            # A snapshot left by a previous run or another process may still be fresh
+            delay = self.interval - (time.time() - self.store.updated())
+            if delay <= 0 and self._is_leader():
+                try:
+                    product_ids = self.registry.ids('USD')
+                    names = {p: self.registry.name(p) for p in product_ids}
+                    self.store.publish(compute_screener(self.market_data, product_ids, names))
+                    delay = self.interval
+                except Exception as e:
+                    print('Screener refresh failed: {}'.format(e))
+            time.sleep(max(delay, min(self.interval, 60)))
+
+
+def _daily_candles(close, volume, start=pd.Timestamp('2021-01-01')):
+    # Daily candles in the API format (time, low, high, open, close, volume), newest first, skipping missing closes
+    times = (pd.date_range(start, periods=len(close), freq='D') - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+    return [[t, c, c, c, c, v] for t, c, v in zip(times, close, volume) if not np.isnan(c)][::-1]
+
+
+class TestScreener(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.close = pd.DataFrame(100 * np.exp(np.cumsum(rng.normal(0, 0.03, (40, 4)), axis=0)),
+                                  index=pd.date_range('2021-01-01', periods=40, freq='D'),
+                                  columns=['A-USD', 'B-USD', 'C-USD', 'D-USD'])
+        self.volume = pd.DataFrame(rng.uniform(1, 100, (40, 4)), index=self.close.index, columns=self.close.columns)
+        # C-USD was listed 5 days ago, D-USD did not trade on a few days
+        self.close.iloc[:35, 2] = np.nan
+        self.close.iloc[[10, 36, 38], 3] = np.nan
+        self.volume[self.close.isna()] = np.nan
+
+    def product_candles(self):
+        return {p: _daily_candles(self.close[p].values, self.volume[p].values) for p in self.close.columns}
+
+    def test_price_matrix(self):
+        product_candles = self.product_candles()
+        product_candles['E-USD'] = {'message': 'NotFound'}
+        product_candles['F-USD'] = []
+        close, volume = price_matrix(product_candles)
+        self.assertEqual(list(close.columns), ['A-USD', 'B-USD', 'C-USD', 'D-USD'])
+        pd.testing.assert_frame_equal(close, self.close, check_freq=False, check_index_type=False)
+        pd.testing.assert_frame_equal(volume, self.volume, check_freq=False, check_index_type=False)
+        self.assertEqual(price_matrix({'E-USD': {'message': 'NotFound'}})[0].shape, (0, 0))
+
+    def test_screener_metrics(self):
+        screener = screener_metrics(self.close, self.volume, {'A-USD': 'Alpha'}).set_index('productId')
+        prices = self.close.ffill()
+        volumes = self.volume.fillna(0)
+        self.assertEqual(list(screener.columns), SCREENER_COLUMNS[:1] + SCREENER_COLUMNS[2:])
+        self.assertEqual(screener.loc['A-USD', 'productName'], 'Alpha')
+        self.assertEqual(screener.loc['B-USD', 'productName'], 'B-USD')
+        np.testing.assert_allclose(screener['last'], prices.iloc[-1][screener.index])
+        for days, column in ((1, '1day%'), (7, '7day%'), (30, '30day%')):
+            expected = np.round(prices.pct_change(days, fill_method=None).iloc[-1] * 100, 1)
+            np.testing.assert_allclose(screener[column], expected[screener.index])
+        # C-USD has 5 days of history, too short for the 7 and 30 day metrics
+        self.assertTrue(np.isnan(screener.loc['C-USD', ['7day%', '30day%']].astype(float)).all())
+        self.assertFalse(np.isnan(screener.loc['C-USD', '1day%']))
+        volatility = np.round(np.log(prices.iloc[-31:]).diff().std() * 100, 1)
+        np.testing.assert_allclose(screener['30dayVol%'], volatility[screener.index])
+        volume_change = np.round((volumes.iloc[-7:].sum() / volumes.iloc[-14:-7].sum() - 1) * 100, 1)
+        self.assertTrue(np.isnan(screener.loc['C-USD', '7dayVolume%']))
+        np.testing.assert_allclose(screener.loc[['A-USD', 'B-USD', 'D-USD'], '7dayVolume%'],
+                                   volume_change[['A-USD', 'B-USD', 'D-USD']])
+
+    def test_zero_volumes(self):
+        # No volume in the previous week leaves the change undefined instead of infinite
+        self.volume.iloc[-14:-7, 0] = 0
+        self.volume.iloc[-14:, 1] = 0
+        self.volume.iloc[-7:, 3] = 0
+        screener = screener_metrics(self.close, self.volume, {}).set_index('productId')
+        self.assertTrue(np.isnan(screener.loc['A-USD', '7dayVolume%']))
+        self.assertTrue(np.isnan(screener.loc['B-USD', '7dayVolume%']))
+        self.assertEqual(screener.loc['D-USD', '7dayVolume%'], -100.0)
+
+    def test_rank(self):
+        # Ranked by 7 day change, highest first, ties sharing the best rank and products without one last
+        close = pd.DataFrame({'A-USD': [100.0] * 8, 'B-USD': [100.0] * 7 + [120.0], 'C-USD': [100.0] * 7 + [90.0],
+                              'D-USD': [np.nan] * 6 + [100.0, 110.0], 'E-USD': [100.0] * 7 + [120.0]},
+                             index=pd.date_range('2021-01-01', periods=8, freq='D'))
+        screener = screener_metrics(close, close * 0 + 1, {})
+        self.assertEqual(list(screener['productId']), ['B-USD', 'E-USD', 'A-USD', 'C-USD', 'D-USD'])
+        np.testing.assert_array_equal(screener['rank'], [1, 1, 3, 4, np.nan])
+        self.assertEqual(list(screener['7day%'][:4]), [20.0, 20.0, 0.0, -10.0])
+
+    def test_empty(self):
+        screener = screener_metrics(*price_matrix({}), {})
+        self.assertTrue(screener.empty)
+        self.assertEqual(list(screener.columns), SCREENER_COLUMNS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+'''
+MangoDB Benchmark
+
+A YCSB style workload harness for MangoDB. Every workload is run against every configuration and thread count and reports throughput, latency
+percentiles and memory, i.e.
+
+    python benchmark.py --workloads a,b,c,e --distribution zipfian --threads 1,4 --configs plain,indexed,capped,sharded
+'''
+
+import argparse, bisect, importlib.util, itertools, os, random, threading, time
+import pandas as pd
+
+# no-sql-db.py cannot be imported by name because of the dashes in it
+spec = importlib.util.spec_from_file_location('mangodb', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'no-sql-db.py'))
+mangodb = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mangodb)
+
+COLLECTION = 'usertable'
+
+# The YCSB core workloads, as proportions of read, update, insert, scan and read-modify-write operations
+WORKLOADS = {
+    'a': {'name': 'update heavy', 'read': 0.5, 'update': 0.5},
+    'b': {'name': 'read mostly', 'read': 0.95, 'update': 0.05},
+    'c': {'name': 'read only', 'read': 1.0},
+    'd': {'name': 'read latest', 'read': 0.95, 'insert': 0.05, 'distribution': 'latest'},
+    'e': {'name': 'short ranges', 'scan': 0.95, 'insert': 0.05},
+    'f': {'name': 'read-modify-write', 'read': 0.5, 'rmw': 0.5},
+    'w': {'name': 'write heavy', 'read': 0.1, 'update': 0.6, 'insert': 0.3}
+}
+
+OPERATIONS = ['read', 'update', 'insert', 'scan', 'rmw']
+
+class UniformGenerator:
+    def __init__(self, n_items, rng):
+        self.n_items = n_items
+        self.rng = rng
+
+    def next(self):
+        return self.rng.randrange(self.n_items)
+
+FNV_OFFSET_BASIS_64 = 0xCBF29CE484222325
+FNV_PRIME_64 = 0x100000001B3
+
+# fnv_hash64(value) is the FNV-1a hash of the 8 bytes of an integer used by YCSB, unlike hash() it does not depend on PYTHONHASHSEED so every run
+# scrambles the ranks the same way
+def fnv_hash64(value):
+    h = FNV_OFFSET_BASIS_64
+    for _ in range(8):
+        h ^= value & 0xFF
+        h = (h * FNV_PRIME_64) & 0xFFFFFFFFFFFFFFFF
+        value >>= 8
+    return h
+
+class ZipfianGenerator:
+    # Draws item numbers following a Zipf distribution with the given skew, item 0 being the most popular. The popular items are scattered over the
+    # key space by hashing so that they are not all neighbours, as in YCSB's scrambled zipfian generator.
+    def __init__(self, n_items, rng, theta=0.99):
+        self.n_items = n_items
+        self.rng = rng
+        self.theta = theta
+        self.zetan = sum(1 / (i + 1) ** theta for i in range(n_items))
+        zeta2 = 1 + 1 / 2 ** theta
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - (2 / n_items) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+
+    def rank(self):
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < 1 + 0.5 ** self.theta:
+            return 1
+        return min(int(self.n_items * (self.eta * u - self.eta + 1) ** self.alpha), self.n_items - 1)
+
+    def next(self):
+        return fnv_hash64(self.rank()) % self.n_items
+
+class LatestGenerator:
+    # Favours the most recently inserted items, the zipfian rank counts back from the newest key
+    def __init__(self, counter, rng):
+        self.counter = counter
+        self.zipfian = ZipfianGenerator(counter.value, rng)
+
+    def next(self):
+        return max(self.counter.value - 1 - self.zipfian.rank(), 0)
+
+class KeyCounter:
+    # Hands out new keys for inserts across threads
+    def __init__(self, start):
+        self.value = start
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            self.value += 1
+            return self.value - 1
+
+def build_record(rng, n_fields, field_length):
+    return {'field%d' % i: ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=field_length)) for i in range(n_fields)}
+
+# make_db(config, n_records) returns a database set up for one of the compared configurations, along with a function releasing it
+def make_db(config, n_records):
+    if config == 'sharded':
+        db = mangodb.ShardedMangoDB()
+        db.add_collection(COLLECTION)
+        return db, db.close
+    db = mangodb.MangoDB()
+    if config == 'capped':
+        # Large enough never to evict the loaded records, so only the bookkeeping cost is measured
+        db.add_collection(COLLECTION, ttl=3600, max_items=n_records * 10)
+    else:
+        db.add_collection(COLLECTION)
+    if config == 'indexed':
+        db.create_index(COLLECTION, 'field0')
+    return db, lambda: None
+
+def load(db, n_records, n_fields, field_length, seed, batch_size=1000):
+    rng = random.Random(seed)
+    for start in range(0, n_records, batch_size):
+        db.update_collection(COLLECTION, {key: build_record(rng, n_fields, field_length)
+                                          for key in range(start, min(start + batch_size, n_records))})
+
+def run_workload(db, workload, n_records, n_operations, n_threads, distribution='zipfian', n_fields=10, field_length=100,
+                 max_scan_length=100, seed=0):
+    spec = WORKLOADS[workload]
+    distribution = spec.get('distribution', distribution)
+    cumulative = list(itertools.accumulate(spec.get(op, 0) for op in OPERATIONS))
+    counter = KeyCounter(n_records)
+    latencies = {op: [] for op in OPERATIONS}
+
+    def worker(thread_id, n):
+        rng = random.Random(seed * 1000 + thread_id)
+        if distribution == 'latest':
+            keys = LatestGenerator(counter, rng)
+        elif distribution == 'zipfian':
+            keys = ZipfianGenerator(n_records, rng)
+        else:
+            keys = UniformGenerator(n_records, rng)
+        local = {op: [] for op in OPERATIONS}
+        for _ in range(n):
+            op = OPERATIONS[min(bisect.bisect_right(cumulative, rng.random() * cumulative[-1]), len(OPERATIONS) - 1)]
+            start = time.perf_counter()
+            if op == 'read':
+                db.get(COLLECTION, keys.next())
+            elif op == 'update':
+                db.put(COLLECTION, keys.next(), build_record(rng, n_fields, field_length))
+            elif op == 'insert':
+                db.put(COLLECTION, counter.next(), build_record(rng, n_fields, field_length))
+            elif op == 'scan':
+                first = keys.next()
+                db.aggregate(COLLECTION, [{'$match': {'_id': {'$in': list(range(first, first + rng.randint(1, max_scan_length)))}}}])
+            else:
+                key = keys.next()
+                record = dict(db.get(COLLECTION, key) or {})
+                record['field0'] = ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=field_length))
+                db.put(COLLECTION, key, record)
+            local[op].append(time.perf_counter() - start)
+        for op, values in local.items():
+            latencies[op].extend(values)
+
+    per_thread = [n_operations // n_threads + (1 if i < n_operations % n_threads else 0) for i in range(n_threads)]
+    threads = [threading.Thread(target=worker, args=(i, n)) for i, n in enumerate(per_thread)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    all_latencies = sorted(itertools.chain.from_iterable(latencies.values()))
+    percentile = lambda values, p: values[min(int(len(values) * p / 100), len(values) - 1)] * 1e6 if values else None
+    result = {
+        'workload': workload,
+        'ops': n_operations,
+        'ops/s': n_operations / elapsed,
+        'p50_us': percentile(all_latencies, 50),
+        'p99_us': percentile(all_latencies, 99)
+    }
+    for op, values in latencies.items():
+        if values:
+            result['%s_p99_us' % op] = percentile(sorted(values), 99)
+    return result
+
+def benchmark(workloads=('a', 'b', 'c', 'e'), configs=('plain', 'indexed', 'capped', 'sharded'), thread_counts=(1, 4), n_records=10000,
+              n_operations=20000, distribution='zipfian', n_fields=10, field_length=100, seed=0):
+    results = []
+    for config in configs:
+        for n_threads in thread_counts:
+            for workload in workloads:
+                db, release = make_db(config, n_records)
+                try:
+                    load(db, n_records, n_fields, field_length, seed)
+                    result = run_workload(db, workload, n_records, n_operations, n_threads, distribution, n_fields, field_length, seed=seed)
+                    result['config'] = config
+                    result['threads'] = n_threads
+                    result['memory_mb'] = db.stats()['bytes'] / 2 ** 20
+                    results.append(result)
+                finally:
+                    release()
+    columns = ['config', 'threads', 'workload', 'ops', 'ops/s', 'p50_us', 'p99_us', 'memory_mb']
+    frame = pd.DataFrame(results)
+    columns = [c for c in columns if c in frame.columns]
+    return frame[columns + [c for c in frame.columns if c not in columns]]
+
+def main():
+    parser = argparse.ArgumentParser(description='YCSB style benchmark of MangoDB')
+    parser.add_argument('--workloads', default='a,b,c,e', help='comma separated workloads among %s' % ','.join(WORKLOADS))
+    parser.add_argument('--configs', default='plain,indexed,capped,sharded', help='comma separated among plain,indexed,capped,sharded')
+    parser.add_argument('--threads', default='1,4', help='comma separated thread counts')
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--operations', type=int, default=20000)
+    parser.add_argument('--distribution', default='zipfian', choices=['zipfian', 'uniform'])
+    parser.add_argument('--fields', type=int, default=10)
+    parser.add_argument('--field-length', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = benchmark(workloads=args.workloads.split(','),
+                        configs=args.configs.split(','),
+                        thread_counts=[int(n) for n in args.threads.split(',')],
+                        n_records=args.records,
+                        n_operations=args.operations,
+                        distribution=args.distribution,
+                        n_fields=args.fields,
+                        field_length=args.field_length,
+                        seed=args.seed)
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:,.1f}'.format):
+        print(results)
+
+if __name__ == '__main__':
+    main()
@@ -2,58 +2,1542 @@
 NoSQL Database Implementation
 '''
 
-import csv, json, pandas as pd, requests, unittest, uuid
+import asyncio, collections, contextlib, csv, functools, io, itertools, json, math, multiprocessing, numbers, numpy as np, os, pandas as pd, pickle, random, requests, struct, sys, threading, time, types, unittest, uuid, zlib
+from multiprocessing import resource_tracker, shared_memory
+
+# Comparison operators understood by matches(), e.g. {'$gte': 90}
+OPERATORS = {
+    '$eq': lambda a, b: a == b,
+    '$ne': lambda a, b: a != b,
+    '$gt': lambda a, b: a is not None and a > b,
+    '$gte': lambda a, b: a is not None and a >= b,
+    '$lt': lambda a, b: a is not None and a < b,
+    '$lte': lambda a, b: a is not None and a <= b,
+    '$in': lambda a, b: a in b,
+    '$nin': lambda a, b: a not in b
+}
+
+# matches(value, condition) tests a stored value against a condition. A condition made of operators applies to the value itself, otherwise each entry
+# of the condition names a field of a dictionary value and gives either the expected value or an operator condition for it. None matches everything
+def matches(value, condition):
+    if condition is None:
+        return True
+    if not isinstance(condition, dict):
+        return value == condition
+    if condition and all(str(op).startswith('$') for op in condition):
+        return all(OPERATORS[op](value, arg) for op, arg in condition.items())
+    if not isinstance(value, dict):
+        return False
+    return all(matches(value.get(field), cond) for field, cond in condition.items())
+
+# Aggregation
+#
+# aggregate() turns every item of a collection into a record, {'_id': key, **value} for dictionary values and {'_id': key, 'value': value} otherwise,
+# and passes the records through a pipeline of stages. Group accumulators run as NumPy kernels over columns of at most BATCH_SIZE records.
+
+BATCH_SIZE = 65536
+
+_MISSING = object()
+
+def as_record(key, value):
+    if isinstance(value, dict):
+        return dict(value, _id=key)
+    return {'_id': key, 'value': value}
+
+# field_value(value, field) returns the field of a stored value as seen by aggregate(), None when it is absent
+def field_value(value, field):
+    if isinstance(value, dict):
+        return value.get(field)
+    return value if field == 'value' else None
+
+# candidate_keys(condition, content, indexes) uses the collection keys and secondary indexes to narrow a $match condition down to a set of keys,
+# or returns None when no field of the condition can be answered that way and the whole collection has to be scanned. A field is left to the scan
+# when its condition holds an unhashable value or when its index has skipped unhashable values, which no lookup in the index could find
+def candidate_keys(condition, content, indexes):
+    if not isinstance(condition, dict) or any(str(field).startswith('$') for field in condition):
+        return None
+    keys = None
+    for field, cond in condition.items():
+        try:
+            if field == '_id' and (not isinstance(cond, dict) or set(cond) <= {'$eq', '$in'}):
+                if not isinstance(cond, dict):
+                    found = {cond}
+                else:
+                    found = set(cond.get('$in', ()))
+                    if '$eq' in cond:
+                        found.add(cond['$eq'])
+                found = {key for key in found if key in content}
+            elif field in indexes and _UNINDEXED not in indexes[field]:
+                index = indexes[field]
+                if not isinstance(cond, dict):
+                    found = set(index.get(cond, ()))
+                else:
+                    found = set()
+                    for val, bucket in index.items():
+                        try:
+                            if matches(val, cond):
+                                found.update(bucket)
+                        except TypeError:
+                            continue
+            else:
+                continue
+        except TypeError:
+            # Unhashable condition value
+            continue
+        keys = found if keys is None else keys & found
+    return keys
+
+def _stage_match(records, condition):
+    return [record for record in records if matches(record, condition)]
+
+def _stage_project(records, spec):
+    include_id = spec.get('_id', 1)
+    fields = {field: rule for field, rule in spec.items() if field != '_id'}
+    if fields and all(rule in (0, False) for rule in fields.values()):
+        return [{field: val for field, val in record.items() if field not in fields and (include_id or field != '_id')} for record in records]
+    projected = []
+    for record in records:
+        out = {'_id': record.get('_id')} if include_id else {}
+        for field, rule in fields.items():
+            if isinstance(rule, str) and rule.startswith('$'):
+                out[field] = record.get(rule[1:])
+            elif rule and field in record:
+                out[field] = record[field]
+        projected.append(out)
+    return projected
+
+def _stage_sort(records, spec):
+    records = list(records)
+    for field, direction in reversed(list(spec.items())):
+        records.sort(key=lambda record: (record.get(field) is None, record.get(field)), reverse=direction < 0)
+    return records
+
+def _stage_limit(records, n):
+    return records[:n]
+
+# _group_column(batch, expression) evaluates an accumulator argument, '$field' or a constant, over a batch and returns the values with a mask of present ones
+def _group_column(batch, expression):
+    if isinstance(expression, str) and expression.startswith('$'):
+        values = [record.get(expression[1:]) for record in batch]
+    else:
+        values = [expression] * len(batch)
+    mask = np.fromiter((val is not None for val in values), dtype=bool, count=len(values))
+    present = [val for val in values if val is not None]
+    try:
+        column = np.array(present)
+    except ValueError:
+        column = None
+    if column is None or column.ndim != 1:
+        # Lists and other containers stay one object per record
+        column = np.empty(len(present), dtype=object)
+        column[:] = present
+    return column, mask
+
+def _stage_group(records, spec):
+    key_expression = spec.get('_id')
+    accumulators = {name: next(iter(acc.items())) for name, acc in spec.items() if name != '_id'}
+    group_ids = {}
+    sums, counts, mins, maxs, integral = {}, {}, {}, {}, {}
+
+    def grow(array, size, fill, dtype=float):
+        if array is None:
+            return np.full(size, fill, dtype=dtype)
+        if len(array) < size:
+            return np.concatenate([array, np.full(size - len(array), fill, dtype=array.dtype)])
+        return array
+
+    for start in range(0, len(records), BATCH_SIZE):
+        batch = records[start:start + BATCH_SIZE]
+        if isinstance(key_expression, str) and key_expression.startswith('$'):
+            keys = (record.get(key_expression[1:]) for record in batch)
+        else:
+            keys = itertools.repeat(key_expression, len(batch))
+        codes = np.fromiter((group_ids.setdefault(key, len(group_ids)) for key in keys), dtype=np.intp, count=len(batch))
+        n_groups = len(group_ids)
+        for name, (op, expression) in accumulators.items():
+            column, mask = _group_column(batch, expression)
+            if op != '$count' and column.dtype.kind not in 'iufb':
+                raise ValueError('%s accepts numeric values only, %s holds %s values' % (op, expression, column.dtype))
+            present = codes[mask]
+            integral[name] = integral.get(name, True) and column.dtype.kind in 'iub'
+            if op in ('$sum', '$avg', '$count'):
+                dtype = np.int64 if op == '$sum' and (column.dtype.kind in 'iub' or not len(column)) else float
+                total = sums.get(name)
+                if total is not None and np.result_type(total.dtype, dtype) != total.dtype:
+                    # Integer sums of earlier batches become floats once a batch holds floats
+                    total = total.astype(np.result_type(total.dtype, dtype))
+                sums[name] = grow(total, n_groups, 0, dtype)
+                counts[name] = grow(counts.get(name), n_groups, 0, np.int64)
+                if op != '$count':
+                    np.add.at(sums[name], present, column.astype(sums[name].dtype))
+                counts[name] += np.bincount(present, minlength=n_groups)
+            elif op == '$min':
+                mins[name] = grow(mins.get(name), n_groups, np.inf)
+                np.minimum.at(mins[name], present, column.astype(float))
+                counts[name] = grow(counts.get(name), n_groups, 0, np.int64)
+                counts[name] += np.bincount(present, minlength=n_groups)
+            elif op == '$max':
+                maxs[name] = grow(maxs.get(name), n_groups, -np.inf)
+                np.maximum.at(maxs[name], present, column.astype(float))
+                counts[name] = grow(counts.get(name), n_groups, 0, np.int64)
+                counts[name] += np.bincount(present, minlength=n_groups)
+            else:
+                raise ValueError('unknown accumulator %s' % op)
+
+    results = [{'_id': key} for key in group_ids]
+    for name, (op, expression) in accumulators.items():
+        count = grow(counts.get(name), len(group_ids), 0, np.int64)
+        if op == '$sum':
+            values = grow(sums.get(name), len(group_ids), 0).tolist()
+        elif op == '$count':
+            values = count.tolist()
+        elif op == '$avg':
+            total = grow(sums.get(name), len(group_ids), 0)
+            values = [t / c if c else None for t, c in zip(total.tolist(), count.tolist())]
+        else:
+            extreme = (mins if op == '$min' else maxs)[name]
+            cast = int if integral[name] else float
+            values = [cast(v) if c else None for v, c in zip(extreme.tolist(), count.tolist())]
+        for result, value in zip(results, values):
+            result[name] = value
+    return results
+
+STAGES = {
+    '$match': _stage_match,
+    '$project': _stage_project,
+    '$group': _stage_group,
+    '$sort': _stage_sort,
+    '$limit': _stage_limit
+}
+
+class ReadWriteLock:
+    # A lock that lets many readers in at once but only one writer. Waiting writers are served first so that a steady stream of readers cannot starve them
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    # read_locked() and write_locked() allow the lock to be used in a with statement
+    @contextlib.contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+# Persistent maps
+#
+# Collections and indexes are held in persistent maps: immutable mappings that share all but O(log n) of their nodes with the map they were derived
+# from, so that publishing the next version of a collection costs as much as the items written rather than the size of the collection. Keys are
+# placed in a trie branching 32 ways on successive 5 bit slices of their hash, whose leaves are small dicts split into a branch when they outgrow
+# LEAF_SIZE. Until then the root is a single leaf, so small collections keep their insertion order.
+
+LEAF_SIZE = 8
+
+_BRANCH_BITS = 5
+_BRANCH_WIDTH = 1 << _BRANCH_BITS
+_MAX_DEPTH = 64 // _BRANCH_BITS
+
+def _key_hash(key):
+    return hash(key) & 0xFFFFFFFFFFFFFFFF
+
+def _slot(h, depth):
+    return (h >> (depth * _BRANCH_BITS)) & (_BRANCH_WIDTH - 1)
+
+def _lookup(node, key, default):
+    h, depth = _key_hash(key), 0
+    while type(node) is list:
+        node = node[_slot(h, depth)]
+        if node is None:
+            return default
+        depth += 1
+    return node.get(key, default)
+
+def _iter_items(node):
+    if type(node) is dict:
+        yield from node.items()
+    else:
+        for child in node:
+            if child is not None:
+                yield from _iter_items(child)
+
+class _PersistentItemsView(collections.abc.ItemsView):
+    def __iter__(self):
+        return _iter_items(self._mapping._root)
+
+class PersistentMap(collections.abc.Mapping):
+    # PersistentMap(items) is an immutable mapping, set() and discard() return a modified copy and edit() a MapEditor to apply a batch of writes.
+    # The bytes taken by the nodes are counted as they are copied, so sys.getsizeof() of a map does not walk it
+    __slots__ = ('_root', '_len', '_nbytes')
+
+    def __init__(self, items=()):
+        self._root, self._len = {}, 0
+        self._nbytes = sys.getsizeof(self._root)
+        if items:
+            editor = MapEditor(self)
+            for key, value in (items.items() if isinstance(items, collections.abc.Mapping) else items):
+                editor[key] = value
+            self._root, self._len, self._nbytes = editor._root, editor._len, editor._nbytes
+
+    @classmethod
+    def _make(cls, root, length, nbytes):
+        pmap = cls.__new__(cls)
+        pmap._root, pmap._len, pmap._nbytes = root, length, nbytes
+        return pmap
+
+    def __getitem__(self, key):
+        value = _lookup(self._root, key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return _lookup(self._root, key, default)
+
+    def __contains__(self, key):
+        return _lookup(self._root, key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return (key for key, _ in _iter_items(self._root))
+
+    def items(self):
+        return _PersistentItemsView(self)
+
+    # The size of the nodes of the map, not of its keys and values
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self._nbytes
+
+    def __repr__(self):
+        return 'PersistentMap(%r)' % dict(self.items())
+
+    # sample(k, rng) returns about k (key, value) pairs drawn at random, with replacement, by descending from the root through random children. As the
+    # keys are spread by their hash the draws are close to uniform, at O(log n) each
+    def sample(self, k, rng=random):
+        if not self._len:
+            return []
+        drawn = []
+        for _ in range(k):
+            node = self._root
+            while type(node) is list:
+                node = rng.choice([child for child in node if child is not None])
+            drawn.append(rng.choice(list(node.items())))
+        return drawn
+
+    def edit(self):
+        return MapEditor(self)
+
+    def set(self, key, value):
+        editor = MapEditor(self)
+        editor[key] = value
+        return editor.finish()
+
+    def discard(self, key):
+        if key not in self:
+            return self
+        editor = MapEditor(self)
+        editor.pop(key)
+        return editor.finish()
+
+class MapEditor:
+    # MapEditor(persistent_map) applies a batch of writes to a persistent map with the dict interface. Each shared node on the path to a written key
+    # is copied once and the copy edited in place afterwards, finish() returns the resulting map and leaves the original untouched.
+    def __init__(self, base):
+        self._root = base._root
+        self._len = base._len
+        self._nbytes = base._nbytes
+        self._owned = set()
+
+    # _own(node) returns an editable copy of a node in place of the node, _new(node) takes a node built by the editor, _drop(node) a removed one
+    def _own(self, node):
+        if id(node) not in self._owned:
+            copy = dict(node) if type(node) is dict else list(node)
+            self._nbytes += sys.getsizeof(copy) - sys.getsizeof(node)
+            self._owned.add(id(copy))
+            return copy
+        return node
+
+    def _new(self, node):
+        self._nbytes += sys.getsizeof(node)
+        self._owned.add(id(node))
+        return node
+
+    def _drop(self, node):
+        self._nbytes -= sys.getsizeof(node)
+        self._owned.discard(id(node))
+
+    def __getitem__(self, key):
+        value = _lookup(self._root, key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return _lookup(self._root, key, default)
+
+    def __contains__(self, key):
+        return _lookup(self._root, key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return self._len
+
+    def __setitem__(self, key, value):
+        self._root = self._assoc(self._root, 0, _key_hash(key), key, value)
+
+    def _assoc(self, node, depth, h, key, value):
+        if type(node) is dict and key not in node and len(node) >= LEAF_SIZE and depth < _MAX_DEPTH:
+            self._drop(node)
+            branch = [None] * _BRANCH_WIDTH
+            for k, v in node.items():
+                i = _slot(_key_hash(k), depth)
+                if branch[i] is None:
+                    branch[i] = {}
+                branch[i][k] = v
+            for leaf in branch:
+                if leaf is not None:
+                    self._new(leaf)
+            node = self._new(branch)
+        node = self._own(node)
+        if type(node) is dict:
+            self._len += key not in node
+            before = sys.getsizeof(node)
+            node[key] = value
+            self._nbytes += sys.getsizeof(node) - before
+            return node
+        i = _slot(h, depth)
+        if node[i] is None:
+            self._len += 1
+            node[i] = self._new({key: value})
+        else:
+            node[i] = self._assoc(node[i], depth + 1, h, key, value)
+        return node
+
+    def pop(self, key, default=_MISSING):
+        self._root, value = self._dissoc(self._root, 0, _key_hash(key), key)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        self._len -= 1
+        return value
+
+    def _dissoc(self, node, depth, h, key):
+        if type(node) is dict:
+            if key not in node:
+                return node, _MISSING
+            node = self._own(node)
+            return node, node.pop(key)
+        i = _slot(h, depth)
+        if node[i] is None:
+            return node, _MISSING
+        child, value = self._dissoc(node[i], depth + 1, h, key)
+        if value is not _MISSING:
+            node = self._own(node)
+            if not child if type(child) is dict else not any(child):
+                self._drop(child)
+                child = None
+            node[i] = child
+        return node, value
+
+    def finish(self):
+        self._owned = set()
+        return PersistentMap._make(self._root, self._len, self._nbytes)
+
+EMPTY_MAP = PersistentMap()
+
+# Indexes map each value of a field to a bucket of the keys holding it, both persistent maps (buckets map the keys to None). Unhashable values
+# cannot be indexed, the keys holding them are kept in the bucket of _UNINDEXED so that lookups know the index is incomplete
+_UNINDEXED = object()
+
+def _index_add(index, value, key):
+    try:
+        index[value] = index.get(value, EMPTY_MAP).set(key, None)
+    except TypeError:
+        index[_UNINDEXED] = index.get(_UNINDEXED, EMPTY_MAP).set(key, None)
+
+def _index_discard(index, value, key):
+    try:
+        hash(value)
+    except TypeError:
+        value = _UNINDEXED
+    bucket = index.get(value, EMPTY_MAP).discard(key)
+    if bucket:
+        index[value] = bucket
+    else:
+        index.pop(value, None)
+
+# Expiry and capped collections
+
+class TimingWheel:
+    # A hashed timing wheel: deadlines are bucketed by tick of `resolution` seconds into n_slots slots, scheduling an item and expiring it are both O(1).
+    # Deadlines further away than one turn of the wheel stay in their slot and are passed over until the turn in which they fall due.
+    def __init__(self, resolution=1.0, n_slots=512, now=0.0):
+        self.resolution = resolution
+        self.slots = [[] for _ in range(n_slots)]
+        self._tick = math.floor(now / resolution)
+
+    def schedule(self, item, deadline):
+        tick = max(math.ceil(deadline / self.resolution), self._tick + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+
+    # due(now) tells whether advance(now) may have anything to expire
+    def due(self, now):
+        return math.floor(now / self.resolution) > self._tick
+
+    # advance(now) returns the items whose deadline has passed, visiting each slot at most once however long it has been since the last call
+    def advance(self, now):
+        current = math.floor(now / self.resolution)
+        expired = []
+        for tick in range(self._tick + 1, min(current, self._tick + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            pending = [(t, item) for t, item in slot if t > current]
+            if len(pending) != len(slot):
+                expired.extend(item for t, item in slot if t <= current)
+                slot[:] = pending
+        self._tick = max(current, self._tick)
+        return expired
+
+# approximate_size(key, value) estimates the bytes taken by an item from its pickled size
+def approximate_size(key, value):
+    try:
+        return len(pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(key) + sys.getsizeof(value)
+
+class Retention:
+    # Retention(ttl, max_items, max_bytes, now) tracks the expiry deadlines and insertion order of a collection. Writing a key again restarts its
+    # time to live and makes it the newest entry. Only the writer holding the collection lock touches it.
+    def __init__(self, ttl=None, max_items=None, max_bytes=None, now=0.0):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.deadlines = {}
+        self.order = collections.OrderedDict()
+        self.total_bytes = 0
+        self.wheel = TimingWheel(resolution=min(max(ttl / 64, 0.001), 1.0), now=now) if ttl else None
+
+    @property
+    def capped(self):
+        return bool(self.max_items or self.max_bytes)
+
+    def expired(self, key, now):
+        deadline = self.deadlines.get(key)
+        return deadline is not None and deadline <= now
+
+    def due(self, now):
+        return self.wheel is not None and self.wheel.due(now)
+
+    def track(self, key, value, now):
+        if self.wheel is not None:
+            deadline = now + self.ttl
+            self.deadlines[key] = deadline
+            self.wheel.schedule((key, deadline), deadline)
+        if self.capped:
+            self.total_bytes -= self.order.pop(key, 0)
+            self.order[key] = approximate_size(key, value) if self.max_bytes else 0
+            self.total_bytes += self.order[key]
+
+    def forget(self, key):
+        self.deadlines.pop(key, None)
+        self.total_bytes -= self.order.pop(key, 0)
+
+    # evictions(now) yields the keys that have expired, then the oldest keys until the collection is back within its caps
+    def evictions(self, now):
+        if self.wheel is not None:
+            for key, deadline in self.wheel.advance(now):
+                # Keys written again since being scheduled carry a newer deadline
+                if self.deadlines.get(key) == deadline:
+                    self.forget(key)
+                    yield key
+        while self.order and ((self.max_items and len(self.order) > self.max_items) or
+                              (self.max_bytes and self.total_bytes > self.max_bytes)):
+            key = next(iter(self.order))
+            self.forget(key)
+            yield key
+
+# Statistics
+
+STATS_SAMPLE_SIZE = 100
+
+# deep_sizeof(obj) returns the memory taken by an object and everything it contains, counting shared objects once
+def deep_sizeof(obj, seen=None):
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+# index_bytes(index) estimates the memory taken by an index from its nodes and a sample of its buckets
+def index_bytes(index):
+    sample = index.sample(STATS_SAMPLE_SIZE)
+    bucket_bytes = sum(sys.getsizeof(bucket) for value, bucket in sample) / len(sample) if sample else 0
+    return int(sys.getsizeof(index) + bucket_bytes * len(index))
+
+class LatencyHistogram:
+    # Counts latencies in power of two buckets of microseconds, bucket n holds latencies up to 2**n us
+    def __init__(self):
+        self.counts = [0] * 32
+
+    def record(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), 31)] += 1
+
+    # percentile(p) returns the upper bound in microseconds of the bucket holding the p-th percentile
+    def percentile(self, p):
+        total = sum(self.counts)
+        if not total:
+            return None
+        running = 0
+        for bucket, count in enumerate(self.counts):
+            running += count
+            if running >= total * p / 100:
+                return 2 ** bucket
+        return 2 ** (len(self.counts) - 1)
+
+    def to_dict(self):
+        return {2 ** bucket: count for bucket, count in enumerate(self.counts) if count}
+
+class CollectionStats:
+    # Operation counters of a collection, updated on every instrumented call
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+        self.evictions = 0
+        self.read_latency = LatencyHistogram()
+        self.write_latency = LatencyHistogram()
+
+    def record(self, kind, seconds):
+        with self.lock:
+            if kind == 'read':
+                self.reads += 1
+                self.read_latency.record(seconds)
+            else:
+                self.writes += 1
+                self.write_latency.record(seconds)
+
+# instrumented(kind) times a MangoDB method taking a collection name first and records it as a 'read' or a 'write' of that collection
+def instrumented(kind):
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, collection_name, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(self, collection_name, *args, **kwargs)
+            finally:
+                stats = self._stats.get(collection_name)
+                if stats is not None:
+                    stats.record(kind, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+# Change streams
+#
+# Every write is recorded in a ChangeLog, a ring buffer of change events numbered by a sequence number. A ChangeStream returned by watch() reads the
+# events following its resume token, the sequence number of the last event it has consumed, which can be handed to a later watch() to carry on.
+
+class ChangeStreamHistoryLost(Exception):
+    pass
+
+class ChangeLog:
+    # ChangeLog(capacity) keeps the last capacity change events, i.e. {'seq': 7, 'op': 'update', 'collection': 'temperatures', 'key': 1, 'value': 50}
+    # where op is one of 'create', 'update', 'delete', 'evict', 'drop' or 'wipe'
+    def __init__(self, capacity=10000):
+        self.events = collections.deque(maxlen=capacity)
+        self.last_seq = 0
+        self.cond = threading.Condition()
+        self._async_waiters = []
+
+    def append(self, changes):
+        with self.cond:
+            for op, collection_name, key, value in changes:
+                self.last_seq += 1
+                self.events.append({'seq': self.last_seq, 'op': op, 'collection': collection_name, 'key': key, 'value': value})
+            self.cond.notify_all()
+        self.wake_async()
+
+    # wake_async() resolves the futures of every pending wait_async(), whose streams then check for new events or for having been closed
+    def wake_async(self):
+        with self.cond:
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            # The consumer may have gone away, a dead consumer must never fail the writer that woke it
+            if future.done() or loop.is_closed():
+                continue
+            try:
+                loop.call_soon_threadsafe(_resolve_waiter, future)
+            except RuntimeError:
+                # Closed after the check above
+                pass
+
+    # read_after(seq) returns the buffered events following seq, raising ChangeStreamHistoryLost if some of them have already been overwritten
+    def read_after(self, seq):
+        with self.cond:
+            first = self.last_seq - len(self.events) + 1
+            if seq + 1 < first:
+                raise ChangeStreamHistoryLost('events after %d are no longer buffered, the oldest is %d' % (seq, first))
+            return list(itertools.islice(self.events, seq + 1 - first, None))
+
+    # wait_async(seq, loop) returns a future resolved once an event following seq has been appended
+    def wait_async(self, seq, loop):
+        future = loop.create_future()
+        with self.cond:
+            if self.last_seq > seq:
+                future.set_result(None)
+            else:
+                self._async_waiters.append((loop, future))
+        return future
+
+def _resolve_waiter(future):
+    if not future.done():
+        future.set_result(None)
+
+class ChangeStream:
+    # ChangeStream(log, collection_name, condition, resume_after) iterates the change events of one collection (every collection when None) matching
+    # a condition on the event (see matches()), e.g. {'op': 'update', 'value': {'$gte': 90}}. Both blocking and async iteration are supported.
+    def __init__(self, log, collection_name=None, condition=None, resume_after=None):
+        self._log = log
+        self.collection_name = collection_name
+        self.condition = condition
+        self._position = log.last_seq if resume_after is None else resume_after
+        self.resume_token = self._position
+        self._pending = collections.deque()
+        self.closed = False
+        # Fail straight away rather than on the first read when resuming too far back
+        log.read_after(self._position)
+
+    def _wanted(self, event):
+        if self.collection_name is not None and event['collection'] not in (self.collection_name, None):
+            return False
+        return matches(event, self.condition)
+
+    def _fill(self):
+        for event in self._log.read_after(self._position):
+            self._position = event['seq']
+            if self._wanted(event):
+                self._pending.append(event)
+        if not self._pending:
+            self.resume_token = self._position
+
+    def _deliver(self):
+        event = self._pending.popleft()
+        self.resume_token = event['seq'] if self._pending else self._position
+        return event
+
+    # next(timeout=None) returns the next matching event, waiting up to timeout seconds for one, or None if none arrived in time
+    def next(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.closed:
+            self._fill()
+            if self._pending:
+                return self._deliver()
+            with self._log.cond:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._log.cond.wait_for(lambda: self._log.last_seq > self._position, remaining)
+        return None
+
+    def close(self):
+        self.closed = True
+        with self._log.cond:
+            self._log.cond.notify_all()
+        self._log.wake_async()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        event = self.next()
+        if event is None:
+            raise StopIteration
+        return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            self._fill()
+            if self._pending:
+                return self._deliver()
+            await self._log.wait_async(self._position, loop)
+        raise StopAsyncIteration
 
 class MangoDB:
+    # Collections are copy-on-write: a published collection is a PersistentMap, writers derive the next version from it and swap it in.
+    # Readers take a snapshot of the current versions and iterate it without holding any lock, so they never block writers.
+    # Writers to the same collection are serialized by that collection's ReadWriteLock, the catalog lock only guards the short swap itself.
+    # Expired items are purged by the next write to their collection or by expire(), which snapshot() runs whenever a deadline has passed.
+
+    # clock() gives the time used for time-to-live deadlines
+    clock = staticmethod(time.monotonic)
+
+    # Number of change events kept for watch()
+    change_log_size = 10000
+
     # The MangoDB class should create only the default collection, as shown, on instantiation including a randomly generated uuid using the uuid4()
     def __init__(self):
+        self._catalog_lock = ReadWriteLock()
+        self._change_log = ChangeLog(self.change_log_size)
+        self._reset()
+
+    def _reset(self):
         self.collections = {}
-        self.collections['default'] = { 'version': 1.0,
-                                        'db': 'mangodb',
-                                        'uuid': str(uuid.uuid4())
-                                        }
+        self._locks = {}
+        self._versions = {}
+        self._indexes = {}
+        self._retention = {}
+        self._stats = {}
+        self._publish('default', PersistentMap({ 'version': 1.0,
+                                                 'db': 'mangodb',
+                                                 'uuid': str(uuid.uuid4())
+                                                 }))
+
+    # _publish(collection_name, content, indexes) installs a new version of a collection and its indexes, the caller must hold the catalog write lock
+    def _publish(self, collection_name, content, indexes=None):
+        self.collections[collection_name] = content
+        self._indexes[collection_name] = indexes if indexes is not None else {}
+        self._locks.setdefault(collection_name, ReadWriteLock())
+        self._stats.setdefault(collection_name, CollectionStats())
+        self._versions[collection_name] = self._versions.get(collection_name, 0) + 1
+
+    # snapshot(collection_name=None) returns a read-only view of a collection, or of the whole catalog when no name is given, as of the time of the call
+    def snapshot(self, collection_name=None):
+        self.expire(collection_name)
+        with self._catalog_lock.read_locked():
+            if collection_name is None:
+                return types.MappingProxyType(dict(self.collections))
+            return types.MappingProxyType(self.collections[collection_name])
+
+    # get_collection_version(collection_name) returns the version number of a collection, incremented on every write
+    def get_collection_version(self, collection_name):
+        with self._catalog_lock.read_locked():
+            return self._versions[collection_name]
 
     # display_all_collections() which iterates through every collection and prints to screen each collection names and the collection's content underneath and may look something like:
     def display_all_collections(self):
-        for collection, content in self.collections.items():
+        for collection, content in self.snapshot().items():
             print('collection: ' + collection)
             for key, val in content.items():
                 print('     %s: %s' % (key, val))
 
     # add_collection(collection_name) allows the caller to add a new collection by providing a name. The collection will be empty but will have a name.
-    def add_collection(self, collection_name):
-        self.collections[collection_name] = {}
+    # Items of a collection added with a ttl (in seconds) expire that long after they were last written, a collection capped with max_items and/or
+    # max_bytes evicts its oldest items once it grows beyond them.
+    def add_collection(self, collection_name, ttl=None, max_items=None, max_bytes=None):
+        with self._catalog_lock.write_locked():
+            self._publish(collection_name, EMPTY_MAP)
+            self._change_log.append([('create', collection_name, None, None)])
+            if ttl or max_items or max_bytes:
+                self._retention[collection_name] = Retention(ttl, max_items, max_bytes, now=self.clock())
+            else:
+                self._retention.pop(collection_name, None)
 
     # update_collection(collection_name,updates) allows the caller to insert new items into a collection i.e.
+    @instrumented('write')
     def update_collection(self, collection_name, updates):
-        for key, val in updates.items():
-            self.collections[collection_name][key] = val
+        self._write(collection_name, updates.items())
+
+    # delete(collection_name, *keys) removes items from a collection, keys that are not present are ignored
+    @instrumented('write')
+    def delete(self, collection_name, *keys):
+        self._write(collection_name, deletes=keys)
+
+    # _write(collection_name, updates, deletes) builds and publishes the next version of a collection, applying its retention policy on the way
+    def _write(self, collection_name, updates=(), deletes=()):
+        with self._catalog_lock.read_locked():
+            lock = self._locks[collection_name]
+        with lock.write_locked():
+            with self._catalog_lock.read_locked():
+                content = self.collections[collection_name].edit()
+                indexes = {field: index.edit() for field, index in self._indexes[collection_name].items()}
+                retention = self._retention.get(collection_name)
+            now = self.clock()
+            changes = []
+
+            def drop(key, op):
+                old = content.pop(key, _MISSING)
+                if old is not _MISSING:
+                    changes.append((op, collection_name, key, None))
+                    for field, index in indexes.items():
+                        _index_discard(index, field_value(old, field), key)
+
+            for key, val in updates:
+                old = content.get(key, _MISSING)
+                content[key] = val
+                changes.append(('update', collection_name, key, val))
+                for field, index in indexes.items():
+                    if old is not _MISSING:
+                        _index_discard(index, field_value(old, field), key)
+                    _index_add(index, field_value(val, field), key)
+                if retention is not None:
+                    retention.track(key, val, now)
+            for key in deletes:
+                drop(key, 'delete')
+                if retention is not None:
+                    retention.forget(key)
+            if retention is not None:
+                evicted = 0
+                for key in retention.evictions(now):
+                    drop(key, 'evict')
+                    evicted += 1
+                if evicted:
+                    with self._stats[collection_name].lock:
+                        self._stats[collection_name].evictions += evicted
+            if not changes:
+                # Nothing was written or expired, i.e. expire() on a wheel tick without deadlines, the current version stands
+                return
+            with self._catalog_lock.write_locked():
+                # The collection may have been removed while the new version was being built
+                if self._locks.get(collection_name) is lock:
+                    self._publish(collection_name, content.finish(), {field: index.finish() for field, index in indexes.items()})
+                    self._change_log.append(changes)
+
+    # expire(collection_name=None) purges the expired items of a collection, or of every collection, it is cheap when nothing has fallen due
+    def expire(self, collection_name=None):
+        now = self.clock()
+        with self._catalog_lock.read_locked():
+            if collection_name is None:
+                due = [name for name, retention in self._retention.items() if retention.due(now)]
+            else:
+                retention = self._retention.get(collection_name)
+                due = [collection_name] if retention is not None and retention.due(now) else []
+        for name in due:
+            try:
+                self._write(name)
+            except KeyError:
+                # Removed in the meantime
+                pass
 
     # remove_collection() allows caller to delete a specific collection by name and its associated data
     def remove_collection(self, collection_name):
-        del(self.collections[collection_name])
+        with self._catalog_lock.write_locked():
+            del(self.collections[collection_name])
+            del(self._locks[collection_name])
+            del(self._versions[collection_name])
+            del(self._indexes[collection_name])
+            self._retention.pop(collection_name, None)
+            self._stats.pop(collection_name, None)
+            self._change_log.append([('drop', collection_name, None, None)])
 
     # list_collections() displays a list of all the collections
     def list_collections(self):
-        print(self.collections.keys())
+        print(self.snapshot().keys())
 
     # get_collection_size(collection_name) finds the number of key/value pairs in a given collection
+    @instrumented('read')
     def get_collection_size(self, collection_name):
-        return len(self.collections[collection_name])
+        return len(self.snapshot(collection_name))
 
     # to_json(collection_name) that converts the collection to a JSON string
+    @instrumented('read')
     def to_json(self, collection_name):
-        return json.dumps(self.collections[collection_name])
+        return json.dumps(dict(self.snapshot(collection_name)))
 
     # wipe() that cleans out the db and resets it with just a default collection
     def wipe(self):
-        del[self.collections]
-        #self.collections = self.__init__()
-        self.__init__()
+        with self._catalog_lock.write_locked():
+            self._reset()
+            self._change_log.append([('wipe', None, None, None)])
 
     # get_collection_names() that returns a list of collection names
     def get_collection_names(self):
-        return self.collections.keys()
+        return self.snapshot().keys()
+
+    # watch(collection_name=None, condition=None, resume_after=None) returns a ChangeStream of the writes made from now on, or from just after the
+    # resume token of an earlier stream
+    # i.e.
+    #     for change in db.watch('temperatures', {'op': 'update'}):
+    #         cache[change['key']] = change['value']
+    def watch(self, collection_name=None, condition=None, resume_after=None):
+        return ChangeStream(self._change_log, collection_name, condition, resume_after)
+
+    # get(collection_name, key, default=None) returns the value stored under a key in a collection
+    @instrumented('read')
+    def get(self, collection_name, key, default=None):
+        retention = self._retention.get(collection_name)
+        if retention is not None and retention.expired(key, self.clock()):
+            return default
+        return self.snapshot(collection_name).get(key, default)
+
+    # put(collection_name, key, value) inserts or replaces a single item in a collection
+    def put(self, collection_name, key, value):
+        self.update_collection(collection_name, {key: value})
+
+    # find(collection_name, condition=None) returns the items of a collection whose value satisfies the condition (see matches())
+    @instrumented('read')
+    def find(self, collection_name, condition=None):
+        return {key: val for key, val in self.snapshot(collection_name).items() if matches(val, condition)}
+
+    # create_index(collection_name, field) builds a secondary index mapping each value of a field to the keys holding it, kept up to date on every update
+    def create_index(self, collection_name, field):
+        with self._catalog_lock.read_locked():
+            lock = self._locks[collection_name]
+        with lock.write_locked():
+            index = EMPTY_MAP.edit()
+            with self._catalog_lock.read_locked():
+                content = self.collections[collection_name]
+            for key, val in content.items():
+                _index_add(index, field_value(val, field), key)
+            with self._catalog_lock.write_locked():
+                if self._locks.get(collection_name) is lock:
+                    self._indexes[collection_name] = dict(self._indexes[collection_name], **{field: index.finish()})
+
+    # list_indexes(collection_name) returns the indexed fields of a collection
+    def list_indexes(self, collection_name):
+        with self._catalog_lock.read_locked():
+            return list(self._indexes[collection_name])
+
+    # aggregate(collection_name, pipeline) runs a list of $match, $project, $group, $sort and $limit stages over a collection and returns the resulting records
+    # i.e.
+    #     db.aggregate('testscores', [{'$match': {'value': {'$gte': 80}}}, {'$group': {'_id': None, 'avg': {'$avg': '$value'}}}])
+    # A leading $match is answered from the collection keys and secondary indexes where possible instead of scanning every item
+    @instrumented('read')
+    def aggregate(self, collection_name, pipeline):
+        self.expire(collection_name)
+        with self._catalog_lock.read_locked():
+            content = self.collections[collection_name]
+            indexes = self._indexes[collection_name]
+        pipeline = list(pipeline)
+        keys = None
+        if pipeline and '$match' in pipeline[0]:
+            keys = candidate_keys(pipeline[0]['$match'], content, indexes)
+        if keys is None:
+            records = [as_record(key, val) for key, val in content.items()]
+        else:
+            records = [as_record(key, content[key]) for key in keys]
+        for stage in pipeline:
+            (op, spec), = stage.items()
+            if op not in STAGES:
+                raise ValueError('unknown pipeline stage %s' % op)
+            records = STAGES[op](records, spec)
+        return records
+
+    # collection_stats(collection_name) reports the size of a collection, estimated in bytes from a sample of its items, its operation counts and
+    # latency percentiles (in microseconds) and the size of each of its indexes
+    def collection_stats(self, collection_name):
+        self.expire(collection_name)
+        with self._catalog_lock.read_locked():
+            content = self.collections[collection_name]
+            indexes = self._indexes[collection_name]
+            stats = self._stats[collection_name]
+            version = self._versions[collection_name]
+        sample = content.sample(STATS_SAMPLE_SIZE)
+        item_bytes = sum(deep_sizeof(key) + deep_sizeof(val) for key, val in sample) / len(sample) if sample else 0
+        with stats.lock:
+            return {
+                'items': len(content),
+                'bytes': int(sys.getsizeof(content) + item_bytes * len(content)),
+                'version': version,
+                'reads': stats.reads,
+                'writes': stats.writes,
+                'evictions': stats.evictions,
+                'read_latency_us': {'p50': stats.read_latency.percentile(50), 'p99': stats.read_latency.percentile(99),
+                                    'histogram': stats.read_latency.to_dict()},
+                'write_latency_us': {'p50': stats.write_latency.percentile(50), 'p99': stats.write_latency.percentile(99),
+                                     'histogram': stats.write_latency.to_dict()},
+                'indexes': {field: {'entries': len(index) - (_UNINDEXED in index), 'bytes': index_bytes(index)}
+                            for field, index in indexes.items()}
+            }
+
+    # stats() reports collection_stats() for every collection along with totals for the whole db
+    def stats(self):
+        per_collection = {}
+        for collection_name in list(self.get_collection_names()):
+            try:
+                per_collection[collection_name] = self.collection_stats(collection_name)
+            except KeyError:
+                # Removed in the meantime
+                continue
+        return {
+            'collections': per_collection,
+            'items': sum(c['items'] for c in per_collection.values()),
+            'bytes': sum(c['bytes'] + sum(i['bytes'] for i in c['indexes'].values()) for c in per_collection.values()),
+            'reads': sum(c['reads'] for c in per_collection.values()),
+            'writes': sum(c['writes'] for c in per_collection.values())
+        }
+
+# Network front-end
+#
+# Every message is a frame made of an 8 byte header (payload length, request id) followed by a compact JSON payload. Requests carry [op, args] and
+# responses [ok, result] under the id of the request they answer, so a client can pipeline many requests on one connection without waiting.
+# Collections travel as lists of [key, value] pairs rather than JSON objects so that non-string keys survive the round trip.
+
+FRAME_HEADER = struct.Struct('!II')
+
+class MangoRemoteError(Exception):
+    pass
+
+def encode_frame(request_id, payload):
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return FRAME_HEADER.pack(len(body), request_id) + body
+
+async def read_frame(reader):
+    length, request_id = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    return request_id, json.loads(await reader.readexactly(length))
+
+class MangoServer:
+    # MangoServer(db, host, port) serves a MangoDB instance over TCP, port 0 picks a free port which is available as server.port once started
+    def __init__(self, db, host='127.0.0.1', port=27027):
+        self.db = db
+        self.host = host
+        self.port = port
+        self._server = None
+        self._ops = {
+            'get': db.get,
+            'get_many': self._get_many,
+            'put': db.put,
+            'update': lambda c, items: db.update_collection(c, dict(items)),
+            'find': lambda c, condition=None: list(map(list, db.find(c, condition).items())),
+            'size': db.get_collection_size,
+            'names': lambda: list(db.get_collection_names()),
+            'add': db.add_collection,
+            'remove': db.remove_collection
+        }
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _get_many(self, collection_name, keys):
+        content = self.db.snapshot(collection_name)
+        return [[key, content[key]] for key in keys if key in content]
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                request_id, (op, args) = await read_frame(reader)
+                try:
+                    # Database calls take locks and may scan whole collections, they run on the default executor to keep the loop serving
+                    response = [True, await loop.run_in_executor(None, functools.partial(self._ops[op], *args))]
+                except Exception as e:
+                    response = [False, '%s: %s' % (type(e).__name__, e)]
+                writer.write(encode_frame(request_id, response))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+class _MangoConnection:
+    # A single client connection, responses are matched to waiting requests by request id
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    async def request(self, op, args):
+        request_id = next(self._ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(encode_frame(request_id, [op, args]))
+        await self._writer.drain()
+        ok, result = await future
+        if not ok:
+            raise MangoRemoteError(result)
+        return result
+
+    async def _receive(self):
+        try:
+            while True:
+                request_id, response = await read_frame(self._reader)
+                future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('connection to MangoServer closed'))
+            self._pending.clear()
+
+    async def close(self):
+        self._writer.close()
+        await self._receiver
+
+class MangoClient:
+    # MangoClient(host, port, pool_size) holds a pool of connections to a MangoServer, requests are spread over the pool round robin and may be pipelined
+    # i.e.
+    #     async with MangoClient(port=server.port) as client:
+    #         await client.put('temperatures', 1, 50)
+    #         await asyncio.gather(*(client.get('temperatures', k) for k in range(100)))
+    def __init__(self, host='127.0.0.1', port=27027, pool_size=4):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self._connections = []
+        self._robin = itertools.count()
+
+    async def connect(self):
+        for _ in range(self.pool_size):
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            self._connections.append(_MangoConnection(reader, writer))
+        return self
+
+    async def close(self):
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            await connection.close()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def request(self, op, *args):
+        if not self._connections:
+            raise MangoRemoteError('not connected, call connect() or use the client in an async with statement')
+        connection = self._connections[next(self._robin) % len(self._connections)]
+        return await connection.request(op, list(args))
+
+    async def get(self, collection_name, key):
+        return await self.request('get', collection_name, key)
+
+    async def get_many(self, collection_name, keys):
+        return dict(await self.request('get_many', collection_name, list(keys)))
+
+    async def put(self, collection_name, key, value):
+        await self.request('put', collection_name, key, value)
+
+    async def update_collection(self, collection_name, updates):
+        await self.request('update', collection_name, list(map(list, updates.items())))
+
+    async def find(self, collection_name, condition=None):
+        return dict(await self.request('find', collection_name, condition))
+
+    async def get_collection_size(self, collection_name):
+        return await self.request('size', collection_name)
+
+    async def get_collection_names(self):
+        return await self.request('names')
+
+    async def add_collection(self, collection_name):
+        await self.request('add', collection_name)
+
+    async def remove_collection(self, collection_name):
+        await self.request('remove', collection_name)
+
+# Sharding
+#
+# ShardedMangoDB partitions every collection by a hash of the key across worker processes, each holding a plain MangoDB. Single key operations go to
+# the owning shard, scans and aggregations are scattered to every shard and gathered in the calling process. Messages larger than SHM_THRESHOLD
+# bytes are passed through a shared memory block instead of being copied through the pipe, the receiving side unlinks the block once read.
+
+SHM_THRESHOLD = 1 << 16
+
+# Stages that can run on each shard independently before the results are gathered
+SHARD_LOCAL_STAGES = ('$match', '$project')
+
+def _send_message(conn, message):
+    blob = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(blob) < SHM_THRESHOLD:
+        conn.send(('inline', blob))
+        return
+    shm = shared_memory.SharedMemory(create=True, size=len(blob))
+    shm.buf[:len(blob)] = blob
+    conn.send(('shm', shm.name, len(blob)))
+    shm.close()
+
+def _recv_message(conn):
+    envelope = conn.recv()
+    if envelope[0] == 'inline':
+        return pickle.loads(envelope[1])
+    shm = shared_memory.SharedMemory(name=envelope[1])
+    try:
+        with shm.buf[:envelope[2]] as view:
+            return pickle.loads(view)
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _shard_worker(conn):
+    db = MangoDB()
+    db.remove_collection('default')
+
+    def wipe():
+        db.wipe()
+        db.remove_collection('default')
+
+    ops = {
+        'add': db.add_collection,
+        'remove': db.remove_collection,
+        'update': db.update_collection,
+        'delete': db.delete,
+        'get': db.get,
+        'size': db.get_collection_size,
+        'names': lambda: list(db.get_collection_names()),
+        'items': lambda c: dict(db.snapshot(c)),
+        'find': db.find,
+        'create_index': db.create_index,
+        'aggregate': db.aggregate,
+        'stats': db.stats,
+        'wipe': wipe
+    }
+    while True:
+        message = _recv_message(conn)
+        if message is None:
+            break
+        op, args = message
+        try:
+            response = ('ok', ops[op](*args))
+        except Exception as e:
+            response = ('error', e)
+        _send_message(conn, response)
+    conn.close()
+
+# _canonical_key(key) maps the numbers that compare equal, and so are the same dictionary key, to one form: integral values to int and other reals to
+# float when exact, inside tuples as well
+def _canonical_key(key):
+    if isinstance(key, numbers.Integral):
+        return int(key)
+    if isinstance(key, numbers.Real):
+        as_float = float(key)
+        if as_float != key:
+            return key
+        return int(as_float) if as_float.is_integer() else as_float
+    if isinstance(key, tuple):
+        return tuple(_canonical_key(k) for k in key)
+    return key
+
+class ShardedMangoDB:
+    # ShardedMangoDB(n_shards) offers the MangoDB interface over n_shards worker processes, one per CPU by default. Call close() (or use it in a with
+    # statement) to stop the workers. The default collection is sharded like any other one.
+    def __init__(self, n_shards=None):
+        self.n_shards = n_shards or os.cpu_count() or 1
+        self._conns = []
+        self._locks = []
+        self._processes = []
+        # Both creating and attaching to a shared memory block register it with the resource tracker of the process, and unlinking it unregisters it.
+        # Starting the tracker before forking makes the workers share the parent's, so a block created by one side and unlinked by the other is
+        # unregistered from the tracker that registered it instead of being reported as leaked, and unlinked a second time, when a worker exits
+        resource_tracker.ensure_running()
+        for _ in range(self.n_shards):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(child_conn,), daemon=True)
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._locks.append(threading.Lock())
+            self._processes.append(process)
+        self._add_default()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for conn, lock in zip(self._conns, self._locks):
+            with lock:
+                _send_message(conn, None)
+                conn.close()
+        for process in self._processes:
+            process.join()
+        self._conns = []
+
+    def _add_default(self):
+        self.add_collection('default')
+        self.update_collection('default', { 'version': 1.0,
+                                            'db': 'mangodb',
+                                            'uuid': str(uuid.uuid4())
+                                            })
+
+    # shard_for(key) returns the index of the shard owning a key, keys that are equal as dictionary keys (1, 1.0 and True) share a shard
+    def shard_for(self, key):
+        return zlib.crc32(pickle.dumps(_canonical_key(key), protocol=4)) % self.n_shards
+
+    # _scatter(messages) sends {shard: (op, args)} to every listed shard before waiting on any of them, so the shards work in parallel
+    def _scatter(self, messages):
+        shards = sorted(messages)
+        for shard in shards:
+            self._locks[shard].acquire()
+        try:
+            for shard in shards:
+                _send_message(self._conns[shard], messages[shard])
+            responses = {shard: _recv_message(self._conns[shard]) for shard in shards}
+        finally:
+            for shard in shards:
+                self._locks[shard].release()
+        for status, result in responses.values():
+            if status == 'error':
+                raise result
+        return {shard: result for shard, (status, result) in responses.items()}
+
+    def _broadcast(self, op, *args):
+        return self._scatter({shard: (op, args) for shard in range(self.n_shards)})
+
+    def _route(self, key, op, *args):
+        shard = self.shard_for(key)
+        return self._scatter({shard: (op, args)})[shard]
+
+    # snapshot(collection_name=None) gathers a collection, or the whole catalog, from every shard
+    def snapshot(self, collection_name=None):
+        if collection_name is None:
+            return types.MappingProxyType({name: dict(self.snapshot(name)) for name in self.get_collection_names()})
+        content = {}
+        for part in self._broadcast('items', collection_name).values():
+            content.update(part)
+        return types.MappingProxyType(content)
+
+    def display_all_collections(self):
+        for collection, content in self.snapshot().items():
+            print('collection: ' + collection)
+            for key, val in content.items():
+                print('     %s: %s' % (key, val))
+
+    # Caps are split evenly between the shards, so eviction order is only approximately oldest first across the whole collection
+    def add_collection(self, collection_name, ttl=None, max_items=None, max_bytes=None):
+        per_shard = lambda cap: cap and max(1, -(-cap // self.n_shards))
+        self._broadcast('add', collection_name, ttl, per_shard(max_items), per_shard(max_bytes))
+
+    # update_collection(collection_name, updates) splits the updates by owning shard and applies every part in parallel
+    def update_collection(self, collection_name, updates):
+        parts = {}
+        for key, val in updates.items():
+            parts.setdefault(self.shard_for(key), {})[key] = val
+        if not parts:
+            # Still fail on an unknown collection like MangoDB does
+            parts = {0: {}}
+        self._scatter({shard: ('update', (collection_name, part)) for shard, part in parts.items()})
+
+    def remove_collection(self, collection_name):
+        self._broadcast('remove', collection_name)
+
+    def list_collections(self):
+        print(self.get_collection_names())
+
+    def get_collection_size(self, collection_name):
+        return sum(self._broadcast('size', collection_name).values())
+
+    def to_json(self, collection_name):
+        return json.dumps(dict(self.snapshot(collection_name)))
+
+    def wipe(self):
+        self._broadcast('wipe')
+        self._add_default()
+
+    # All shards hold every collection, so the first shard knows every name
+    def get_collection_names(self):
+        return self._scatter({0: ('names', ())})[0]
+
+    def get(self, collection_name, key, default=None):
+        return self._route(key, 'get', collection_name, key, default)
+
+    def put(self, collection_name, key, value):
+        self._route(key, 'update', collection_name, {key: value})
+
+    def delete(self, collection_name, *keys):
+        parts = {}
+        for key in keys:
+            parts.setdefault(self.shard_for(key), []).append(key)
+        self._scatter({shard: ('delete', (collection_name, *part)) for shard, part in (parts or {0: []}).items()})
+
+    def find(self, collection_name, condition=None):
+        found = {}
+        for part in self._broadcast('find', collection_name, condition).values():
+            found.update(part)
+        return found
+
+    def create_index(self, collection_name, field):
+        self._broadcast('create_index', collection_name, field)
+
+    # stats() adds up the stats() of every shard, reporting the items and bytes (including indexes) of each collection
+    def stats(self):
+        shards = list(self._broadcast('stats').values())
+        per_collection = {}
+        for shard in shards:
+            for collection_name, c in shard['collections'].items():
+                totals = per_collection.setdefault(collection_name, {'items': 0, 'bytes': 0})
+                totals['items'] += c['items']
+                totals['bytes'] += c['bytes'] + sum(i['bytes'] for i in c['indexes'].values())
+        return {
+            'collections': per_collection,
+            'items': sum(shard['items'] for shard in shards),
+            'bytes': sum(shard['bytes'] for shard in shards),
+            'reads': sum(shard['reads'] for shard in shards),
+            'writes': sum(shard['writes'] for shard in shards)
+        }
+
+    # aggregate(collection_name, pipeline) runs the leading $match/$project stages on every shard, along with a $sort/$limit pair right after them,
+    # and the rest of the pipeline on the gathered records
+    def aggregate(self, collection_name, pipeline):
+        pipeline = list(pipeline)
+        split = 0
+        while split < len(pipeline) and next(iter(pipeline[split])) in SHARD_LOCAL_STAGES:
+            split += 1
+        local = pipeline[:split]
+        if [next(iter(stage)) for stage in pipeline[split:split + 2]] == ['$sort', '$limit']:
+            # Each shard only needs to return its own top records
+            local = pipeline[:split + 2]
+        records = []
+        for part in self._broadcast('aggregate', collection_name, local).values():
+            records.extend(part)
+        for stage in pipeline[split:]:
+            (op, spec), = stage.items()
+            if op not in STAGES:
+                raise ValueError('unknown pipeline stage %s' % op)
+            records = STAGES[op](records, spec)
+        return records
 
 def db_test():
     '''
@@ -124,6 +1608,9 @@ def db_test():
     # Display the size of the testscores collection
     print(mdb.get_collection_size('testscores'))
 
+    # Display the average and best test score
+    print(mdb.aggregate('testscores', [{'$group': {'_id': None, 'avg': {'$avg': '$value'}, 'max': {'$max': '$value'}}}]))
+
     # Display the db's UUID
     print(mdb.collections['default']['uuid'])
 
@@ -163,6 +1650,348 @@ class TestDB(unittest.TestCase):
         self.assertEqual(db.get_collection_size('default'), 3)
         self.assertEqual(len(db.get_collection_names()), 1)
 
+    def test_concurrent_readers_and_writers(self):
+        db = MangoDB()
+        db.add_collection('temperatures')
+        errors = []
+
+        def writer(offset):
+            try:
+                for i in range(200):
+                    db.update_collection('temperatures', {offset + i: i})
+            except Exception as e:
+                errors.append(e)
+
+        def reader():
+            try:
+                for _ in range(50):
+                    db.display_all_collections()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(n * 1000,)) for n in range(4)]
+        threads += [threading.Thread(target=reader) for _ in range(4)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(db.get_collection_size('temperatures'), 800)
+        self.assertEqual(db.get_collection_version('temperatures'), 801)
+
+    def test_snapshot_is_isolated_from_writes(self):
+        db = MangoDB()
+        db.add_collection('temperatures')
+        db.update_collection('temperatures', {1: 50})
+        snap = db.snapshot('temperatures')
+        db.update_collection('temperatures', {2: 100})
+        self.assertEqual(dict(snap), {1: 50})
+        self.assertEqual(db.get_collection_size('temperatures'), 2)
+
+    def test_persistent_map(self):
+        rng = random.Random(0)
+        expected, pmap = {}, PersistentMap()
+        versions = []
+        for _ in range(20):
+            editor = pmap.edit()
+            for _ in range(200):
+                key = rng.choice([rng.randrange(3000), str(rng.randrange(100)), (rng.randrange(5), 'k')])
+                if rng.random() < 0.3:
+                    self.assertEqual(editor.pop(key, None), expected.pop(key, None))
+                else:
+                    editor[key] = expected[key] = rng.random()
+            pmap = editor.finish()
+            versions.append((pmap, dict(expected)))
+        # Earlier versions are left untouched by the writes made after them
+        for pmap, expected in versions:
+            self.assertEqual(len(pmap), len(expected))
+            self.assertEqual(dict(pmap.items()), expected)
+            self.assertEqual(set(pmap), set(expected))
+        self.assertNotIn(-1, pmap)
+        with self.assertRaises(KeyError):
+            pmap[-1]
+        self.assertEqual(PersistentMap({1: 'a'}).set(2, 'b').discard(1), {2: 'b'})
+
+        # The node bytes counted along the edits are those of the nodes
+        def node_bytes(node):
+            children = node if type(node) is list else ()
+            return sys.getsizeof(node) + sum(node_bytes(child) for child in children if child is not None)
+        for pmap, expected in versions:
+            self.assertEqual(pmap._nbytes, node_bytes(pmap._root))
+        self.assertEqual(len(pmap.sample(10)), 10)
+        self.assertTrue(all(pmap[key] == value for key, value in pmap.sample(10)))
+
+    def test_find(self):
+        db = MangoDB()
+        db.add_collection('students')
+        db.update_collection('students', {1: {'name': 'Ann', 'score': 99}, 2: {'name': 'Bob', 'score': 66}})
+        self.assertEqual(list(db.find('students', {'score': {'$gte': 90}})), [1])
+        self.assertEqual(list(db.find('students', {'name': 'Bob'})), [2])
+        self.assertEqual(db.find('default', {'$eq': 'mangodb'}), {'db': 'mangodb'})
+
+    def test_aggregate(self):
+        test_scores = [99, 89, 88, 75, 66, 92, 75, 94, 88, 87, 88, 68, 52]
+        db = MangoDB()
+        db.add_collection('testscores')
+        db.update_collection('testscores', dict(zip(range(1, len(test_scores) + 1), test_scores)))
+        result = db.aggregate('testscores', [{'$group': {'_id': None, 'avg': {'$avg': '$value'}, 'n': {'$sum': 1}}}])
+        self.assertEqual(result, [{'_id': None, 'avg': sum(test_scores) / len(test_scores), 'n': len(test_scores)}])
+        top = db.aggregate('testscores', [{'$match': {'value': {'$gte': 90}}},
+                                          {'$sort': {'value': -1}},
+                                          {'$limit': 2},
+                                          {'$project': {'_id': 0, 'score': '$value'}}])
+        self.assertEqual(top, [{'score': 99}, {'score': 94}])
+
+    def test_aggregate_sum_across_batches(self):
+        global BATCH_SIZE
+        db = MangoDB()
+        db.add_collection('amounts')
+        db.update_collection('amounts', {1: 1, 2: 2, 3: 0.5, 4: 0.25, 5: None})
+        saved, BATCH_SIZE = BATCH_SIZE, 2
+        try:
+            result = db.aggregate('amounts', [{'$group': {'_id': None, 'total': {'$sum': '$value'}}}])
+        finally:
+            BATCH_SIZE = saved
+        self.assertEqual(result, [{'_id': None, 'total': 3.75}])
+
+    def test_aggregate_unhashable_values(self):
+        db = MangoDB()
+        db.add_collection('students')
+        db.create_index('students', 'tags')
+        db.update_collection('students', {1: {'name': 'Ann', 'tags': [1, 2]}, 2: {'name': 'Bob', 'tags': 'x'}})
+        self.assertEqual(db.aggregate('students', [{'$match': {'tags': [1, 2]}}, {'$project': {'name': 1}}]), [{'_id': 1, 'name': 'Ann'}])
+        self.assertEqual(db.aggregate('students', [{'$match': {'_id': [1, 2]}}]), [])
+        self.assertEqual([r['_id'] for r in db.aggregate('students', [{'$match': {'tags': {'$ne': 'x'}}}])],
+                         list(db.find('students', {'tags': {'$ne': 'x'}})))
+        self.assertEqual(db.aggregate('students', [{'$group': {'_id': None, 'n': {'$count': '$tags'}}}]), [{'_id': None, 'n': 2}])
+        with self.assertRaisesRegex(ValueError, 'numeric'):
+            db.aggregate('students', [{'$group': {'_id': None, 'first': {'$min': '$name'}}}])
+        # Once the unhashable value is gone the index answers the lookups again
+        db.delete('students', 1)
+        with db._catalog_lock.read_locked():
+            self.assertNotIn(_UNINDEXED, db._indexes['students']['tags'])
+
+    def test_aggregate_uses_indexes(self):
+        db = MangoDB()
+        db.add_collection('students')
+        db.create_index('students', 'grade')
+        db.update_collection('students', {1: {'grade': 'A', 'score': 95}, 2: {'grade': 'B', 'score': 85}, 3: {'grade': 'A', 'score': 91}})
+        db.update_collection('students', {2: {'grade': 'A', 'score': 90}})
+        content = db.snapshot('students')
+        with db._catalog_lock.read_locked():
+            indexes = db._indexes['students']
+        self.assertEqual(candidate_keys({'grade': 'A'}, content, indexes), {1, 2, 3})
+        self.assertEqual(candidate_keys({'_id': {'$in': [1, 7]}}, content, indexes), {1})
+        self.assertIsNone(candidate_keys({'score': 90}, content, indexes))
+        result = db.aggregate('students', [{'$match': {'grade': 'A'}},
+                                           {'$group': {'_id': '$grade', 'total': {'$sum': '$score'}, 'low': {'$min': '$score'}}}])
+        self.assertEqual(result, [{'_id': 'A', 'total': 276, 'low': 90}])
+
+    def test_sharded(self):
+        with ShardedMangoDB(n_shards=3) as db:
+            self.assertEqual(db.get_collection_size('default'), 3)
+            db.add_collection('testscores')
+            # Large enough for the per-shard payloads to travel through shared memory
+            db.update_collection('testscores', {k: {'score': k % 100, 'note': 'x' * 200} for k in range(6000)})
+            self.assertEqual(db.get_collection_size('testscores'), 6000)
+            self.assertEqual(db.get('testscores', 1234), {'score': 34, 'note': 'x' * 200})
+            db.put('testscores', 1234, {'score': 100})
+            self.assertEqual(db.get('testscores', 1234), {'score': 100})
+            self.assertEqual(list(db.find('testscores', {'score': {'$gte': 100}})), [1234])
+            top = db.aggregate('testscores', [{'$match': {'score': {'$gte': 99}}}, {'$sort': {'score': -1}}, {'$limit': 2},
+                                              {'$project': {'score': 1}}])
+            self.assertEqual(top[0], {'_id': 1234, 'score': 100})
+            self.assertEqual(top[1]['score'], 99)
+            result = db.aggregate('testscores', [{'$group': {'_id': None, 'n': {'$sum': 1}}}])
+            self.assertEqual(result, [{'_id': None, 'n': 6000}])
+            # Equal keys of different types are the same item, as in MangoDB
+            db.put('testscores', 7.0, {'score': 1})
+            self.assertEqual(db.get('testscores', 7), {'score': 1})
+            db.put('testscores', (True, 2), {'score': 2})
+            self.assertEqual(db.get('testscores', (1, 2.0)), {'score': 2})
+            self.assertEqual(db.get_collection_size('testscores'), 6001)
+            db.delete('testscores', (1, 2))
+            stats = db.stats()
+            self.assertEqual(stats['collections']['testscores']['items'], 6000)
+            self.assertGreater(stats['bytes'], 6000 * 200)
+            with self.assertRaises(KeyError):
+                db.get('missing', 1)
+            db.wipe()
+            self.assertEqual(list(db.get_collection_names()), ['default'])
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'), 'shared memory blocks are not listed in /dev/shm')
+    def test_sharded_shared_memory_is_unlinked(self):
+        before = set(os.listdir('/dev/shm'))
+        with ShardedMangoDB(n_shards=2) as db:
+            db.add_collection('blobs')
+            # Large enough to travel through shared memory both to and from the workers
+            db.update_collection('blobs', {k: 'x' * 200 for k in range(2000)})
+            self.assertEqual(len(db.find('blobs')), 2000)
+        self.assertEqual({name for name in set(os.listdir('/dev/shm')) - before if name.startswith('psm_')}, set())
+
+    def test_ttl_collection(self):
+        now = [0.0]
+        db = MangoDB()
+        db.clock = lambda: now[0]
+        db.add_collection('cache', ttl=10)
+        db.update_collection('cache', {1: 'a', 2: 'b'})
+        now[0] = 5.0
+        db.put('cache', 2, 'bb')
+        now[0] = 10.5
+        self.assertIsNone(db.get('cache', 1))
+        self.assertEqual(dict(db.snapshot('cache')), {2: 'bb'})
+        now[0] = 2000.0
+        self.assertEqual(db.get_collection_size('cache'), 0)
+
+    def test_ttl_reads_do_not_publish(self):
+        now = [0.0]
+        db = MangoDB()
+        db.clock = lambda: now[0]
+        db.add_collection('cache', ttl=10)
+        db.put('cache', 1, 'a')
+        version = db.get_collection_version('cache')
+        for _ in range(50):
+            now[0] += 0.1
+            db.get('cache', 1)
+        self.assertEqual(db.get_collection_version('cache'), version)
+
+    def test_ttl_collection_aggregate_and_stats(self):
+        now = [0.0]
+        db = MangoDB()
+        db.clock = lambda: now[0]
+        db.add_collection('cache', ttl=10)
+        db.create_index('cache', 'kind')
+        db.update_collection('cache', {1: {'kind': 'a'}, 2: {'kind': 'b'}})
+        now[0] = 20.0
+        self.assertEqual(db.aggregate('cache', [{'$group': {'_id': None, 'n': {'$sum': 1}}}]), [])
+        self.assertEqual(db.aggregate('cache', [{'$match': {'kind': 'a'}}]), [])
+        self.assertEqual(db.collection_stats('cache')['items'], 0)
+
+    def test_timing_wheel(self):
+        wheel = TimingWheel(resolution=1.0, n_slots=8)
+        wheel.schedule('soon', 3)
+        wheel.schedule('later', 20)
+        self.assertEqual(wheel.advance(2), [])
+        self.assertEqual(wheel.advance(3), ['soon'])
+        self.assertEqual(wheel.advance(19), [])
+        self.assertEqual(wheel.advance(100), ['later'])
+
+    def test_capped_collection(self):
+        db = MangoDB()
+        db.add_collection('recent', max_items=3)
+        db.update_collection('recent', {1: 'a', 2: 'b', 3: 'c'})
+        db.put('recent', 1, 'aa')
+        db.put('recent', 4, 'd')
+        self.assertEqual(dict(db.snapshot('recent')), {1: 'aa', 3: 'c', 4: 'd'})
+        db.add_collection('small', max_bytes=200)
+        db.update_collection('small', {k: 'x' * 40 for k in range(10)})
+        self.assertLess(db.get_collection_size('small'), 10)
+        self.assertIn(9, db.snapshot('small'))
+        db.delete('small', 9)
+        self.assertNotIn(9, db.snapshot('small'))
+
+    def test_stats(self):
+        db = MangoDB()
+        db.add_collection('testscores')
+        db.create_index('testscores', 'value')
+        db.update_collection('testscores', {1: 99, 2: 89, 3: 99})
+        db.get('testscores', 1)
+        db.get('testscores', 2)
+        stats = db.collection_stats('testscores')
+        self.assertEqual(stats['items'], 3)
+        self.assertEqual((stats['reads'], stats['writes']), (2, 1))
+        self.assertGreater(stats['bytes'], 0)
+        self.assertEqual(stats['indexes']['value']['entries'], 2)
+        self.assertEqual(sum(stats['read_latency_us']['histogram'].values()), 2)
+        self.assertEqual(set(db.stats()['collections']), {'default', 'testscores'})
+
+    def test_watch(self):
+        db = MangoDB()
+        db.add_collection('temperatures')
+        stream = db.watch('temperatures', {'op': 'update', 'value': {'$gte': 100}})
+        db.update_collection('temperatures', {1: 50, 2: 100})
+        db.delete('temperatures', 1)
+        db.put('temperatures', 3, 120)
+        self.assertEqual([(e['key'], e['value']) for e in (stream.next(0), stream.next(0))], [(2, 100), (3, 120)])
+        self.assertIsNone(stream.next(0))
+
+        everything = db.watch('temperatures', resume_after=stream.resume_token - 3)
+        self.assertEqual([everything.next(0)['op'] for _ in range(3)], ['update', 'delete', 'update'])
+
+        db._change_log = ChangeLog(capacity=2)
+        db.update_collection('temperatures', {k: k for k in range(5)})
+        with self.assertRaises(ChangeStreamHistoryLost):
+            db.watch(resume_after=0)
+
+    def test_watch_async(self):
+        async def run():
+            db = MangoDB()
+            db.add_collection('temperatures')
+            stream = db.watch('temperatures')
+            threading.Timer(0.01, db.update_collection, args=('temperatures', {1: 50})).start()
+            async for change in stream:
+                self.assertEqual((change['key'], change['value']), (1, 50))
+                stream.close()
+        asyncio.run(asyncio.wait_for(run(), 5))
+
+    def test_watch_async_close(self):
+        async def run():
+            db = MangoDB()
+            db.add_collection('temperatures')
+            stream = db.watch('temperatures')
+            changes = []
+
+            async def consume():
+                async for change in stream:
+                    changes.append(change)
+
+            consumer = asyncio.ensure_future(consume())
+            await asyncio.sleep(0.01)
+            stream.close()
+            await consumer
+            self.assertEqual(changes, [])
+        asyncio.run(asyncio.wait_for(run(), 5))
+
+    def test_watch_async_closed_loop(self):
+        db = MangoDB()
+        db.add_collection('temperatures')
+        stream = db.watch('temperatures')
+
+        async def consume():
+            async for change in stream:
+                pass
+
+        async def run():
+            asyncio.ensure_future(consume())
+            await asyncio.sleep(0.01)
+
+        # asyncio.run() cancels the consumer blocked in async for and closes its loop, leaving its waiter behind
+        asyncio.run(run())
+        db.put('temperatures', 1, 50)
+        self.assertEqual(db.get('temperatures', 1), 50)
+
+    def test_server_and_client(self):
+        async def run():
+            server = await MangoServer(MangoDB(), port=0).start()
+            try:
+                async with MangoClient(port=server.port, pool_size=2) as client:
+                    await client.add_collection('testscores')
+                    await client.update_collection('testscores', {1: 99, 2: 89})
+                    await asyncio.gather(*(client.put('testscores', k, k) for k in range(3, 103)))
+                    self.assertEqual(await client.get_collection_size('testscores'), 102)
+                    self.assertEqual(await client.get('testscores', 1), 99)
+                    self.assertEqual(await client.get_many('testscores', [1, 2, 1000]), {1: 99, 2: 89})
+                    self.assertEqual(await client.find('testscores', {'$gt': 100}), {101: 101, 102: 102})
+                    with self.assertRaises(MangoRemoteError):
+                        await client.get('missing', 1)
+                with self.assertRaises(MangoRemoteError):
+                    await MangoClient(port=server.port).get('testscores', 1)
+            finally:
+                await server.close()
+        asyncio.run(run())
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
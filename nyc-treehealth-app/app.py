@@ -5,15 +5,32 @@ from dash.dependencies import Input, Output
 import plotly.express as px
 import plotly.graph_objs as go
 import pandas as pd
-import numpy as np
+import os
+from treecube import TreeCube
+from census import CensusSnapshot
+
+# Data
+
+# Returns the tree counts per borough, species, health and steward. They are built from a local census export when
+# TREE_CENSUS_PATH points to one (CSV), otherwise read from the TREE_CUBE_PATH snapshot or aggregated by
+# the census API (and saved to the snapshot) when there is none.
+def get_tree_cube():
+    census_path = os.environ.get('TREE_CENSUS_PATH')
+    if census_path:
+        return TreeCube.from_frame(CensusSnapshot.from_file(census_path).frame())
+    path = os.environ.get('TREE_CUBE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tree-cube.npz'))
+    if os.path.exists(path):
+        return TreeCube.load(path)
+    cube = TreeCube.from_soql()
+    cube.save(path)
+    return cube
+
+tree_cube = get_tree_cube()
 
 # Helper functions for layout
 
 def get_tree_species(output=None):
-    soql_url = ('https://data.cityofnewyork.us/resource/nwxe-4ae8.json?' +
-                '$select=distinct(spc_common)').replace(' ', '%20')
-    trees = pd.read_json(soql_url).dropna()
-    trees = list(trees.spc_common_1)
+    trees = tree_cube.species
     if output=='dict':
         return [{'label': spc, 'value': spc} for spc in sorted(trees)]
     else:
@@ -89,21 +106,6 @@ app.layout = html.Div(children=[
 
 ])
 
-# Helper functions
-
-def get_tree_info():
-    tree_info = pd.DataFrame()
-    for boro in ['Bronx', 'Brooklyn', 'Manhattan', 'Queens', 'Staten Island']:
-        soql_url = ('https://data.cityofnewyork.us/resource/nwxe-4ae8.json?' + \
-                    '$select=spc_common,count(tree_id),health,steward' + \
-                    '&$where=boroname=\'{}\'' + \
-                    '&$group=spc_common,health,steward').format(boro).replace(' ', '%20')
-        soql_trees = pd.read_json(soql_url)
-        soql_trees['borough'] = boro
-        soql_trees = soql_trees.dropna()
-        tree_info = tree_info.append(soql_trees)
-    return tree_info
-
 # Callbacks
 
 @app.callback(
@@ -111,13 +113,10 @@ def get_tree_info():
     [Input('dropdown-boro', 'value'),
      Input('dropdown-species', 'value')])
 def tree_prop_map(borough, species):
-    treeinfo = get_tree_info()
-    trees = treeinfo[(treeinfo.spc_common==species)&(treeinfo.borough==borough)]
-    t = trees.groupby(['health']).agg({'count_tree_id':'sum'})
+    t = tree_cube.slice(borough, species).sum(axis=0).rename('count_tree_id').to_frame()
+    t = t[t.count_tree_id > 0]
     t_prop = t.apply(lambda x: 100 * x / float(x.sum()))
     t_prop = t_prop.reset_index()
-    t_prop.health = pd.Categorical(t_prop.health, categories=["Poor", "Fair", "Good"],ordered=True)
-    t_prop = t_prop.sort_values('health', axis=0)
     fig = px.treemap(t_prop, path=['health'], values='count_tree_id',
                      color_discrete_sequence = ['rgb(35,139,69)','rgb(116,196,118)','rgb(199,233,192)'])
     fig.update_layout(title_text='Tree Health Proportion', title_x=0.5)
@@ -129,10 +128,9 @@ def tree_prop_map(borough, species):
     [Input('dropdown-boro', 'value'),
      Input('dropdown-species', 'value')])
 def steward_impact_detail(borough, species):
-    treeinfo = get_tree_info()
-    trees = treeinfo[(treeinfo.spc_common==species)&(treeinfo.borough==borough)]
-    t_pivot = pd.pivot_table(trees, index='steward',values='count_tree_id', columns='health', aggfunc=np.sum)
-    t_pivot = t_pivot.fillna(0)
+    t_pivot = tree_cube.slice(borough, species)
+    # Only the stewards and health levels with trees, as in a pivot of the census rows
+    t_pivot = t_pivot.loc[t_pivot.sum(axis=1) > 0, t_pivot.sum(axis=0) > 0]
     t_pivot = t_pivot.reset_index()
     cols = list(t_pivot.columns[1:])
     t_prop_wide = pd.concat([t_pivot['steward'],t_pivot.iloc[:, 1:].apply(lambda x: 100 * x / float(x.sum()),axis=1)],
@@ -0,0 +1,92 @@
+# Local snapshot of the street tree census for the NYC Tree Health Dashboard
+#
+# The census is read from a CSV export keeping only the columns the dashboard uses, as categoricals. The category
+# codes are then cached as .npy files next to the export and memory mapped when loaded, so that the gunicorn workers
+# share the pages of the cached snapshot instead of each parsing the export.
+
+import json
+import os
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+# Census columns used by the dashboard, and their names in the dashboard
+CENSUS_COLUMNS = {'boroname': 'borough', 'spc_common': 'spc_common', 'health': 'health', 'steward': 'steward'}
+
+
+# Opens a temporary file next to path for writing, and replaces path with it once the block completes, so that a worker
+# loading the snapshot never maps a partly written file
+@contextmanager
+def _atomic_write(path, mode='w'):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+# Returns the census rows of a CSV export with only the used columns, as categoricals
+def read_census(path):
+    # 'None' is a steward category, only empty fields are missing values
+    census = pd.read_csv(path, usecols=list(CENSUS_COLUMNS), dtype={c: 'category' for c in CENSUS_COLUMNS},
+                         keep_default_na=False, na_values=[''])
+    return census.rename(columns=CENSUS_COLUMNS)
+
+
+class CensusSnapshot:
+    def __init__(self, codes, categories):
+        # column -> array of category codes (-1 for missing values), column -> list of categories
+        self.codes = codes
+        self.categories = categories
+
+    @classmethod
+    def from_frame(cls, census):
+        codes, categories = {}, {}
+        for column in CENSUS_COLUMNS.values():
+            values = census[column].astype('category').cat
+            codes[column] = np.asarray(values.codes)
+            categories[column] = [str(c) for c in values.categories]
+        return cls(codes, categories)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for column, codes in self.codes.items():
+            with _atomic_write(os.path.join(directory, column + '.npy'), 'wb') as f:
+                np.save(f, codes)
+        with _atomic_write(os.path.join(directory, 'categories.json')) as f:
+            json.dump(self.categories, f)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'categories.json')) as f:
+            categories = json.load(f)
+        codes = {column: np.load(os.path.join(directory, column + '.npy'), mmap_mode='r') for column in categories}
+        return cls(codes, categories)
+
+    # Returns the snapshot of an export, from its cache when the cache is newer than the export. When the cache cannot
+    # be written, i.e. next to a read-only export, the snapshot parsed from the export is kept in memory.
+    @classmethod
+    def from_file(cls, path, cache_dir=None):
+        cache_dir = cache_dir or path + '.cache'
+        try:
+            if os.path.getmtime(os.path.join(cache_dir, 'categories.json')) >= os.path.getmtime(path):
+                return cls.load(cache_dir)
+        except OSError:
+            pass
+        snapshot = cls.from_frame(read_census(path))
+        try:
+            snapshot.save(cache_dir)
+        except OSError:
+            return snapshot
+        return cls.load(cache_dir)
+
+    # Returns the census rows as a dataframe of categoricals
+    def frame(self):
+        return pd.DataFrame({column: pd.Categorical.from_codes(codes, self.categories[column])
+                             for column, codes in self.codes.items()})
@@ -0,0 +1,60 @@
+# Preaggregated tree counts for the NYC Tree Health Dashboard
+#
+# The street tree census is reduced once to the number of trees per (borough, species, health, steward), held as a
+# dense integer array indexed by the codes of each category. The callbacks then read a (steward x health) slice
+# instead of querying the census. The cube can be saved to and loaded from a .npz snapshot.
+
+import numpy as np
+import pandas as pd
+
+CENSUS_URL = 'https://data.cityofnewyork.us/resource/nwxe-4ae8.json'
+
+BOROUGHS = ['Bronx', 'Brooklyn', 'Manhattan', 'Queens', 'Staten Island']
+HEALTHS = ['Poor', 'Fair', 'Good']
+STEWARDS = ['None', '1or2', '3or4', '4orMore']
+
+
+class TreeCube:
+    def __init__(self, species, counts):
+        self.species = list(species)
+        # borough x species x health x steward
+        self.counts = counts
+        self._species_codes = {s: i for i, s in enumerate(self.species)}
+
+    # Builds the cube from a dataframe with borough, spc_common, health and steward columns, and a column of counts
+    # (one tree per row when count is None). Rows with a missing or unknown category are left out.
+    @classmethod
+    def from_frame(cls, frame, count=None):
+        species = sorted(frame['spc_common'].dropna().unique())
+        codes = [pd.Categorical(frame[column], categories=categories).codes
+                 for column, categories in [('borough', BOROUGHS), ('spc_common', species),
+                                            ('health', HEALTHS), ('steward', STEWARDS)]]
+        valid = np.logical_and.reduce([c >= 0 for c in codes])
+        weights = np.ones(len(frame), dtype=np.int64) if count is None else frame[count].values.astype(np.int64)
+        flat = np.ravel_multi_index([c[valid] for c in codes], (len(BOROUGHS), len(species), len(HEALTHS), len(STEWARDS)))
+        counts = np.bincount(flat, weights=weights[valid], minlength=len(BOROUGHS) * len(species) * len(HEALTHS) * len(STEWARDS))
+        return cls(species, counts.astype(np.int32).reshape(len(BOROUGHS), len(species), len(HEALTHS), len(STEWARDS)))
+
+    # Builds the cube from one grouped SoQL query on the census
+    @classmethod
+    def from_soql(cls, url=CENSUS_URL):
+        soql_url = (url + '?$select=boroname,spc_common,health,steward,count(tree_id)' +
+                    '&$group=boroname,spc_common,health,steward&$limit=50000').replace(' ', '%20')
+        trees = pd.read_json(soql_url).rename(columns={'boroname': 'borough'})
+        return cls.from_frame(trees, count='count_tree_id')
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as snapshot:
+            return cls(snapshot['species'].tolist(), snapshot['counts'])
+
+    def save(self, path):
+        np.savez(path, species=np.array(self.species), counts=self.counts)
+
+    # Returns the (steward x health) counts of a species in a borough
+    def slice(self, borough, species):
+        if borough not in BOROUGHS or species not in self._species_codes:
+            counts = np.zeros((len(HEALTHS), len(STEWARDS)), dtype=np.int32)
+        else:
+            counts = self.counts[BOROUGHS.index(borough), self._species_codes[species]]
+        return pd.DataFrame(counts.T, index=pd.Index(STEWARDS, name='steward'), columns=pd.Index(HEALTHS, name='health'))